@@ -0,0 +1,170 @@
+import math
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class Admission:
+    """کنترل ورود درخواست‌ها پیش از رسیدن به دیتابیس و API هوش مصنوعی
+
+    - سطل توکن (token bucket) برای هر session و هر IP در هر دسته endpoint؛
+      limits: {دسته: (توکن در ثانیه، ظرفیت)}. سطل IP ظرفیت و نرخ ip_factor برابر
+      دارد چون چند کاربر پشت یک NAT هستند.
+    - سقف تماس‌های همزمان هوش مصنوعی برای کل سرور (همه worker ها).
+    - سقف درخواست‌های همزمان کاربران در هر worker تا همیشه نخ آزاد برای
+      ادمین بماند.
+
+    وضعیت در یک فایل SQLite بین worker های gunicorn مشترک است (مثل لایه دوم کش
+    پاسخ‌ها)؛ بدون db_path فقط در حافظه همین پروسه. این داده موقتی است، پس
+    synchronous = OFF: بعد از قطع برق فقط سطل‌ها از نو پر می‌شوند.
+    """
+
+    def __init__(self, db_path=None, limits=None, ip_factor=4, ai_max_in_flight=0,
+                 ai_slot_ttl=120, max_in_flight=0):
+        self.limits = dict(limits or {})
+        self.ip_factor = ip_factor
+        self.ai_max_in_flight = ai_max_in_flight
+        self.ai_slot_ttl = ai_slot_ttl
+        self.max_in_flight = max_in_flight
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._next_cleanup = 0
+        self._conn = sqlite3.connect(db_path or ':memory:', timeout=5, check_same_thread=False,
+                                     isolation_level=None)
+        if db_path:
+            self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = OFF')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL,
+                updated_at REAL,
+                idle_at REAL
+            )
+        ''')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS ai_slots (
+                token TEXT PRIMARY KEY,
+                expires_at REAL
+            )
+        ''')
+
+    # ---------- سطل‌های توکن ----------
+
+    def take(self, kind, session_id=None, ip=None):
+        """برداشتن یک توکن از سطل‌های این درخواست؛ 0 یعنی مجاز، وگرنه ثانیه تا Retry-After
+
+        توکن فقط وقتی برداشته می‌شود که همه سطل‌ها توکن داشته باشند.
+        """
+        limit = self.limits.get(kind)
+        if not limit:
+            return 0
+        rate, burst = limit
+        buckets = []
+        if session_id:
+            buckets.append((f'{kind}:s:{session_id}', rate, burst))
+        if ip:
+            buckets.append((f'{kind}:ip:{ip}', rate * self.ip_factor, burst * self.ip_factor))
+        if not buckets:
+            return 0
+
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute('BEGIN IMMEDIATE')
+                try:
+                    wait = 0
+                    levels = []
+                    for key, bucket_rate, capacity in buckets:
+                        row = self._conn.execute(
+                            'SELECT tokens, updated_at FROM buckets WHERE key = ?', (key,)
+                        ).fetchone()
+                        tokens = capacity if row is None else min(
+                            capacity, row[0] + max(now - row[1], 0) * bucket_rate
+                        )
+                        if tokens < 1:
+                            wait = max(wait, (1 - tokens) / bucket_rate)
+                        levels.append((key, tokens, bucket_rate, capacity))
+
+                    if not wait:
+                        # idle_at: زمانی که سطل دوباره پر است و ردیف دیگر لازم نیست
+                        self._conn.executemany(
+                            'INSERT OR REPLACE INTO buckets (key, tokens, updated_at, idle_at) VALUES (?, ?, ?, ?)',
+                            [(key, tokens - 1, now, now + (capacity - tokens + 1) / bucket_rate)
+                             for key, tokens, bucket_rate, capacity in levels]
+                        )
+                    if now >= self._next_cleanup:
+                        self._conn.execute('DELETE FROM buckets WHERE idle_at < ?', (now,))
+                        self._next_cleanup = now + 60
+                    self._conn.execute('COMMIT')
+                except Exception:
+                    self._conn.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as e:
+                # خرابی این لایه نباید سایت را از کار بیندازد
+                print(f"Admission error: {e}")
+                return 0
+        return math.ceil(wait)
+
+    # ---------- سقف همزمانی ----------
+
+    def acquire_ai(self):
+        """گرفتن یک جای خالی برای تماس با هوش مصنوعی؛ None یعنی ظرفیت پر است
+
+        جای worker ی که وسط کار از کار افتاده بعد از ai_slot_ttl آزاد می‌شود.
+        """
+        if not self.ai_max_in_flight:
+            return ''
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self._lock:
+            try:
+                self._conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self._conn.execute('DELETE FROM ai_slots WHERE expires_at < ?', (now,))
+                    in_flight = self._conn.execute('SELECT COUNT(*) FROM ai_slots').fetchone()[0]
+                    if in_flight < self.ai_max_in_flight:
+                        self._conn.execute('INSERT INTO ai_slots (token, expires_at) VALUES (?, ?)',
+                                           (token, now + self.ai_slot_ttl))
+                    else:
+                        token = None
+                    self._conn.execute('COMMIT')
+                except Exception:
+                    self._conn.execute('ROLLBACK')
+                    raise
+            except sqlite3.Error as e:
+                print(f"Admission error: {e}")
+                return ''
+        return token
+
+    def release_ai(self, token):
+        if not token:
+            return
+        with self._lock:
+            try:
+                self._conn.execute('DELETE FROM ai_slots WHERE token = ?', (token,))
+            except sqlite3.Error as e:
+                print(f"Admission error: {e}")
+
+    def ai_in_flight(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM ai_slots WHERE expires_at >= ?', (time.time(),)
+            ).fetchone()[0]
+
+    def enter(self):
+        """شروع یک درخواست کاربر در این worker؛ False یعنی باید رد شود"""
+        with self._lock:
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                return False
+            self._in_flight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
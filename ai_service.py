@@ -1,57 +1,252 @@
 import requests
 import json
+import os
 import random
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+
+from keyword_rules import ReloadableRuleSet
+from metrics import AI_CALL_SECONDS, AI_CALLS_REJECTED, AI_RESPONSES, trace_event
+
+# قوانین پاسخ محلی، تمیزکاری و پاسخ جایگزین
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules', 'ai_rules.json')
+
+# دستورالعمل سیستم - بهینه‌سازی برای فارسی
+SYSTEM_PROMPT = """تو یک دستیار هوش مصنوعی فارسی به نام ChatGPT هستی. 
+                قوانین:
+                1. همیشه به زبان فارسی پاسخ بده
+                2. مهربان و مفید باش
+                3. پاسخ‌ها رو کوتاه و مفید ارائه بده
+                4. از اموجی مناسب استفاده کن 😊
+                5. اگر سوال ریاضی بود، از LaTeX استفاده کن
+                6. اگر نمی‌دونی، صادقانه بگو
+                
+                شخصیت: دوستانه، باهوش، کمک‌کننده"""
+
+# دستورالعمل خلاصه‌سازی پیام‌های قدیمی که در پنجره گفتگو جا نمی‌شوند
+SUMMARY_PROMPT = ("گفتگوی زیر را به فارسی در حداکثر پنج جمله خلاصه کن. "
+                  "نام‌ها، خواسته‌ها و نکاتی که کاربر گفته و بعداً لازم می‌شوند را نگه دار.")
+
+# وضعیت‌هایی که ارزش تلاش دوباره دارند
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """API در دسترس نیست - بدون تماس شبکه مستقیم به پاسخ محلی برو"""
+
+
+class TokenBucket:
+    """محدودکننده نرخ سمت کلاینت تا از سهمیه API بیشتر درخواست نفرستیم"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquire(self, timeout):
+        """یک توکن بگیر؛ حداکثر timeout ثانیه صبر می‌کند"""
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """بعد از چند خطای پشت سر هم، تا reset_timeout ثانیه تماس با API را قطع می‌کند"""
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+    
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            # بعد از reset_timeout فقط یک درخواست آزمایشی اجازه دارد
+            if time.monotonic() - self._opened_at >= self.reset_timeout and not self._probing:
+                self._probing = True
+                return True
+            return False
+    
+    def release_probe(self):
+        """درخواست آزمایشی بدون نتیجه تمام شد (مثلاً rate limit محلی)؛ نوبت به بعدی برسد"""
+        with self._lock:
+            self._probing = False
+    
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+    
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
 
 class AIService:
-    def __init__(self, api_key=None, api_url=None, model=None):
+    def __init__(self, api_key=None, api_url=None, model=None, pool_size=10,
+                 max_retries=3, backoff_base=0.5, backoff_max=8,
+                 breaker_threshold=5, breaker_reset=30, rate_limit=None, rate_burst=5,
+                 cache=None, rules_path=None):
         self.api_key = api_key
         self.api_url = api_url
         self.model = model or 'gpt-3.5-turbo'
-        self.local_responses = self._load_local_responses()
-    
-    def _load_local_responses(self):
-        """پاسخ‌های محلی برای مواقع قطعی API"""
-        return {
-            "سلام": "سلام! چطور می‌تونم کمکتون کنم؟ 😊",
-            "خداحافظ": "خداحافظ! منتظر بازگشت شما هستم 👋",
-            "تشکر": "خواهش می‌کنم! خوشحالم که می‌تونم کمک کنم 🤗",
-            "اسم": "من دستیار هوش مصنوعی ChatGPT هستم! 🤖",
-            "چطوری": "من خوبم ممنون! شما چطورید؟ 😊",
-            "ریاضی": "برای سوالات ریاضی می‌تونید از LaTeX استفاده کنید. مثلاً: $E = mc^2$",
-            "کمک": "من می‌تونم در موضوعات مختلف کمکتون کنم. سوالاتتون رو بپرسید!",
-            "برنامه‌نویسی": "در مورد کد و برنامه‌نویسی هم می‌تونم کمک کنم!",
-            "طرف": "روز خوبی داشته باشید! 🌞",
-            "ساعت": f"الان ساعت {datetime.now().strftime('%H:%M')} هست."
-        }
+        self.rules = ReloadableRuleSet(rules_path or DEFAULT_RULES_PATH)
+        
+        # یک session با اتصال‌های keep-alive به جای اتصال جدید برای هر پیام
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.rate_limiter = TokenBucket(rate_limit, rate_burst) if rate_limit else None
+        
+        # کش اختیاری پاسخ‌ها (ResponseCache)
+        self.cache = cache
+    
+    def reload_rules(self):
+        """بارگذاری دوباره فایل قوانین بدون ری‌استارت"""
+        return self.rules.reload()
     
-    def get_response(self, user_input, use_real_ai=True):
-        """دریافت پاسخ از ChatGPT"""
+    def get_response(self, user_input, use_real_ai=True, timeout=30, history=None):
+        """دریافت پاسخ از ChatGPT
+        
+        history: پیام‌های قبلی گفتگو به قالب chat (خروجی ContextBuilder.build)
+        """
         if not user_input:
             return "سوال خودتون رو بپرسید! 😊"
         
-        user_input_lower = user_input.lower()
-        
         # اول چک کن ببین پاسخ از پیش تعریف شده داریم
-        for key in self.local_responses:
-            if key in user_input_lower:
-                return self.local_responses[key]
+        local_response = self.rules.get().local_response(user_input)
+        if local_response is not None:
+            AI_RESPONSES.inc(mode='sync', source='local')
+            return local_response
         
         # اگر API key موجود بود، از ChatGPT استفاده کن
         if use_real_ai and self.api_key and self.api_url:
+            cache_key = self._cache_key(user_input, history)
+            cached = self.cache.get(cache_key) if self.cache else None
+            if cached is not None:
+                AI_RESPONSES.inc(mode='sync', source='cache')
+                return cached
+            
             try:
-                ai_response = self._call_chatgpt(user_input)
-                return self._clean_response(ai_response)
+                ai_response = self._clean_response(
+                    self._call_chatgpt(user_input, timeout=timeout, history=history)
+                )
+                if self.cache:
+                    self.cache.set(cache_key, user_input, ai_response)
+                AI_RESPONSES.inc(mode='sync', source='api')
+                return ai_response
             except Exception as e:
                 print(f"ChatGPT API Error: {e}")
                 # اگر خطا داشت، به پاسخ‌های محلی برو
+                AI_RESPONSES.inc(mode='sync', source='fallback')
                 return self._get_fallback_response(user_input)
         
         # در غیر این صورت از پاسخ‌های محلی استفاده کن
+        AI_RESPONSES.inc(mode='sync', source='fallback')
         return self._get_fallback_response(user_input)
     
-    def _call_chatgpt(self, user_input):
-        """تماس با ChatGPT API"""
+    def stream_response(self, user_input, timeout=30, history=None):
+        """دریافت تدریجی پاسخ از ChatGPT
+        
+        رویدادهای ('delta', متن) را همزمان با رسیدن تولید می‌کند و در پایان
+        یک ('done', متن نهایی تمیز شده) می‌دهد که باید ذخیره شود.
+        """
+        if not user_input:
+            yield ('done', "سوال خودتون رو بپرسید! 😊")
+            return
+        
+        local_response = self.rules.get().local_response(user_input)
+        if local_response is not None:
+            AI_RESPONSES.inc(mode='stream', source='local')
+            yield ('delta', local_response)
+            yield ('done', local_response)
+            return
+        
+        if not (self.api_key and self.api_url):
+            AI_RESPONSES.inc(mode='stream', source='fallback')
+            fallback = self._get_fallback_response(user_input)
+            yield ('delta', fallback)
+            yield ('done', fallback)
+            return
+        
+        cache_key = self._cache_key(user_input, history)
+        cached = self.cache.get(cache_key) if self.cache else None
+        if cached is not None:
+            AI_RESPONSES.inc(mode='stream', source='cache')
+            yield ('delta', cached)
+            yield ('done', cached)
+            return
+        
+        parts = []
+        complete = False
+        try:
+            for chunk in self._stream_chatgpt(user_input, timeout=timeout, history=history):
+                parts.append(chunk)
+                yield ('delta', chunk)
+            complete = True
+        except Exception as e:
+            print(f"ChatGPT API Error: {e}")
+            if not parts:
+                AI_RESPONSES.inc(mode='stream', source='fallback')
+                fallback = self._get_fallback_response(user_input)
+                yield ('delta', fallback)
+                yield ('done', fallback)
+                return
+        
+        AI_RESPONSES.inc(mode='stream', source='api' if complete else 'partial')
+        final_text = self._clean_response(''.join(parts))
+        # پاسخ نیمه‌کاره (قطع شده) کش نمی‌شود
+        if complete and self.cache:
+            self.cache.set(cache_key, user_input, final_text)
+        yield ('done', final_text)
+    
+    def _cache_key(self, user_input, history=None):
+        if not self.cache:
+            return None
+        # پاسخ به تاریخچه هم بستگی دارد؛ بدون تاریخچه کلید مثل قبل است
+        context = json.dumps(history, ensure_ascii=False, sort_keys=True) if history else None
+        return self.cache.make_key(user_input, self.model, SYSTEM_PROMPT, context)
+    
+    def _build_request(self, user_input, history=None):
+        """هدرها و بدنه درخواست chat completions"""
         headers = {
             'Authorization': f'Bearer {self.api_key}',
             'Content-Type': 'application/json'
@@ -61,17 +256,9 @@ class AIService:
         messages = [
             {
                 "role": "system",
-                "content": """تو یک دستیار هوش مصنوعی فارسی به نام ChatGPT هستی. 
-                قوانین:
-                1. همیشه به زبان فارسی پاسخ بده
-                2. مهربان و مفید باش
-                3. پاسخ‌ها رو کوتاه و مفید ارائه بده
-                4. از اموجی مناسب استفاده کن 😊
-                5. اگر سوال ریاضی بود، از LaTeX استفاده کن
-                6. اگر نمی‌دونی، صادقانه بگو
-                
-                شخصیت: دوستانه، باهوش، کمک‌کننده"""
+                "content": SYSTEM_PROMPT
             },
+            *(history or []),
             {
                 "role": "user",
                 "content": user_input
@@ -87,16 +274,111 @@ class AIService:
             "frequency_penalty": 0,
             "presence_penalty": 0
         }
+        return headers, data
+    
+    def _api_error(self, error):
+        """تبدیل خطای requests به پیام قابل فهم"""
+        if isinstance(error, CircuitOpenError):
+            return error
+        if isinstance(error, requests.exceptions.Timeout):
+            return Exception("زمان پاسخ‌گویی به پایان رسید. لطفاً دوباره تلاش کنید.")
+        if isinstance(error, requests.exceptions.HTTPError):
+            error_msg = f"HTTP Error: {error.response.status_code}"
+            if error.response.status_code == 401:
+                error_msg = "API Key نامعتبر است!"
+            elif error.response.status_code == 429:
+                error_msg = "محدودیت rate limit! لطفاً کمی صبر کنید."
+            elif error.response.status_code == 500:
+                error_msg = "سرور OpenAI مشکل دارد."
+            return Exception(error_msg)
+        return Exception(f"خطا در ارتباط با ChatGPT: {str(error)}")
+    
+    def _retry_delay(self, attempt, response=None):
+        """تأخیر نمایی با jitter؛ اگر سرور Retry-After فرستاده همان رعایت می‌شود"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    when = parsedate_to_datetime(retry_after)
+                    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+                except (TypeError, ValueError):
+                    pass
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(delay / 2, delay)
+    
+    def _post(self, headers, data, timeout, stream=False):
+        """ارسال درخواست با تلاش مجدد، circuit breaker و محدودیت نرخ
         
+        timeout کل زمان مجاز برای همه تلاش‌هاست.
+        """
+        if not self.breaker.allow():
+            AI_CALLS_REJECTED.inc(reason='circuit_open')
+            raise CircuitOpenError("ChatGPT موقتاً در دسترس نیست.")
+        
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        recorded = False
         try:
-            response = requests.post(
-                self.api_url,
-                headers=headers,
-                json=data,
-                timeout=30  # 30 ثانیه timeout
-            )
-            
-            response.raise_for_status()  # اگر خطای HTTP بود، exception بده
+            while True:
+                remaining = deadline - time.monotonic()
+                if self.rate_limiter and not self.rate_limiter.acquire(timeout=max(remaining, 0)):
+                    # سهمیه محلی تمام شده؛ خطای سرور نیست پس breaker را باز نکن
+                    AI_CALLS_REJECTED.inc(reason='rate_limited')
+                    raise requests.exceptions.Timeout("rate limit محلی")
+                
+                response = None
+                started = time.perf_counter()
+                try:
+                    response = self.session.post(
+                        self.api_url,
+                        headers=headers,
+                        json=data,
+                        stream=stream,
+                        timeout=max(deadline - time.monotonic(), 0.1)
+                    )
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    self._observe_call(stream, 'timeout' if isinstance(e, requests.exceptions.Timeout)
+                                       else 'connection_error', started)
+                    error = e
+                else:
+                    self._observe_call(stream, str(response.status_code), started)
+                    if response.status_code not in RETRY_STATUSES:
+                        # خطاهایی مثل 401 مشکل ما هستند نه قطعی سرویس
+                        self.breaker.record_success()
+                        recorded = True
+                        response.raise_for_status()
+                        return response
+                    error = requests.exceptions.HTTPError(response=response)
+                    response.close()
+                
+                delay = self._retry_delay(attempt, response)
+                attempt += 1
+                if attempt > self.max_retries or time.monotonic() + delay >= deadline:
+                    self.breaker.record_failure()
+                    recorded = True
+                    raise error
+                time.sleep(delay)
+        except BaseException:
+            # خروج بدون ثبت نتیجه نباید breaker را برای همیشه در حالت آزمایشی نگه دارد
+            if not recorded:
+                self.breaker.release_probe()
+            raise
+    
+    @staticmethod
+    def _observe_call(stream, status, started):
+        elapsed = time.perf_counter() - started
+        AI_CALL_SECONDS.observe(elapsed, kind='stream' if stream else 'chat', status=status)
+        trace_event('ai', status, elapsed)
+    
+    def _call_chatgpt(self, user_input, timeout=30, history=None):
+        """تماس با ChatGPT API"""
+        headers, data = self._build_request(user_input, history)
+        
+        try:
+            # پیش‌فرض 30 ثانیه برای کل تلاش‌ها
+            response = self._post(headers, data, timeout)
             
             result = response.json()
             
@@ -106,83 +388,71 @@ class AIService:
             else:
                 raise Exception("No response from ChatGPT API")
                 
-        except requests.exceptions.Timeout:
-            raise Exception("زمان پاسخ‌گویی به پایان رسید. لطفاً دوباره تلاش کنید.")
-        except requests.exceptions.HTTPError as e:
-            error_msg = f"HTTP Error: {e.response.status_code}"
-            if e.response.status_code == 401:
-                error_msg = "API Key نامعتبر است!"
-            elif e.response.status_code == 429:
-                error_msg = "محدودیت rate limit! لطفاً کمی صبر کنید."
-            elif e.response.status_code == 500:
-                error_msg = "سرور OpenAI مشکل دارد."
-            raise Exception(error_msg)
         except Exception as e:
-            raise Exception(f"خطا در ارتباط با ChatGPT: {str(e)}")
+            raise self._api_error(e)
     
-    def _clean_response(self, response):
-        """تمیز کردن پاسخ ChatGPT"""
-        # حذف کلمات اضافی
-        unwanted_prefixes = [
-            "به عنوان یک دستیار هوش مصنوعی",
-            "به عنوان ChatGPT",
-            "به عنوان یک مدل زبانی",
-            "من یک هوش مصنوعی هستم",
-            "خب، ",
-            "باشه، ",
-            "اوکی، ",
-            "ببین، ",
-            "عالی، ",
-            "ممنون از سوال شما.",
-            "سوال جالبی پرسیدید.",
-            "بیایید در مورد این موضوع صحبت کنیم."
-        ]
-        
-        cleaned_response = response.strip()
-        
-        for prefix in unwanted_prefixes:
-            if cleaned_response.startswith(prefix):
-                cleaned_response = cleaned_response[len(prefix):].strip()
+    def _stream_chatgpt(self, user_input, timeout=30, history=None):
+        """تماس با ChatGPT API در حالت stream - تکه‌های متن را تولید می‌کند"""
+        headers, data = self._build_request(user_input, history)
+        data['stream'] = True
         
-        # اضافه کردن اموجی به برخی پاسخ‌ها
-        if any(word in cleaned_response.lower() for word in ['سلام', 'درود', 'صب بخیر']):
-            if '😊' not in cleaned_response:
-                cleaned_response += ' 😊'
-        
-        elif any(word in cleaned_response.lower() for word in ['خداحافظ', 'بدرود', 'خدانگهدار']):
-            if '👋' not in cleaned_response:
-                cleaned_response += ' 👋'
+        try:
+            # تلاش مجدد فقط تا قبل از رسیدن اولین تکه ممکن است
+            with self._post(headers, data, timeout, stream=True) as response:
+                response.encoding = 'utf-8'
+                
+                # قالب server-sent events: هر خط «data: {...}» و در پایان «data: [DONE]»
+                for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                    if not line or not line.startswith('data:'):
+                        continue
+                    payload = line[len('data:'):].strip()
+                    if payload == '[DONE]':
+                        break
+                    
+                    chunk = json.loads(payload)
+                    choices = chunk.get('choices') or []
+                    if choices:
+                        content = (choices[0].get('delta') or {}).get('content')
+                        if content:
+                            yield content
+        except Exception as e:
+            raise self._api_error(e)
+    
+    def summarize(self, previous_summary, turns, timeout=20):
+        """خلاصه کوتاه از پیام‌های قدیمی گفتگو (برای ContextBuilder)"""
+        if not (self.api_key and self.api_url):
+            return None
         
-        elif '?' in cleaned_response and '❓' not in cleaned_response:
-            cleaned_response = cleaned_response.replace('?', '? ❓')
+        lines = [f"خلاصه قبلی: {previous_summary}"] if previous_summary else []
+        for turn in turns:
+            speaker = 'کاربر' if turn['role'] == 'user' else 'دستیار'
+            lines.append(f"{speaker}: {turn['content']}")
         
-        return cleaned_response
+        headers = {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json'
+        }
+        data = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": '\n'.join(lines)}
+            ],
+            "max_tokens": 300,
+            "temperature": 0.3
+        }
+        try:
+            result = self._post(headers, data, timeout).json()
+            return result['choices'][0]['message']['content'].strip()
+        except Exception as e:
+            raise self._api_error(e)
+    
+    def _clean_response(self, response):
+        """تمیز کردن پاسخ ChatGPT"""
+        rules = self.rules.get()
+        # حذف کلمات اضافی و اضافه کردن اموجی به برخی پاسخ‌ها
+        return rules.decorate(rules.strip_prefixes(response))
     
     def _get_fallback_response(self, user_input=None):
         """پاسخ‌های جایگزین اگر ChatGPT کار نکرد"""
-        # پاسخ‌های هوشمند بر اساس نوع سوال
-        if user_input:
-            user_input_lower = user_input.lower()
-            
-            if any(word in user_input_lower for word in ['چطور', 'چگونه', 'راهنمایی']):
-                return "برای راهنمایی دقیق‌تر، لطفاً سوال خود را با جزئیات بیشتری مطرح کنید. 🤔"
-            
-            elif any(word in user_input_lower for word in ['کی', 'چه زمانی', 'تاریخ']):
-                return f"در مورد زمان، الان {datetime.now().strftime('%H:%M')} هست. ⏰"
-            
-            elif any(word in user_input_lower for word in ['ریاضی', 'محاسبه', 'فرمول']):
-                return "برای محاسبات ریاضی، لطفاً فرمول را به صورت LaTeX بنویسید: $x = \\frac{-b \\pm \\sqrt{b^2 - 4ac}}{2a}$"
-        
-        # پاسخ‌های عمومی
-        fallback_responses = [
-            "در حال پردازش سوال شما... 🔄",
-            "بگذارید در مورد این موضوع فکر کنم... 💭",
-            "سوال جالبی است! می‌تونید بیشتر توضیح بدید؟ 🤔",
-            "برای پاسخ دقیق‌تر، لطفاً سوال خود را با جزئیات بیشتری مطرح کنید.",
-            "در حال حاضر ChatGPT در دسترس است. سوال خود را بپرسید!",
-            "می‌تونم در موضوعات مختلف کمکتون کنم. سوال دیگه‌ای دارید؟",
-            "ممنون از صبر شما! در حال بررسی سوال شما هستم... ⏳",
-            "لطفاً کمی صبر کنید، در حال آماده‌سازی پاسخ شما هستم. 🌟"
-        ]
-        
-        return random.choice(fallback_responses)
\ No newline at end of file
+        return self.rules.get().fallback_response(user_input)
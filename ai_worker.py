@@ -0,0 +1,86 @@
+import queue
+import threading
+import time
+
+
+class AIQueueFull(Exception):
+    """صف پاسخ‌های هوش مصنوعی پر است - درخواست باید بعداً تکرار شود"""
+
+
+class AIReplyQueue:
+    """صف محدود و استخر نخ برای گرفتن پاسخ هوش مصنوعی خارج از درخواست HTTP
+
+    پیام کاربر فوراً تأیید می‌شود و پاسخ وقتی رسید با Database.save_message
+    ذخیره و از طریق MessageHub به کلاینت اعلام می‌شود.
+    """
+
+    def __init__(self, ai_service, db, hub, context_builder=None, workers=4, max_queue=100, deadline=45):
+        self.ai_service = ai_service
+        self.db = db
+        self.hub = hub
+        self.context_builder = context_builder
+        self.deadline = deadline
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._workers = workers
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def is_full(self):
+        return self._queue.full()
+
+    def retry_after(self):
+        """تخمین تقریبی زمان خالی شدن صف (ثانیه) برای هدر Retry-After"""
+        return max(1, int(self.depth() / max(self._workers, 1)) + 1)
+
+    def submit(self, user_id, content, message_id=None):
+        """افزودن به صف؛ اگر صف پر باشد AIQueueFull می‌دهد"""
+        self._ensure_workers()
+        job = (user_id, content, message_id, time.monotonic() + self.deadline)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise AIQueueFull()
+
+    def stop(self):
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+
+    def _ensure_workers(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._run, name=f'ai-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            user_id, content, message_id, deadline = job
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining <= 1:
+                    # مهلت در صف تمام شد؛ به جای تماس با API پاسخ محلی بده
+                    reply = self.ai_service.get_response(content, use_real_ai=False)
+                else:
+                    history = None
+                    if self.context_builder and message_id is not None:
+                        history = self.context_builder.build(user_id, before_id=message_id)
+                    reply = self.ai_service.get_response(content, timeout=remaining, history=history)
+                reply_id = self.db.save_message(user_id, 'ai', 'text', reply)
+                self.hub.publish(user_id, reply_id)
+            except Exception as e:
+                print(f"AI worker error: {e}")
+            finally:
+                self._queue.task_done()
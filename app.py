@@ -1,48 +1,360 @@
 import os
+import atexit
+import json
+import time
 import uuid
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, send_from_directory, session
-from werkzeug.utils import secure_filename
+import click
+from datetime import datetime, timezone
+from flask import Flask, Response, g, render_template, request, jsonify, session
 
+from admission import Admission
 from config import Config
 from database import Database
 from ai_service import AIService
+from ai_worker import AIQueueFull, AIReplyQueue
+from broadcast import Broadcaster
+from context_builder import ContextBuilder
+from markup import highlight_snippet, process_latex
+from media_jobs import MediaProcessor
+from metrics import (
+    ADMISSION_REJECTED, DB_METHOD_ERRORS, DB_METHOD_SECONDS, HTTP_IN_FLIGHT, HTTP_REQUEST_SECONDS,
+    REGISTRY, Callback, end_trace, instrument_methods, start_trace, trace_sql
+)
+from message_hub import MessageHub
+from response_cache import ResponseCache
+from retention import Retention
+from serving import FileServer
+from storage import BLOB_PREFIX, BlobStore
 
 app = Flask(__name__)
 app.config.from_object(Config)
 Config.init_app(app)
 
 # Initialize components
-db = Database(app.config['DATABASE'])
+db = Database(
+    app.config['DATABASE'],
+    pool_size=app.config['DB_POOL_SIZE'],
+    busy_timeout=app.config['DB_BUSY_TIMEOUT'],
+    synchronous=app.config['DB_SYNCHRONOUS'],
+    cache_size_kb=app.config['DB_CACHE_SIZE_KB'],
+    mmap_size=app.config['DB_MMAP_SIZE'],
+    user_cache_size=app.config['USER_CACHE_SIZE'],
+    user_cache_ttl=app.config['USER_CACHE_TTL'],
+    activity_flush_interval=app.config['ACTIVITY_FLUSH_INTERVAL'],
+    activity_flush_threshold=app.config['ACTIVITY_FLUSH_THRESHOLD'],
+    write_behind=app.config['DB_WRITE_BEHIND'],
+    write_batch_size=app.config['DB_WRITE_BATCH_SIZE'],
+    write_batch_ms=app.config['DB_WRITE_BATCH_MS'],
+    write_queue_size=app.config['DB_WRITE_QUEUE_SIZE'],
+    write_synchronous=app.config['DB_WRITE_SYNCHRONOUS'],
+    trace_callback=trace_sql if app.config['METRICS_SLOW_REQUEST_MS'] is not None else None
+)
+if app.config['METRICS_ENABLED']:
+    # زمان و تعداد فراخوانی هر متد Database
+    instrument_methods(db, DB_METHOD_SECONDS, DB_METHOD_ERRORS,
+                       exclude=('connection', 'get_connection', 'init_db', 'close'))
+hub = MessageHub(db, poll_interval=app.config['HUB_POLL_INTERVAL'])
+
+# فایل‌های آپلودی هنگام دریافت مستقیم در انبار نوشته و هش می‌شوند
+blob_store = BlobStore(app.config['UPLOAD_FOLDER'], chunk_size=app.config['UPLOAD_CHUNK_SIZE'])
+app.request_class = blob_store.request_class()
+
+# ارسال uploads و static با ETag، 304 و Range
+if app.config['UPLOAD_OFFLOAD'] == 'x-sendfile':
+    app.config['USE_X_SENDFILE'] = True
+upload_server = FileServer(
+    os.path.join(app.root_path, app.config['UPLOAD_FOLDER']),
+    max_age=app.config['UPLOAD_MAX_AGE'],
+    offload=app.config['UPLOAD_OFFLOAD'],
+    accel_prefix=app.config['UPLOAD_ACCEL_PREFIX']
+)
+static_server = FileServer(app.static_folder, max_age=app.config['STATIC_MAX_AGE'])
+
+media_processor = None
+if app.config['MEDIA_ENABLED']:
+    media_processor = MediaProcessor(
+        db, app.config['UPLOAD_FOLDER'],
+        workers=app.config['MEDIA_WORKERS'],
+        thumb_size=app.config['MEDIA_THUMB_SIZE'],
+        poll_interval=app.config['MEDIA_POLL_INTERVAL'],
+        max_attempts=app.config['MEDIA_MAX_ATTEMPTS']
+    )
+    atexit.register(media_processor.stop)
+
+# بستن تمیز اتصال‌ها هنگام خاموش شدن worker
+atexit.register(db.close)
+atexit.register(hub.stop)
+
+# آرشیو و حذف داده‌های قدیمی در دسته‌های کوچک
+retention = Retention(
+    db, app.config['RETENTION_ARCHIVE_DIR'],
+    message_days=app.config['RETENTION_MESSAGE_DAYS'],
+    inactive_user_days=app.config['RETENTION_INACTIVE_USER_DAYS'],
+    empty_session_hours=app.config['RETENTION_EMPTY_SESSION_HOURS'],
+    compression=app.config['RETENTION_COMPRESSION'],
+    batch_size=app.config['RETENTION_BATCH_SIZE'],
+    batch_pause=app.config['RETENTION_BATCH_PAUSE'],
+    vacuum_pages=app.config['RETENTION_VACUUM_PAGES']
+)
+if app.config['RETENTION_SCHEDULED']:
+    retention.start(app.config['RETENTION_INTERVAL'])
+    atexit.register(retention.stop)
+
+response_cache = None
+if app.config['AI_CACHE_ENABLED']:
+    response_cache = ResponseCache(
+        max_entries=app.config['AI_CACHE_MAX_ENTRIES'],
+        max_bytes=app.config['AI_CACHE_MAX_BYTES'],
+        ttl=app.config['AI_CACHE_TTL'],
+        db_path=app.config['AI_CACHE_DB'],
+        disk_max_entries=app.config['AI_CACHE_DISK_MAX_ENTRIES'],
+        disk_max_bytes=app.config['AI_CACHE_DISK_MAX_BYTES']
+    )
+    atexit.register(response_cache.close)
 
 ai_service = AIService(
     api_key=app.config['OPENAI_API_KEY'],
     api_url=app.config['OPENAI_API_URL'],
-    model=app.config['OPENAI_MODEL']
+    model=app.config['OPENAI_MODEL'],
+    pool_size=app.config['AI_POOL_SIZE'],
+    max_retries=app.config['AI_MAX_RETRIES'],
+    backoff_base=app.config['AI_BACKOFF_BASE'],
+    backoff_max=app.config['AI_BACKOFF_MAX'],
+    breaker_threshold=app.config['AI_BREAKER_THRESHOLD'],
+    breaker_reset=app.config['AI_BREAKER_RESET'],
+    rate_limit=app.config['AI_RATE_LIMIT'] or None,
+    rate_burst=app.config['AI_RATE_BURST'],
+    cache=response_cache,
+    rules_path=app.config['AI_RULES_PATH']
+)
+
+context_builder = ContextBuilder(
+    db,
+    max_tokens=app.config['AI_CONTEXT_MAX_TOKENS'],
+    max_turns=app.config['AI_CONTEXT_MAX_TURNS'],
+    summarize=ai_service.summarize if app.config['AI_CONTEXT_SUMMARY'] else None,
+    summary_min_turns=app.config['AI_CONTEXT_SUMMARY_MIN_TURNS']
+)
+
+ai_queue = AIReplyQueue(
+    ai_service, db, hub, context_builder,
+    workers=app.config['AI_WORKERS'],
+    max_queue=app.config['AI_QUEUE_SIZE'],
+    deadline=app.config['AI_DEADLINE']
+)
+atexit.register(ai_queue.stop)
+
+broadcaster = Broadcaster(
+    db, hub,
+    chunk_size=app.config['BROADCAST_CHUNK_SIZE'],
+    pause=app.config['BROADCAST_PAUSE'],
+    stale_after=app.config['BROADCAST_STALE_AFTER'],
+    check_interval=app.config['BROADCAST_RESUME_INTERVAL']
 )
+atexit.register(broadcaster.stop)
+
+admission = None
+if app.config['ADMISSION_ENABLED']:
+    admission = Admission(
+        db_path=app.config['ADMISSION_DB'],
+        limits=app.config['ADMISSION_LIMITS'],
+        ip_factor=app.config['ADMISSION_IP_FACTOR'],
+        ai_max_in_flight=app.config['ADMISSION_AI_MAX_IN_FLIGHT'],
+        ai_slot_ttl=app.config['ADMISSION_AI_SLOT_TTL'],
+        max_in_flight=app.config['ADMISSION_MAX_IN_FLIGHT']
+    )
+    atexit.register(admission.close)
+
+# دسته هر endpoint برای کنترل ورود؛ مسیرهای ادمین اینجا نیستند و همیشه پاسخ می‌گیرند
+ADMISSION_ENDPOINTS = {
+    'index': 'page',
+    'api_get_messages': 'poll',
+    'stream_messages': 'stream',
+    'send_message': 'send',
+    'send_message_stream': 'ai',
+}
+
+# آماری که جای دیگری نگه داشته می‌شود، هنگام scrape خوانده می‌شود
+Callback('ai_queue_depth', 'Async AI replies waiting for a worker', ai_queue.depth)
+if admission is not None:
+    Callback('ai_calls_in_flight', 'Synchronous AI calls in progress across all workers',
+             admission.ai_in_flight)
+if response_cache is not None:
+    Callback('ai_cache_lookups_total', 'AI response cache lookups by result',
+             lambda: {(result,): response_cache.stats()[key] for result, key in (('hit', 'hits'), ('miss', 'misses'))},
+             kind='counter', labelnames=('result',))
+    Callback('ai_cache_hit_ratio', 'AI response cache hit ratio since start',
+             lambda: response_cache.stats()['hit_ratio'])
 
 # Helper functions
+def busy_response(retry_after, status_code=503,
+                  message='سرور شلوغ است، لطفاً چند لحظه دیگر دوباره تلاش کنید.'):
+    """پاسخ سریع 503/429 با Retry-After - قبل از هر کار سنگینی"""
+    response = jsonify({'status': 'busy', 'message': message})
+    response.status_code = status_code
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def ai_busy_response():
+    """پاسخ 503 وقتی صف هوش مصنوعی پر است"""
+    return busy_response(ai_queue.retry_after())
+
+def client_ip():
+    """IP کاربر؛ پشت proxy آدرسی که proxy مورد اعتماد در X-Forwarded-For گذاشته"""
+    hops = app.config['ADMISSION_PROXY_HOPS']
+    route = request.access_route
+    if hops and len(route) >= hops:
+        return route[-hops]
+    return request.remote_addr
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
 
-def process_latex(text):
-    import re
-    if not text:
-        return text
+def save_upload(file):
+    """ذخیره فایل آپلودی در انبار محتوا-محور؛ مسیر نسبی یا None"""
+    if not (file and file.filename and allowed_file(file.filename)):
+        return None
+    file_path = blob_store.save(file, file.filename.rsplit('.', 1)[1].lower())
+    # تصویر کوچک و مشخصات در پس‌زمینه ساخته می‌شود
+    if media_processor is not None:
+        media_processor.enqueue(file_path)
+    return file_path
+
+def present_message(msg):
+    """آماده‌سازی پیام برای کلاینت"""
+    # LaTeX هنگام ذخیره پردازش شده (content_html)
+    content_html = msg.pop('content_html')
+    if content_html is not None:
+        msg['content'] = content_html
+    # کلاینت اول پیش‌نمایش را بارگیری می‌کند
+    thumbnail_path = msg.pop('thumbnail_path')
+    msg['thumbnail_url'] = f'/uploads/{thumbnail_path}' if thumbnail_path else None
+    return msg
+
+@app.before_request
+def start_request_metrics():
+    if not app.config['METRICS_ENABLED']:
+        return
+    g.request_started = time.perf_counter()
+    HTTP_IN_FLIGHT.inc()
+    if app.config['METRICS_SLOW_REQUEST_MS'] is not None:
+        start_trace()
+
+@app.before_request
+def start_background_workers():
+    # فقط در پروسه سرور، نه در دستورهای CLI
+    # ارسال‌های همگانی و کارهای رسانه که worker قبلی وسط کار رها کرده
+    broadcaster.ensure_watcher()
+    if media_processor is not None:
+        media_processor.start()
+
+@app.before_request
+def admit_request():
+    """کنترل ورود برای endpoint های کاربران؛ درخواست اضافه قبل از دیتابیس رد می‌شود"""
+    if admission is None:
+        return
+    kind = ADMISSION_ENDPOINTS.get(request.endpoint)
+    if kind is None:
+        return
+    # پنل ادمین؛ بدون رمز درست خود endpoint فوراً پاسخ خالی/403 می‌دهد
+    if kind in ('poll', 'stream') and request.args.get('chat_type') == 'admin':
+        return
+    if kind == 'send' and request.form.get('chat_type', 'ai') == 'ai':
+        kind = 'ai'
     
-    def replace_latex_inline(match):
-        latex_code = match.group(1)
-        return f'<span class="latex">{latex_code}</span>'
+    retry_after = admission.take(kind, session.get('session_id'), client_ip())
+    if retry_after:
+        ADMISSION_REJECTED.inc(kind=kind, reason='rate_limited')
+        return busy_response(retry_after, 429, 'درخواست‌های شما زیاد است، لطفاً کمی صبر کنید.')
     
-    def replace_latex_block(match):
-        latex_code = match.group(1)
-        return f'<div class="latex-block">{latex_code}</div>'
+    # اتصال SSE طولانی است و در سقف همزمانی حساب نمی‌شود
+    if kind == 'stream':
+        return
+    if not admission.enter():
+        ADMISSION_REJECTED.inc(kind=kind, reason='overloaded')
+        return busy_response(1)
+    g.admission_release = [admission.leave]
     
-    text = re.sub(r'\$\$(.+?)\$\$', replace_latex_block, text, flags=re.DOTALL)
-    text = re.sub(r'\$(.+?)\$', replace_latex_inline, text)
+    # حالت غیرهمزمان سقف صف خودش را دارد
+    if kind == 'ai' and not (request.endpoint == 'send_message' and app.config['AI_ASYNC_MODE']):
+        token = admission.acquire_ai()
+        if token is None:
+            ADMISSION_REJECTED.inc(kind=kind, reason='ai_saturated')
+            return busy_response(app.config['ADMISSION_AI_RETRY_AFTER'])
+        g.admission_release.append(lambda: admission.release_ai(token))
+
+@app.after_request
+def release_admission_on_close(response):
+    # بعد از ارسال کامل پاسخ، برای پاسخ‌های تدریجی هم
+    callbacks = g.pop('admission_release', None)
+    if callbacks:
+        response.call_on_close(lambda: [callback() for callback in callbacks])
+    return response
+
+@app.teardown_request
+def release_admission(error=None):
+    # اگر after_request اجرا نشده باشد
+    for callback in g.pop('admission_release', None) or ():
+        callback()
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    HTTP_IN_FLIGHT.dec()
+    elapsed = time.perf_counter() - started
+    # الگوی route نه خود URL، تا تعداد سری‌ها محدود بماند
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    status = g.pop('response_status', 500)
+    HTTP_REQUEST_SECONDS.observe(elapsed, method=request.method, route=route, status=status)
     
-    return text
+    threshold = app.config['METRICS_SLOW_REQUEST_MS']
+    if threshold is None:
+        return
+    events = end_trace()
+    if elapsed * 1000 >= threshold:
+        # برای SSE فقط زمان تا شروع پاسخ است، نه کل مدت اتصال
+        app.logger.warning('Slow request: %s', json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'route': route,
+            'status': status,
+            'ms': round(elapsed * 1000, 1),
+            'events': events or []
+        }, ensure_ascii=False))
+
+@app.route('/metrics')
+def metrics():
+    """آمار عملکرد این worker در قالب Prometheus"""
+    token = app.config['METRICS_TOKEN']
+    authorized = request.args.get('password', '') == 'admin123' or (
+        token and request.headers.get('Authorization', '') == f'Bearer {token}'
+    )
+    if not authorized:
+        return jsonify({'status': 'error', 'message': 'دسترسی غیرمجاز'}), 403
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.url_defaults
+def static_version(endpoint, values):
+    """url_for('static', ...) با ?v=<هش محتوا> تا فایل با خیال راحت immutable کش شود"""
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        version = static_server.version(values['filename'])
+        if version:
+            values['v'] = version
+
+def serve_static(filename):
+    # فقط URL با نسخه فعلی immutable است؛ نسخه قدیمی یا بدون نسخه اعتبارسنجی می‌شود
+    version = request.args.get('v')
+    return static_server.send(filename, immutable=bool(version) and version == static_server.version(filename))
+
+app.view_functions['static'] = serve_static
 
 # Routes
 @app.route('/')
@@ -75,26 +387,33 @@ def send_message():
         message_type = data.get('message_type', 'text')
         content = data.get('content', '')
         chat_type = data.get('chat_type', 'ai')
+        async_reply = chat_type == 'ai' and app.config['AI_ASYNC_MODE']
+        
+        # صف پر است - قبل از ذخیره چیزی رد کن تا پیام تکراری نشود
+        if async_reply and ai_queue.is_full():
+            return ai_busy_response()
+        
+        file_path = save_upload(request.files.get('file'))
         
-        file_path = None
-        if 'file' in request.files:
-            file = request.files['file']
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                folder = 'users'
-                filepath = os.path.join(
-                    folder,
-                    f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
-                )
-                full_path = os.path.join(app.config['UPLOAD_FOLDER'], filepath)
-                file.save(full_path)
-                file_path = filepath
+        message_id = db.save_message(user_id, 'user', message_type, content, file_path)
+        hub.publish(user_id, message_id)
         
-        db.save_message(user_id, 'user', message_type, content, file_path)
+        if async_reply:
+            try:
+                ai_queue.submit(user_id, content, message_id)
+            except AIQueueFull:
+                return ai_busy_response()
+            return jsonify({
+                'status': 'queued',
+                'message_id': message_id,
+                'user_id': user_id
+            }), 202
         
         if chat_type == 'ai':
-            ai_reply = ai_service.get_response(content)
-            db.save_message(user_id, 'ai', 'text', ai_reply)
+            history = context_builder.build(user_id, before_id=message_id)
+            ai_reply = ai_service.get_response(content, history=history)
+            reply_id = db.save_message(user_id, 'ai', 'text', ai_reply)
+            hub.publish(user_id, reply_id)
             return jsonify({
                 'status': 'success',
                 'ai_response': ai_reply,
@@ -106,19 +425,76 @@ def send_message():
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.route('/api/send_message_stream', methods=['POST'])
+def send_message_stream():
+    """ارسال پیام متنی و دریافت تدریجی پاسخ هوش مصنوعی (هر خط یک JSON)"""
+    session_id = session.get('session_id')
+    if not session_id:
+        return jsonify({'status': 'error', 'message': 'Session not found'})
+    
+    user_id = db.get_or_create_user(session_id)
+    content = request.form.get('content', '')
+    
+    message_id = db.save_message(user_id, 'user', 'text', content)
+    hub.publish(user_id, message_id)
+    
+    def save_reply(text):
+        reply_id = db.save_message(user_id, 'ai', 'text', text)
+        hub.publish(user_id, reply_id)
+        return reply_id
+    
+    def generate():
+        history = context_builder.build(user_id, before_id=message_id)
+        events = ai_service.stream_response(content, history=history)
+        final_text = ''
+        try:
+            for kind, text in events:
+                if kind == 'delta':
+                    yield json.dumps({'delta': text}, ensure_ascii=False) + '\n'
+                else:
+                    final_text = text
+        except GeneratorExit:
+            # کاربر قطع شد؛ پاسخ را کامل بگیر تا در تاریخچه ذخیره شود
+            for kind, text in events:
+                if kind == 'done':
+                    final_text = text
+            save_reply(final_text)
+            raise
+        
+        reply_id = save_reply(final_text)
+        yield json.dumps({
+            'done': True,
+            'message_id': reply_id,
+            'content': process_latex(final_text)
+        }, ensure_ascii=False) + '\n'
+    
+    return Response(generate(), mimetype='application/x-ndjson', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 # ========== بخش اصلاح شده برای رفع مشکل امنیتی ==========
 @app.route('/api/get_messages')
 def api_get_messages():
     chat_type = request.args.get('chat_type', 'ai')
     session_id = session.get('session_id')
     
+    # حالت افزایشی - فقط پیام‌های جدیدتر از since_id (after_id هم همین است)
+    since_id = request.args.get('since_id', '') or request.args.get('after_id', '')
+    since_id = int(since_id) if since_id.isdigit() else None
+    # صفحه‌های قدیمی‌تر برای اسکرول به بالا
+    before_id = request.args.get('before_id', '')
+    before_id = int(before_id) if before_id.isdigit() else None
+    limit = request.args.get('limit', '')
+    limit = min(int(limit), 200) if limit.isdigit() and int(limit) > 0 else 50
+    
     # کاربر عادی - فقط پیام‌های خودش
     if chat_type == 'ai':
         if not session_id:
             return jsonify({'messages': []})
         
         user_id = db.get_or_create_user(session_id)
-        messages = db.get_messages(user_id, 50)
+        page = db.get_message_page(user_id, limit, before_id=before_id, after_id=since_id)
     
     # ادمین - با پسورد چک میشه
     elif chat_type == 'admin':
@@ -128,9 +504,11 @@ def api_get_messages():
         
         user_id = request.args.get('user_id')
         if user_id and user_id.isdigit():
-            messages = db.get_messages(int(user_id), 50)
+            page = db.get_message_page(int(user_id), limit, before_id=before_id, after_id=since_id)
+            if page['messages'] and before_id is None:
+                db.mark_read_by_admin(int(user_id))
         else:
-            messages = db.get_messages(limit=50)
+            page = db.get_message_page(limit=limit, before_id=before_id, after_id=since_id)
     
     # حالت پیش‌فرض - امن
     else:
@@ -138,16 +516,76 @@ def api_get_messages():
             return jsonify({'messages': []})
         
         user_id = db.get_or_create_user(session_id)
-        messages = db.get_messages(user_id, 50)
+        page = db.get_message_page(user_id, limit, before_id=before_id, after_id=since_id)
+    
+    messages = page['messages']
+    
+    # چیز جدیدی نیست - پاسخ خالی
+    if since_id is not None and before_id is None and not messages:
+        return '', 304
     
-    # پردازش LaTeX
     for msg in messages:
-        if msg['message_type'] == 'text' and msg['content']:
-            msg['content'] = process_latex(msg['content'])
+        present_message(msg)
     
-    return jsonify({'messages': messages})
+    ids = [msg['id'] for msg in messages]
+    return jsonify({
+        'messages': messages,
+        'last_id': max(ids + [since_id or 0]),
+        'first_id': min(ids) if ids else None,
+        # بعد از before_id: پیام قدیمی‌تر هست؟ بعد از since_id: صفحه بعدی هست؟
+        'has_more': page['has_more']
+    })
 # ========== پایان بخش اصلاح شده ==========
 
+@app.route('/api/stream_messages')
+def stream_messages():
+    """ارسال پیام‌های جدید با Server-Sent Events به جای polling"""
+    chat_type = request.args.get('chat_type', 'ai')
+    session_id = session.get('session_id')
+    
+    if chat_type == 'admin':
+        password = request.args.get('password', '')
+        if password != 'admin123':
+            return jsonify({'status': 'error', 'message': 'دسترسی غیرمجاز'}), 403
+        user_id = request.args.get('user_id')
+        user_id = int(user_id) if user_id and user_id.isdigit() else None
+    else:
+        if not session_id:
+            return jsonify({'status': 'error', 'message': 'Session not found'}), 400
+        user_id = db.get_or_create_user(session_id)
+    
+    # Last-Event-ID را مرورگر هنگام اتصال مجدد خودکار می‌فرستد
+    since_id = request.headers.get('Last-Event-ID') or request.args.get('since_id', '')
+    since_id = int(since_id) if since_id.isdigit() else db.get_latest_message_id()
+    
+    max_duration = app.config['SSE_MAX_DURATION']
+    heartbeat = app.config['SSE_HEARTBEAT']
+    
+    def generate(last_id):
+        deadline = time.monotonic() + max_duration
+        yield 'retry: 2000\n\n'
+        while time.monotonic() < deadline:
+            messages = db.get_messages(user_id, 50, since_id=last_id)
+            if messages:
+                for msg in messages:
+                    present_message(msg)
+                last_id = max(msg['id'] for msg in messages)
+                # ادمین این گفتگو را باز کرده؛ مثل polling خوانده شده حساب شود
+                if chat_type == 'admin' and user_id is not None:
+                    db.mark_read_by_admin(user_id)
+                payload = json.dumps({'messages': messages, 'last_id': last_id})
+                yield f'id: {last_id}\nevent: messages\ndata: {payload}\n\n'
+                continue
+            
+            remaining = deadline - time.monotonic()
+            if not hub.wait(user_id, last_id, timeout=min(heartbeat, max(remaining, 0))):
+                yield ': ping\n\n'
+    
+    return Response(generate(since_id), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/api/get_users')
 def get_users_api():
     # فقط ادمین می‌تونه ببینه
@@ -155,8 +593,15 @@ def get_users_api():
     if password != 'admin123':
         return jsonify({'users': []})
     
-    users = db.get_all_users()
-    return jsonify({'users': users})
+    # صفحه‌بندی و مرتب‌سازی بر اساس فعالیت
+    limit = request.args.get('limit', '')
+    offset = request.args.get('offset', '')
+    sort = request.args.get('sort', 'activity')
+    limit = min(int(limit), 500) if limit.isdigit() else None
+    offset = int(offset) if offset.isdigit() else 0
+    
+    users = db.get_all_users(limit=limit, offset=offset, sort=sort)
+    return jsonify({'users': users, 'total': db.count_users()})
 
 @app.route('/api/admin/send', methods=['POST'])
 def admin_send():
@@ -174,28 +619,204 @@ def admin_send():
         if not user_id:
             return jsonify({'status': 'error', 'message': 'کاربر انتخاب نشده'})
         
-        file_path = None
-        if 'file' in request.files:
-            file = request.files['file']
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(
-                    'admin',
-                    f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{filename}"
-                )
-                full_path = os.path.join(app.config['UPLOAD_FOLDER'], filepath)
-                file.save(full_path)
-                file_path = filepath
+        file_path = save_upload(request.files.get('file'))
         
-        db.save_message(int(user_id), 'admin', message_type, content, file_path)
+        message_id = db.save_message(int(user_id), 'admin', message_type, content, file_path)
+        hub.publish(int(user_id), message_id)
         return jsonify({'status': 'success'})
     
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)})
 
+@app.route('/api/admin/broadcast', methods=['POST'])
+def admin_broadcast():
+    """ارسال یک پیام به همه کاربران، کاربران فعال از یک زمان، یا لیست id ها"""
+    password = request.form.get('password', '')
+    if password != 'admin123':
+        return jsonify({'status': 'error', 'message': 'دسترسی غیرمجاز'}), 403
+    
+    data = request.form
+    target_type = data.get('target', 'all')
+    message_type = data.get('message_type', 'text')
+    content = data.get('content', '')
+    
+    if target_type == 'all':
+        target = {'type': 'all'}
+    elif target_type == 'active':
+        try:
+            since = datetime.fromisoformat(data.get('since', '').replace('Z', '+00:00'))
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'زمان نامعتبر است'}), 400
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        # هم‌قالب CURRENT_TIMESTAMP (UTC)
+        target = {'type': 'active', 'since': since.strftime('%Y-%m-%d %H:%M:%S')}
+    elif target_type == 'ids':
+        ids = sorted({int(i) for i in data.get('user_ids', '').replace(',', ' ').split() if i.isdigit()})
+        if not ids or len(ids) > app.config['BROADCAST_MAX_IDS']:
+            return jsonify({'status': 'error', 'message': 'لیست کاربران نامعتبر است'}), 400
+        target = {'type': 'ids', 'ids': ids}
+    else:
+        return jsonify({'status': 'error', 'message': 'گیرنده نامعتبر است'}), 400
+    
+    # فایل یک بار ذخیره می‌شود و همه پیام‌ها به همان blob ارجاع می‌دهند
+    file_path = save_upload(request.files.get('file'))
+    if not content and not file_path:
+        return jsonify({'status': 'error', 'message': 'پیام خالی است'}), 400
+    
+    job = broadcaster.start(target, message_type, content, file_path)
+    return jsonify({'status': 'success', 'job_id': job['id'], 'total': job['total']})
+
+@app.route('/api/admin/broadcasts')
+def admin_broadcasts():
+    """وضعیت و پیشرفت ارسال‌های همگانی (job_id برای یک مورد)"""
+    password = request.args.get('password', '')
+    if password != 'admin123':
+        return jsonify({'status': 'error', 'message': 'دسترسی غیرمجاز'}), 403
+    
+    job_id = request.args.get('job_id', '')
+    jobs = db.get_broadcasts(limit=20, job_id=int(job_id) if job_id.isdigit() else None)
+    return jsonify({'status': 'success', 'broadcasts': jobs})
+
+@app.route('/api/admin/broadcast/cancel', methods=['POST'])
+def admin_broadcast_cancel():
+    password = request.form.get('password', '')
+    if password != 'admin123':
+        return jsonify({'status': 'error', 'message': 'دسترسی غیرمجاز'}), 403
+    
+    job_id = request.form.get('job_id', '')
+    if not job_id.isdigit():
+        return jsonify({'status': 'error', 'message': 'شناسه نامعتبر است'}), 400
+    return jsonify({'status': 'success', 'cancelled': db.cancel_broadcast(int(job_id))})
+
+@app.route('/api/admin/cache')
+def admin_cache():
+    """وضعیت کش پاسخ‌های هوش مصنوعی"""
+    password = request.args.get('password', '')
+    if password != 'admin123':
+        return jsonify({'status': 'error', 'message': 'دسترسی غیرمجاز'}), 403
+    
+    if response_cache is None:
+        return jsonify({'status': 'disabled'})
+    
+    limit = request.args.get('limit', '')
+    limit = min(int(limit), 500) if limit.isdigit() else 50
+    return jsonify({
+        'status': 'success',
+        'stats': response_cache.stats(),
+        'entries': response_cache.entries(limit)
+    })
+
+@app.route('/api/admin/cache/purge', methods=['POST'])
+def admin_cache_purge():
+    """پاک کردن یک کلید (key) یا کل کش"""
+    password = request.form.get('password', '')
+    if password != 'admin123':
+        return jsonify({'status': 'error', 'message': 'دسترسی غیرمجاز'}), 403
+    
+    if response_cache is None:
+        return jsonify({'status': 'disabled'})
+    
+    removed = response_cache.purge(request.form.get('key') or None)
+    return jsonify({'status': 'success', 'removed': removed})
+
+@app.route('/api/admin/rules/reload', methods=['POST'])
+def admin_rules_reload():
+    """بارگذاری فوری فایل قوانین (worker های دیگر با تغییر فایل خودشان به‌روز می‌شوند)"""
+    password = request.form.get('password', '')
+    if password != 'admin123':
+        return jsonify({'status': 'error', 'message': 'دسترسی غیرمجاز'}), 403
+    
+    try:
+        rules = ai_service.reload_rules()
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        print(f"Rule reload error: {e}")
+        return jsonify({'status': 'error', 'message': 'فایل قوانین نامعتبر است'}), 400
+    
+    return jsonify({
+        'status': 'success',
+        'local_responses': len(rules.local_responses),
+        'fallback_rules': len(rules.fallback_rules)
+    })
+
+@app.route('/api/admin/search')
+def admin_search():
+    """جستجوی متن کامل در پیام‌ها (رتبه‌بندی شده، با برجسته‌سازی)"""
+    password = request.args.get('password', '')
+    if password != 'admin123':
+        return jsonify({'status': 'error', 'message': 'دسترسی غیرمجاز'}), 403
+    
+    query = request.args.get('q', '').strip()
+    user_id = request.args.get('user_id', '')
+    limit = request.args.get('limit', '')
+    offset = request.args.get('offset', '')
+    limit = min(int(limit), 50) if limit.isdigit() else 20
+    offset = int(offset) if offset.isdigit() else 0
+    
+    page = db.search_messages(
+        query, user_id=int(user_id) if user_id.isdigit() else None, limit=limit, offset=offset
+    )
+    for hit in page['results']:
+        hit['snippet'] = highlight_snippet(hit['snippet'])
+    return jsonify({
+        'status': 'success',
+        'results': page['results'],
+        'has_more': page['has_more'],
+        'next_offset': offset + len(page['results'])
+    })
+
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return upload_server.send(filename)
+
+@app.cli.command('gc-uploads')
+@click.option('--grace', type=int, default=None, help='حداقل سن blob (ثانیه) برای حذف')
+@click.option('--dry-run', is_flag=True, help='فقط نمایش، بدون حذف')
+def gc_uploads(grace, dry_run):
+    """حذف blob هایی که هیچ پیامی به آن‌ها ارجاع نمی‌دهد"""
+    referenced = db.get_referenced_files(BLOB_PREFIX)
+    removed, freed = blob_store.collect_garbage(
+        # پیامی که بعد از خواندن لیست ثبت شده هم حساب شود
+        lambda path: path in referenced or db.count_file_references(path) > 0,
+        grace=app.config['UPLOAD_GC_GRACE'] if grace is None else grace,
+        dry_run=dry_run
+    )
+    if removed and not dry_run:
+        # پیش‌نمایش‌های blob های حذف شده هم پاک می‌شوند
+        for thumbnail in db.delete_media(removed):
+            try:
+                os.remove(blob_store.full_path(thumbnail))
+            except FileNotFoundError:
+                pass
+    for path in removed:
+        click.echo(path)
+    action = 'would free' if dry_run else 'freed'
+    click.echo(f'{len(removed)} orphaned blobs, {action} {freed} bytes')
+
+@app.cli.command('reindex-search')
+def reindex_search():
+    """ساخت دوباره ایندکس جستجو (مثلاً بعد از تغییر text_normalize)"""
+    click.echo(f'{db.rebuild_search_index()} messages indexed')
+
+@app.cli.command('retention')
+@click.option('--dry-run', is_flag=True, help='فقط شمارش، بدون تغییر')
+@click.option('--full-vacuum', is_flag=True, help='فعال کردن auto_vacuum و VACUUM کامل (یک بار، قفل طولانی)')
+def run_retention(dry_run, full_vacuum):
+    """آرشیو پیام‌ها و کاربران قدیمی، حذف session های خالی و کوچک کردن فایل دیتابیس"""
+    if dry_run:
+        for name, count in retention.preview().items():
+            click.echo(f'{name}: {count}')
+        return
+    
+    stats = retention.run()
+    if stats is None:
+        click.echo('retention is already running in another process')
+        return
+    for name, count in stats.items():
+        click.echo(f'{name}: {count}')
+    if full_vacuum:
+        retention.full_vacuum()
+        click.echo('database vacuumed')
 
 if __name__ == '__main__':
     app.secret_key = 'super-secret-key-change-in-production'
@@ -0,0 +1,96 @@
+"""Compare the old per-keyword substring loop with the compiled rule matcher.
+
+Usage:
+    python benchmarks/bench_keywords.py --keywords 10 1000 5000 --texts 2000
+
+For each rule-set size a synthetic rule table is built (the shipped rules
+plus random filler keywords) and the same batch of messages is matched with
+``any(key in text ...)`` in rule order and with ``RuleSet.local_response``.
+"""
+import argparse
+import json
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from keyword_rules import RuleSet  # noqa: E402
+
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rules', 'ai_rules.json')
+ALPHABET = 'ابپتثجچحخدذرزژسشصضطظعغفقکگلمنوهی' + string.ascii_lowercase
+
+
+def random_word(rng, low=3, high=9):
+    return ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(low, high)))
+
+
+def build_rules(base, count, rng):
+    data = dict(base)
+    rules = list(base['local_responses'])
+    while len(rules) < count:
+        rules.append({'keywords': [random_word(rng)], 'response': 'filler'})
+    data['local_responses'] = rules[:count]
+    return data
+
+
+def build_texts(rules, count, rng):
+    texts = []
+    for _ in range(count):
+        words = [random_word(rng) for _ in range(rng.randint(5, 40))]
+        if rng.random() < 0.3:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(rules)['keywords'][0])
+        texts.append(' '.join(words))
+    return texts
+
+
+def naive_match(rules, text):
+    text = text.lower()
+    for rule in rules:
+        for keyword in rule['keywords']:
+            if keyword in text:
+                return rule['response']
+    return None
+
+
+def timed(fn, texts):
+    start = time.perf_counter()
+    results = [fn(text) for text in texts]
+    return (time.perf_counter() - start) / len(texts) * 1e6, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keywords', type=int, nargs='+', default=[10, 1000, 5000])
+    parser.add_argument('--texts', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    with open(RULES_PATH, encoding='utf-8') as f:
+        base = json.load(f)
+
+    print(f'{"keywords":>9} {"build ms":>9} {"loop us/msg":>12} {"matcher us/msg":>15} {"speedup":>8}')
+    for count in args.keywords:
+        rng = random.Random(args.seed)
+        data = build_rules(base, count, rng)
+        texts = build_texts(data['local_responses'], args.texts, rng)
+
+        start = time.perf_counter()
+        rules = RuleSet(data)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        # {time} is rendered by RuleSet only, so compare rule identity via templates
+        loop_us, expected = timed(lambda text: naive_match(rules.local_responses, text), texts)
+        matcher_us, _ = timed(rules.local_response, texts)
+        matched = [rules._local.first_rule(text.lower()) for text in texts]
+        actual = [None if i is None else rules.local_responses[i]['response'] for i in matched]
+        if actual != expected:
+            sys.exit(f'Mismatch between loop and matcher at {count} keywords')
+
+        print(f'{count:>9} {build_ms:>9.1f} {loop_us:>12.1f} {matcher_us:>15.1f} {loop_us / matcher_us:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
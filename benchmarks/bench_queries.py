@@ -0,0 +1,138 @@
+"""Time the hot Database queries on a large synthetic chat database.
+
+Usage:
+    python benchmarks/bench_queries.py --messages 1000000 --users 20000
+
+The database is generated once into --path (reused on later runs) and each
+query is timed with the migration indexes in place and again with them
+dropped, so the effect of a schema change is visible side by side.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import Database  # noqa: E402
+from markup import render_message  # noqa: E402
+from migrations import MIGRATIONS  # noqa: E402
+
+CONTENT = 'سلام، این یک پیام آزمایشی است $x^2$'
+
+
+def generate(path, users, messages, batch=50000):
+    db = Database(path)
+    with db.connection() as conn:
+        existing = conn.execute('SELECT COUNT(*) FROM messages').fetchone()[0]
+        if existing < messages:
+            print(f'Generating {users} users / {messages} messages into {path} ...')
+            conn.executemany(
+                'INSERT OR IGNORE INTO users (session_id, username, ip_address) VALUES (?, ?, ?)',
+                ((f'bench-{i}', f'کاربر-{i}', f'10.0.{i // 256 % 256}.{i % 256}') for i in range(users))
+            )
+            conn.commit()
+
+            rng = random.Random(42)
+            senders = ('user', 'ai', 'admin')
+            remaining = messages - existing
+            while remaining > 0:
+                n = min(batch, remaining)
+                conn.executemany(
+                    'INSERT INTO messages (user_id, sender, message_type, content, content_html, timestamp) '
+                    "VALUES (?, ?, ?, ?, ?, datetime(?, 'unixepoch'))",
+                    ((rng.randint(1, users), rng.choice(senders), 'text', CONTENT,
+                      render_message('text', CONTENT), 1_600_000_000 + rng.randint(0, 10 ** 8))
+                     for _ in range(n))
+                )
+                conn.commit()
+                remaining -= n
+        unindexed = conn.execute('SELECT NOT EXISTS (SELECT 1 FROM messages_fts)').fetchone()[0]
+
+    # The bulk inserts above bypass Database._insert_message, so messages_fts
+    # is filled afterwards, the same way 'flask reindex-search' does it
+    if existing < messages or unindexed:
+        print('Building the search index ...')
+        db.rebuild_search_index()
+    return db
+
+
+def timeit(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), max(samples)
+
+
+def run_suite(db, users, messages, repeat):
+    rng = random.Random(7)
+    cases = {
+        'get_messages(user_id)': lambda: db.get_messages(rng.randint(1, users), 50),
+        'get_messages(since_id)': lambda: db.get_messages(rng.randint(1, users), 50, since_id=10 ** 9),
+        'get_message_page(before_id)': lambda: db.get_message_page(
+            rng.randint(1, users), 50, before_id=rng.randint(1, messages)),
+        'get_message_page(all users, before_id)': lambda: db.get_message_page(
+            limit=50, before_id=rng.randint(1, messages)),
+        'get_all_users()': db.get_all_users,
+        'get_user_by_ip()': lambda: db.get_user_by_ip('10.0.3.7'),
+        'search_messages(all users)': lambda: db.search_messages('آزمایشی'),
+        'search_messages(user_id)': lambda: db.search_messages('آزمایشی', rng.randint(1, users)),
+    }
+    # these rank or scan every row; keep their repeat low
+    slow = ('get_all_users()', 'search_messages(all users)', 'search_messages(user_id)')
+    results = {}
+    for name, fn in cases.items():
+        n = 3 if name in slow else repeat
+        results[name] = timeit(fn, n)
+    return results
+
+
+def drop_indexes(db):
+    with db.connection() as conn:
+        indexes = conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx_%'"
+        ).fetchall()
+        for name, _ in indexes:
+            conn.execute(f'DROP INDEX {name}')
+        conn.commit()
+    return indexes
+
+
+def restore_indexes(db, indexes):
+    with db.connection() as conn:
+        for _, sql in indexes:
+            conn.execute(sql)
+        conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', default='data/bench_queries.db')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(args.path) or '.', exist_ok=True)
+    db = generate(args.path, args.users, args.messages)
+
+    indexed = run_suite(db, args.users, args.messages, args.repeat)
+    dropped = drop_indexes(db)
+    plain = run_suite(db, args.users, args.messages, args.repeat)
+    restore_indexes(db, dropped)
+    db.close()
+
+    names = ', '.join(name for name, _ in dropped) or '-'
+    print(f'schema version {MIGRATIONS[-1][0]}, dropped for baseline: {names}')
+    print(f'{"query":<40}{"indexed p50/max ms":>22}{"no index p50/max ms":>24}')
+    for name in indexed:
+        a, b = indexed[name], plain[name]
+        print(f'{name:<40}{a[0]:>12.3f} /{a[1]:>8.3f}{b[0]:>14.3f} /{b[1]:>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Compare per-message commits with write-behind group commits.
+
+Usage:
+    python benchmarks/bench_writes.py --threads 1 8 32 --messages 5000
+
+For each thread count a fresh database is created and the same number of
+messages is saved with ``Database.save_message`` from concurrent threads,
+once with one commit per message and once through the write-behind writer.
+Every call waits for its commit, so both columns are durable messages/sec.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import Database  # noqa: E402
+
+CONTENT = 'سلام، این یک پیام آزمایشی است $x^2$'
+
+
+def run(directory, threads, messages, synchronous, **options):
+    path = os.path.join(directory, f'writes-{threads}-{int(bool(options))}.db')
+    db = Database(path, synchronous=synchronous, **options)
+    user_ids = [db.get_or_create_user(f'bench-{i}') for i in range(threads)]
+    per_thread = messages // threads
+    errors = []
+
+    def worker(user_id):
+        try:
+            for _ in range(per_thread):
+                db.save_message(user_id, 'user', 'text', CONTENT)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(user_id,)) for user_id in user_ids]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    db.close()
+    if errors:
+        sys.exit(f'{len(errors)} writer errors, first: {errors[0]}')
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--synchronous', default='NORMAL', choices=['NORMAL', 'FULL'])
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--batch-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench-writes-')
+    try:
+        print(f'synchronous={args.synchronous}')
+        print(f'{"threads":>8} {"per-commit msg/s":>17} {"write-behind msg/s":>19} {"speedup":>8}')
+        for threads in args.threads:
+            direct = run(directory, threads, args.messages, args.synchronous)
+            grouped = run(directory, threads, args.messages, args.synchronous,
+                          write_behind=True, write_batch_size=args.batch_size,
+                          write_batch_ms=args.batch_ms)
+            print(f'{threads:>8} {direct:>17.0f} {grouped:>19.0f} {grouped / direct:>7.1f}x')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
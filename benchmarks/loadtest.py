@@ -0,0 +1,356 @@
+"""Drive the full app with concurrent clients against a stub AI backend.
+
+Usage:
+    python benchmarks/loadtest.py --users 20000 --messages 1000000 \\
+        --clients 50 --admins 2 --duration 60 --ai-latency 0.5 --output result.json
+
+A synthetic chat database is generated once into --seed-db (see
+bench_queries.generate) and copied into a scratch directory for every run,
+so runs start from the same state. The app is started in a subprocess
+(werkzeug threaded server, or gunicorn with --gunicorn-workers) with
+OPENAI_API_URL pointing at benchmarks/stub_openai.py, also in a subprocess.
+
+User clients each open a session, then repeatedly send a message and poll
+/api/get_messages with since_id; admin clients list users and send
+messages to random users. The result is one JSON document (throughput and
+p50/p95/p99 per endpoint, errors, "database is locked" failures and the
+server's own counters from /metrics) for diffing between commits.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, '..')
+sys.path.insert(0, ROOT)
+
+PROMPTS = [
+    'سلام، حالت چطوره؟',
+    'معادله x^2 - 5x + 6 = 0 را حل کن',
+    'یک کتاب خوب برای یادگیری پایتون معرفی کن',
+    'فرق TCP و UDP چیست؟',
+    'یک شعر کوتاه درباره پاییز بنویس',
+]
+
+
+# ---------- server side (runs in the subprocess) ----------
+
+def wsgi_app():
+    """Import the app with settings from LOADTEST_* variables (also a gunicorn factory)"""
+    from config import Config
+
+    os.chdir(os.environ['LOADTEST_WORKDIR'])
+    # Relative paths in Config now point into the scratch directory
+    Config.AI_RULES_PATH = os.path.join(ROOT, 'rules', 'ai_rules.json')
+    Config.AI_CACHE_ENABLED = os.environ.get('LOADTEST_CACHE') == '1'
+    Config.MEDIA_ENABLED = False
+    Config.ADMISSION_ENABLED = os.environ.get('LOADTEST_ADMISSION') == '1'
+    # Every simulated client shares 127.0.0.1, so only the per-session buckets apply
+    Config.ADMISSION_IP_FACTOR = 10000
+
+    import app
+    return app.app
+
+
+def serve(port):
+    from werkzeug.serving import make_server
+
+    make_server('127.0.0.1', port, wsgi_app(), threaded=True).serve_forever()
+
+
+# ---------- client side ----------
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.lock_errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, ok, locked=False):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+            if not ok:
+                self.errors[name] = self.errors.get(name, 0) + 1
+            if locked:
+                self.lock_errors += 1
+
+
+def timed_request(recorder, name, call):
+    import requests
+
+    start = time.perf_counter()
+    try:
+        response = call()
+    except requests.RequestException:
+        recorder.record(name, time.perf_counter() - start, False)
+        return None
+    elapsed = time.perf_counter() - start
+
+    body = response.text
+    ok = response.status_code < 400
+    if ok and response.headers.get('Content-Type', '').startswith('application/json'):
+        ok = (response.json() or {}).get('status') != 'error'
+    recorder.record(name, elapsed, ok, locked='database is locked' in body)
+    return response
+
+
+def user_client(base, args, recorder, deadline, rng):
+    import requests
+
+    http = requests.Session()
+    http.get(base + '/')
+    last_id = 0
+    while time.monotonic() < deadline:
+        prompt = f'{rng.choice(PROMPTS)} #{rng.randrange(args.prompt_variety)}'
+        timed_request(recorder, 'send_message', lambda: http.post(
+            base + '/api/send_message', data={'content': prompt, 'message_type': 'text'}
+        ))
+        for _ in range(args.polls):
+            if time.monotonic() >= deadline:
+                return
+            time.sleep(args.poll_interval)
+            response = timed_request(recorder, 'get_messages', lambda: http.get(
+                base + '/api/get_messages', params={'since_id': last_id}
+            ))
+            if response is not None and response.status_code == 200:
+                last_id = response.json().get('last_id') or last_id
+        time.sleep(args.think_time)
+
+
+def admin_client(base, args, recorder, deadline, rng):
+    import requests
+
+    http = requests.Session()
+    while time.monotonic() < deadline:
+        timed_request(recorder, 'get_users', lambda: http.get(
+            base + '/api/get_users', params={'password': 'admin123', 'limit': 50, 'sort': 'activity'}
+        ))
+        timed_request(recorder, 'admin_send', lambda: http.post(base + '/api/admin/send', data={
+            'password': 'admin123', 'user_id': rng.randint(1, args.users),
+            'message_type': 'text', 'content': 'پیام آزمایشی ادمین'
+        }))
+        time.sleep(args.think_time)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    # Nearest rank; round() would send .5 to the even rank and overshoot p95/p99
+    index = min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, errors, elapsed):
+    values = sorted(samples)
+    return {
+        'requests': len(values),
+        'errors': errors,
+        'rps': round(len(values) / elapsed, 2),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 2) if values else None,
+        'p95_ms': round(percentile(values, 0.95) * 1000, 2) if values else None,
+        'p99_ms': round(percentile(values, 0.99) * 1000, 2) if values else None,
+        'max_ms': round(values[-1] * 1000, 2) if values else None,
+    }
+
+
+def scrape_metrics(base):
+    """Totals of the server counters we compare between runs (single worker only)"""
+    import requests
+
+    try:
+        text = requests.get(base + '/metrics', params={'password': 'admin123'}, timeout=10).text
+    except requests.RequestException:
+        return {}
+    totals = {}
+    for line in text.splitlines():
+        if line.startswith('#') or ' ' not in line:
+            continue
+        series, value = line.rsplit(' ', 1)
+        name = series.split('{', 1)[0]
+        if name in ('db_method_errors_total', 'ai_api_calls_rejected_total') or name.endswith(
+                ('db_method_duration_seconds_sum', 'db_method_duration_seconds_count',
+                 'ai_api_call_duration_seconds_count')):
+            totals[series] = totals.get(series, 0) + float(value)
+    return totals
+
+
+def metrics_delta(before, after):
+    delta = {series: round(value - before.get(series, 0), 6) for series, value in after.items()}
+    return {series: value for series, value in sorted(delta.items()) if value}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, process, timeout=60):
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit(f'{url} exited with code {process.returncode}')
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    sys.exit(f'{url} did not start within {timeout}s')
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_servers(args, workdir):
+    stub_port, app_port = free_port(), free_port()
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, 'stub_openai.py'), '--port', str(stub_port),
+        '--latency', str(args.ai_latency), '--jitter', str(args.ai_jitter),
+        '--error-rate', str(args.ai_error_rate)
+    ], stdout=subprocess.DEVNULL)
+
+    env = dict(os.environ,
+               LOADTEST_WORKDIR=workdir,
+               LOADTEST_CACHE='1' if args.cache else '0',
+               LOADTEST_ADMISSION='1' if args.admission else '0',
+               OPENAI_API_KEY='stub',
+               OPENAI_API_URL=f'http://127.0.0.1:{stub_port}/v1/chat/completions')
+    if args.gunicorn_workers:
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(args.gunicorn_workers),
+                   '-k', 'gthread', '--threads', str(args.gunicorn_threads),
+                   '-b', f'127.0.0.1:{app_port}', '--pythonpath', f'{BENCH_DIR},{ROOT}',
+                   'loadtest:wsgi_app()']
+    else:
+        command = [sys.executable, os.path.abspath(__file__), '--serve', str(app_port)]
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL,
+                              stderr=None if args.verbose else subprocess.DEVNULL)
+
+    wait_until_up(f'http://127.0.0.1:{stub_port}/', stub)
+    wait_until_up(f'http://127.0.0.1:{app_port}/', server)
+    return f'http://127.0.0.1:{app_port}', [server, stub]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    parser.add_argument('--seed-db', default=None, help='generated database, reused between runs')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--clients', type=int, default=50, help='concurrent chat users')
+    parser.add_argument('--admins', type=int, default=2, help='concurrent admin panels')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--polls', type=int, default=3, help='get_messages polls after each send')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--think-time', type=float, default=1.0)
+    parser.add_argument('--prompt-variety', type=int, default=1000,
+                        help='distinct prompts (lower means more cache hits with --cache)')
+    parser.add_argument('--cache', action='store_true', help='enable the AI response cache')
+    parser.add_argument('--admission', action='store_true',
+                        help='enable admission control (shed requests show up as errors)')
+    parser.add_argument('--ai-latency', type=float, default=0.5)
+    parser.add_argument('--ai-jitter', type=float, default=0.1)
+    parser.add_argument('--ai-error-rate', type=float, default=0.0)
+    parser.add_argument('--gunicorn-workers', type=int, default=0,
+                        help='serve with gunicorn instead of the werkzeug threaded server')
+    parser.add_argument('--gunicorn-threads', type=int, default=16)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON result here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='show server logs')
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve)
+
+    from bench_queries import generate
+
+    seed_db = args.seed_db or os.path.join(ROOT, 'data', f'loadtest_{args.users}x{args.messages}.db')
+    os.makedirs(os.path.dirname(seed_db), exist_ok=True)
+    generate(seed_db, args.users, args.messages).close()
+
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    os.makedirs(os.path.join(workdir, 'data'))
+    shutil.copyfile(seed_db, os.path.join(workdir, 'data', 'chat_data.db'))
+
+    processes = []
+    try:
+        base, processes = start_servers(args, workdir)
+        before = scrape_metrics(base)
+
+        recorder = Recorder()
+        rng = random.Random(args.seed)
+        deadline = time.monotonic() + args.duration
+        threads = [
+            threading.Thread(target=user_client, args=(base, args, recorder, deadline, random.Random(rng.random())))
+            for _ in range(args.clients)
+        ] + [
+            threading.Thread(target=admin_client, args=(base, args, recorder, deadline, random.Random(rng.random())))
+            for _ in range(args.admins)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        after = scrape_metrics(base)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    every = [seconds for samples in recorder.samples.values() for seconds in samples]
+    settings = {key: value for key, value in vars(args).items() if key not in ('serve', 'output', 'verbose')}
+    result = {
+        'revision': git_revision(),
+        'settings': settings,
+        'elapsed_s': round(elapsed, 2),
+        'endpoints': {
+            name: summarize(samples, recorder.errors.get(name, 0), elapsed)
+            for name, samples in sorted(recorder.samples.items())
+        },
+        'total': summarize(every, sum(recorder.errors.values()), elapsed),
+        'lock_errors': recorder.lock_errors,
+        'server': metrics_delta(before, after) if not args.gunicorn_workers else None,
+    }
+
+    print(f'{"endpoint":<14}{"req":>8}{"err":>6}{"rps":>9}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}',
+          file=sys.stderr)
+    for name, row in list(result['endpoints'].items()) + [('total', result['total'])]:
+        print(f'{name:<14}{row["requests"]:>8}{row["errors"]:>6}{row["rps"]:>9.1f}'
+              f'{row["p50_ms"] or 0:>9.1f}{row["p95_ms"] or 0:>9.1f}{row["p99_ms"] or 0:>9.1f}',
+              file=sys.stderr)
+    print(f'database is locked: {result["lock_errors"]}', file=sys.stderr)
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Local stub of the OpenAI chat-completions endpoint.
+
+Usage:
+    python benchmarks/stub_openai.py --port 8089 --latency 0.5 --error-rate 0.05
+    OPENAI_API_KEY=stub OPENAI_API_URL=http://127.0.0.1:8089/v1/chat/completions python app.py
+
+Supports plain and ``"stream": true`` requests, configurable latency (with
+jitter), random 5xx errors and 429 responses with a Retry-After header, so
+AIService retries, circuit breaker and streaming can be exercised offline.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = 'این یک پاسخ آزمایشی از سرور شبیه‌ساز است. $a^2 + b^2 = c^2$'
+
+
+class StubState:
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_after=1, chunk_delay=0.02, reply=REPLY):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.chunk_delay = chunk_delay
+        self.reply = reply
+        self.requests = 0
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = StubState()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        state = self.state
+        with state.lock:
+            state.requests += 1
+
+        time.sleep(max(0.0, state.latency + random.uniform(-state.jitter, state.jitter)))
+
+        roll = random.random()
+        if roll < state.rate_limit_rate:
+            return self._send_json(429, {'error': {'message': 'rate limited'}},
+                                   {'Retry-After': str(state.retry_after)})
+        if roll < state.rate_limit_rate + state.error_rate:
+            return self._send_json(503, {'error': {'message': 'stub failure'}})
+
+        if body.get('stream'):
+            return self._send_stream(body)
+        return self._send_json(200, {
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': state.reply},
+                         'finish_reason': 'stop'}],
+        })
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _send_stream(self, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for word in self.state.reply.split(' '):
+            event = {'choices': [{'index': 0, 'delta': {'content': word + ' '}}]}
+            self._send_chunk(f'data: {json.dumps(event, ensure_ascii=False)}\n\n'.encode('utf-8'))
+            time.sleep(self.state.chunk_delay)
+        self._send_chunk(b'data: [DONE]\n\n')
+        self._send_chunk(b'')
+
+
+def start_stub(host='127.0.0.1', port=0, **options):
+    """Start the stub in a background thread; returns (server, url)"""
+    handler = type('ConfiguredStubHandler', (StubHandler,), {'state': StubState(**options)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='stub-openai', daemon=True).start()
+    return server, f'http://{host}:{server.server_port}/v1/chat/completions'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds before answering')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction answered with 503')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    args = parser.parse_args()
+
+    server, url = start_stub(
+        args.host, args.port, latency=args.latency, jitter=args.jitter,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after
+    )
+    print(f'Stub chat-completions endpoint listening on {url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import multiprocessing
+import threading
+import time
+
+
+class Broadcaster:
+    """ارسال یک پیام ادمین به گروه بزرگی از کاربران در پس‌زمینه
+
+    کاربران به ترتیب id در دسته‌های chunk_size نفره با executemany در یک
+    تراکنش ذخیره می‌شوند و بین دسته‌ها مکث می‌شود تا قفل نوشتن برای بقیه
+    آزاد شود. پیشرفت در جدول broadcast_jobs همراه همان تراکنش ثبت می‌شود،
+    پس کاری که worker آن از کار افتاده بدون پیام تکراری ادامه داده می‌شود.
+    """
+
+    def __init__(self, db, hub, chunk_size=500, pause=0.05, stale_after=60, check_interval=30):
+        self.db = db
+        self.hub = hub
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.stale_after = stale_after
+        self.check_interval = check_interval
+        self._stopped = threading.Event()
+        self._running = set()
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def start(self, target, message_type, content, file_path=None):
+        """ثبت و شروع ارسال؛ خروجی: {'id', 'total'}"""
+        job = self.db.create_broadcast(target, message_type, content, file_path)
+        self._spawn(job['id'])
+        return job
+
+    def ensure_watcher(self):
+        """شروع بررسی دوره‌ای کارهای رها شده (با اولین درخواست، نه در دستورهای CLI)"""
+        if self._watcher is not None or multiprocessing.parent_process() is not None:
+            return
+        with self._lock:
+            if self._watcher is None:
+                self._watcher = threading.Thread(target=self._watch, name='broadcast-watcher', daemon=True)
+                self._watcher.start()
+
+    def resume(self):
+        """ادامه کارهای نیمه‌تمام worker هایی که دیگر زنده نیستند"""
+        try:
+            job_ids = self.db.claim_stale_broadcasts(self.stale_after)
+        except Exception as e:
+            print(f"Broadcast resume error: {e}")
+            return
+        for job_id in job_ids:
+            self._spawn(job_id)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _watch(self):
+        # worker زنده updated_at را با هر دسته جلو می‌برد؛ کار ساکن مانده صاحب ندارد
+        while True:
+            self.resume()
+            if self._stopped.wait(self.check_interval):
+                return
+
+    def _spawn(self, job_id):
+        with self._lock:
+            if job_id in self._running:
+                return
+            self._running.add(job_id)
+        threading.Thread(target=self._run, args=(job_id,), name=f'broadcast-{job_id}', daemon=True).start()
+
+    def _run(self, job_id):
+        try:
+            self._send(job_id)
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+
+    def _send(self, job_id):
+        while not self._stopped.is_set():
+            try:
+                sent = self.db.send_broadcast_chunk(job_id, self.chunk_size)
+            except Exception as e:
+                print(f"Broadcast error ({job_id}): {e}")
+                try:
+                    self.db.fail_broadcast(job_id, str(e))
+                except Exception as db_error:
+                    print(f"Broadcast error ({job_id}): {db_error}")
+                return
+            if not sent:
+                # تمام شد یا لغو شد
+                return
+            # اتصال‌های SSE همین worker فوراً خبردار می‌شوند؛ بقیه با watcher هاب
+            self.hub.publish_many(sent)
+            time.sleep(self.pause)
@@ -5,8 +5,68 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-key-123-change-in-production'
     UPLOAD_FOLDER = 'uploads'
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
+    # آپلودها محتوا-محور در uploads/blobs ذخیره می‌شوند (فایل تکراری یک بار)
+    UPLOAD_CHUNK_SIZE = 64 * 1024
+    UPLOAD_GC_GRACE = 3600  # ثانیه - blob تازه‌تر از این حذف نمی‌شود
+    
+    # ارسال فایل‌ها: ETag از هش محتوا، blob ها با Cache-Control immutable
+    UPLOAD_MAX_AGE = 86400  # ثانیه - فقط برای فایل‌های قدیمی خارج از blobs
+    STATIC_MAX_AGE = 0  # بدون ?v= مرورگر با ETag اعتبارسنجی می‌کند
+    # پشت nginx: 'x-accel' (با location internal روی UPLOAD_ACCEL_PREFIX) یا 'x-sendfile'
+    UPLOAD_OFFLOAD = os.environ.get('UPLOAD_OFFLOAD') or None
+    UPLOAD_ACCEL_PREFIX = '/protected-uploads/'
+    
+    # پیش‌نمایش و مشخصات رسانه در استخر پروسه (Pillow و ffprobe/ffmpeg اختیاری)
+    # هر worker gunicorn استخر خودش را دارد
+    MEDIA_ENABLED = True
+    MEDIA_WORKERS = 2
+    MEDIA_THUMB_SIZE = 320  # پیکسل - ضلع بزرگ‌تر
+    MEDIA_POLL_INTERVAL = 2  # ثانیه - برای کارهای ثبت شده در worker های دیگر
+    MEDIA_MAX_ATTEMPTS = 3
     DATABASE = 'data/chat_data.db'
     
+    # تنظیمات اتصال SQLite
+    DB_POOL_SIZE = 8
+    DB_BUSY_TIMEOUT = 5000  # میلی‌ثانیه
+    DB_SYNCHRONOUS = 'NORMAL'  # در حالت WAL امن است؛ FULL برای دوام کامل
+    DB_CACHE_SIZE_KB = 16384
+    DB_MMAP_SIZE = 128 * 1024 * 1024
+    
+    # نوشتن گروهی پیام‌ها: یک نخ نویسنده، یک commit (یک fsync) برای چند پیام
+    # save_message تا commit شدن صبر می‌کند؛ پس پیام تأیید شده از دست نمی‌رود
+    DB_WRITE_BEHIND = os.environ.get('DB_WRITE_BEHIND', '0') == '1'
+    DB_WRITE_BATCH_SIZE = 100
+    DB_WRITE_BATCH_MS = 0  # میلی‌ثانیه انتظار برای پیام‌های بعدی؛ 0 یعنی فقط پیام‌های در صف
+    DB_WRITE_QUEUE_SIZE = 10000
+    # 'FULL' برای دوام در برابر قطع برق؛ None یعنی همان DB_SYNCHRONOUS
+    DB_WRITE_SYNCHRONOUS = os.environ.get('DB_WRITE_SYNCHRONOUS') or None
+    
+    # نگهداری داده‌ها: پیام‌ها و کاربران قدیمی به JSONL فشرده ماهانه منتقل و حذف می‌شوند
+    # دستی: flask retention - زمان‌بندی شده: RETENTION_SCHEDULED=1 (فقط یک worker اجرا می‌کند)
+    RETENTION_ARCHIVE_DIR = 'data/archive'
+    RETENTION_MESSAGE_DAYS = 365  # None یعنی نگهداری همیشگی
+    RETENTION_INACTIVE_USER_DAYS = 180
+    RETENTION_EMPTY_SESSION_HOURS = 24  # session بدون هیچ پیام
+    RETENTION_COMPRESSION = 'gzip'  # یا 'zstd' (نیاز به بسته zstandard)
+    RETENTION_BATCH_SIZE = 500  # ردیف در هر تراکنش
+    RETENTION_BATCH_PAUSE = 0.05  # ثانیه - فرصت برای نوشتن‌های دیگر
+    RETENTION_VACUUM_PAGES = 1000  # صفحه در هر incremental_vacuum
+    RETENTION_SCHEDULED = os.environ.get('RETENTION_SCHEDULED', '0') == '1'
+    RETENTION_INTERVAL = 6 * 3600  # ثانیه
+    
+    # کش session -> user_id و تجمیع به‌روزرسانی‌های last_active
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 300  # ثانیه
+    ACTIVITY_FLUSH_INTERVAL = 10  # ثانیه
+    ACTIVITY_FLUSH_THRESHOLD = 500
+    
+    # آمار عملکرد در قالب Prometheus روی /metrics (هر worker آمار خودش را دارد)
+    # دسترسی: ?password= ادمین یا هدر Authorization: Bearer <METRICS_TOKEN>
+    METRICS_ENABLED = True
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # درخواست‌های کندتر از این (میلی‌ثانیه) با SQL و تماس‌های AI لاگ می‌شوند؛ None یعنی خاموش
+    METRICS_SLOW_REQUEST_MS = int(os.environ['SLOW_REQUEST_MS']) if os.environ.get('SLOW_REQUEST_MS') else None
+    
     # Allowed file extensions
     ALLOWED_EXTENSIONS = {
         'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif',
@@ -15,9 +75,81 @@ class Config:
     
     # **تنظیمات ChatGPT API - از محیط می‌گیره**
     OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')  # ✅ این از Render/Secrets میاد
-    OPENAI_API_URL = 'https://api.openai.com/v1/chat/completions'
+    OPENAI_API_URL = os.environ.get('OPENAI_API_URL') or 'https://api.openai.com/v1/chat/completions'
     OPENAI_MODEL = 'gpt-3.5-turbo'
     
+    # اتصال به API: pool، تلاش مجدد، circuit breaker و محدودیت نرخ
+    AI_POOL_SIZE = 10
+    AI_MAX_RETRIES = 3
+    AI_BACKOFF_BASE = 0.5  # ثانیه
+    AI_BACKOFF_MAX = 8
+    AI_BREAKER_THRESHOLD = 5  # خطای پشت سر هم تا قطع موقت
+    AI_BREAKER_RESET = 30  # ثانیه
+    # درخواست در ثانیه برای هر worker (سهمیه کل تقسیم بر تعداد worker ها)؛ 0 یعنی بدون محدودیت
+    AI_RATE_LIMIT = float(os.environ.get('AI_RATE_LIMIT', '0'))
+    AI_RATE_BURST = 5
+    
+    # کش پاسخ‌های تکراری - لایه SQLite بین worker ها مشترک است (None برای غیرفعال)
+    AI_CACHE_ENABLED = True
+    AI_CACHE_MAX_ENTRIES = 1000
+    AI_CACHE_MAX_BYTES = 8 * 1024 * 1024
+    AI_CACHE_TTL = 24 * 3600  # ثانیه
+    AI_CACHE_DB = 'data/ai_cache.db'
+    AI_CACHE_DISK_MAX_ENTRIES = 20000  # سقف لایه SQLite؛ قدیمی‌ترها حذف می‌شوند
+    AI_CACHE_DISK_MAX_BYTES = 64 * 1024 * 1024
+    
+    # قوانین پاسخ محلی/تمیزکاری/جایگزین - با تغییر فایل خودکار دوباره خوانده می‌شود
+    AI_RULES_PATH = 'rules/ai_rules.json'
+    
+    # تاریخچه گفتگو در هر درخواست - اندازه payload با طول گفتگو رشد نمی‌کند
+    AI_CONTEXT_MAX_TOKENS = 1500  # تخمینی، فقط برای تاریخچه
+    AI_CONTEXT_MAX_TURNS = 20  # 0 یعنی بدون تاریخچه
+    # خلاصه پیام‌های قدیمی‌تر در پس‌زمینه (یک تماس اضافه با API)
+    AI_CONTEXT_SUMMARY = os.environ.get('AI_CONTEXT_SUMMARY', '0') == '1'
+    AI_CONTEXT_SUMMARY_MIN_TURNS = 6
+    
+    # حالت غیرهمزمان پاسخ هوش مصنوعی - پیام کاربر فوراً تأیید می‌شود
+    AI_ASYNC_MODE = os.environ.get('AI_ASYNC_MODE', '0') == '1'
+    AI_WORKERS = 4
+    AI_QUEUE_SIZE = 100  # بیشتر از این، پاسخ 503 با Retry-After
+    AI_DEADLINE = 45  # ثانیه - از لحظه ورود به صف
+    
+    # کنترل ورود: سطل توکن برای هر session و IP، پاسخ سریع 429/503 با Retry-After
+    # مسیرهای ادمین محدود نمی‌شوند. هر درخواست کاربر یک تراکنش نوشتن کوتاه روی
+    # ADMISSION_DB است؛ پس پیش‌فرض خاموش
+    ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '0') == '1'
+    ADMISSION_DB = 'data/admission.db'  # بین worker ها مشترک؛ None یعنی فقط در حافظه همین پروسه
+    ADMISSION_LIMITS = {  # دسته: (درخواست در ثانیه، ظرفیت سطل)
+        'page': (1, 20),
+        'poll': (2, 30),  # polling هر ۲ ثانیه با چند تب
+        'stream': (0.2, 10),  # باز کردن اتصال SSE
+        'send': (1, 10),
+        'ai': (0.2, 5),  # پیام‌هایی که به هوش مصنوعی می‌روند
+    }
+    ADMISSION_IP_FACTOR = 4  # سطل هر IP چند برابر سطل session (چند کاربر پشت یک NAT)
+    # پشت reverse proxy (مثل Render یا nginx) تعداد proxy های مورد اعتماد؛ IP از X-Forwarded-For
+    ADMISSION_PROXY_HOPS = int(os.environ.get('ADMISSION_PROXY_HOPS', '0'))
+    ADMISSION_AI_MAX_IN_FLIGHT = 20  # تماس همزمان هوش مصنوعی در کل سرور؛ 0 یعنی بدون سقف
+    ADMISSION_AI_SLOT_TTL = 120  # ثانیه - جای worker از کار افتاده بعد از این آزاد می‌شود
+    ADMISSION_AI_RETRY_AFTER = 5  # ثانیه
+    # درخواست همزمان کاربران در هر worker (بدون SSE)؛ باید کمتر از تعداد نخ‌ها باشد تا
+    # ادمین همیشه نخ آزاد داشته باشد - 0 یعنی بدون سقف
+    ADMISSION_MAX_IN_FLIGHT = 0
+    
+    # پیام همگانی ادمین - در دسته‌های کوچک تا قفل نوشتن طولانی نشود
+    BROADCAST_CHUNK_SIZE = 500  # پیام در هر تراکنش
+    BROADCAST_PAUSE = 0.05  # ثانیه بین دسته‌ها
+    BROADCAST_MAX_IDS = 100000  # سقف لیست صریح کاربران
+    # کاری که این مدت پیشرفتی نداشته (worker از کار افتاده) را worker دیگری ادامه می‌دهد
+    BROADCAST_STALE_AFTER = 60  # ثانیه
+    BROADCAST_RESUME_INTERVAL = 30  # ثانیه
+    
+    # تنظیمات Server-Sent Events
+    # هر اتصال SSE یک نخ را نگه می‌دارد؛ gunicorn را با --worker-class gthread اجرا کنید
+    SSE_MAX_DURATION = 55  # ثانیه - بعد از آن مرورگر خودکار دوباره وصل می‌شود
+    SSE_HEARTBEAT = 15
+    HUB_POLL_INTERVAL = 0.5  # دنبال کردن پیام‌های worker های دیگر
+    
     AI_API_KEY = OPENAI_API_KEY
     AI_ENDPOINT = OPENAI_API_URL
     
@@ -0,0 +1,122 @@
+import threading
+
+# هزینه ثابت هر پیام در قالب chat (نقش و جداکننده‌ها)
+MESSAGE_OVERHEAD = 4
+
+SUMMARY_PREFIX = 'خلاصه گفتگوی قبلی با این کاربر: '
+
+
+def estimate_tokens(text):
+    """تخمین سریع تعداد توکن بدون tokenizer
+
+    حروف لاتین تقریباً ۴ کاراکتر در هر توکن و حروف فارسی تقریباً ۲ کاراکتر
+    در هر توکن هستند. تعداد کاراکترهای غیر ASCII از اختلاف طول UTF-8 به دست
+    می‌آید تا روی متن حلقه نزنیم.
+    """
+    if not text:
+        return 0
+    non_ascii = len(text.encode('utf-8')) - len(text)
+    ascii_chars = max(len(text) - non_ascii, 0)
+    return ascii_chars // 4 + (non_ascii + 1) // 2 + 1
+
+
+class ContextBuilder:
+    """ساخت تاریخچه مکالمه برای درخواست هوش مصنوعی در یک بودجه توکن ثابت
+
+    آخرین پیام‌های کاربر از انتهای گفتگو خوانده می‌شوند و از جدیدترین به
+    قدیمی‌ترین تا پر شدن بودجه اضافه می‌شوند. اگر خلاصه فعال باشد، همه
+    پیام‌های قدیمی‌تر از اولین پیام فرستاده شده (چه به خاطر max_turns و چه
+    بودجه) در پس‌زمینه به خلاصه کوتاه هر کاربر اضافه می‌شوند؛ هر بار حداکثر
+    summary_batch پیام، از قدیمی به جدید.
+    """
+
+    def __init__(self, db, max_tokens=1500, max_turns=20, summarize=None, summary_min_turns=6,
+                 summary_batch=50):
+        self.db = db
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        # summarize(previous_summary, turns) -> متن خلاصه؛ None یعنی بدون خلاصه
+        self.summarize = summarize
+        self.summary_min_turns = summary_min_turns
+        self.summary_batch = summary_batch
+        self._summarizing = set()
+        self._lock = threading.Lock()
+
+    def build(self, user_id, before_id=None):
+        """لیست پیام‌ها به قالب chat (قدیمی به جدید) برای پیام‌های قبل از before_id"""
+        if not self.max_turns or not self.max_tokens:
+            return []
+
+        rows = self.db.get_recent_messages(user_id, self.max_turns, before_id)
+        turns = self._turns(rows)
+
+        summary = self.db.get_conversation_summary(user_id) if self.summarize else None
+        budget = self.max_tokens
+        if summary:
+            # پیام‌هایی که در خلاصه آمده‌اند دوباره فرستاده نمی‌شوند
+            turns = [turn for turn in turns if turn['id'] > summary['through_message_id']]
+            summary_text = SUMMARY_PREFIX + summary['summary']
+            budget -= estimate_tokens(summary_text) + MESSAGE_OVERHEAD
+
+        kept = []
+        for turn in reversed(turns):
+            cost = estimate_tokens(turn['content']) + MESSAGE_OVERHEAD
+            if cost > budget:
+                break
+            budget -= cost
+            kept.append(turn)
+        kept.reverse()
+
+        if self.summarize:
+            # هر چه قبل از اولین پیام فرستاده شده است، از جمله پیام‌های بیرون از max_turns
+            boundary = kept[0]['id'] if kept else before_id
+            through = summary['through_message_id'] if summary else 0
+            window_full = len(rows) == self.max_turns and rows[0]['id'] > through
+            if window_full or len(kept) < len(turns):
+                self._maybe_refresh_summary(user_id, summary, through, boundary)
+
+        history = [{'role': turn['role'], 'content': turn['content']} for turn in kept]
+        if summary:
+            history.insert(0, {'role': 'system', 'content': summary_text})
+        return history
+
+    @staticmethod
+    def _turns(rows):
+        return [
+            {'id': row['id'], 'role': 'user' if row['sender'] == 'user' else 'assistant',
+             'content': row['content']}
+            for row in rows
+            # پیام‌های ادمین جزو گفتگو با هوش مصنوعی نیستند
+            if row['sender'] in ('user', 'ai') and row['content']
+        ]
+
+    def _maybe_refresh_summary(self, user_id, summary, through, boundary):
+        with self._lock:
+            if user_id in self._summarizing:
+                return
+            self._summarizing.add(user_id)
+        try:
+            rows = self.db.get_conversation_range(user_id, through, boundary, self.summary_batch)
+        except Exception as e:
+            print(f"Conversation summary error: {e}")
+            rows = []
+        dropped = self._turns(rows)
+        if len(dropped) < self.summary_min_turns:
+            with self._lock:
+                self._summarizing.discard(user_id)
+            return
+
+        def run():
+            try:
+                text = self.summarize(summary['summary'] if summary else None, dropped)
+                if text:
+                    # پیام‌های ادمین بین آنها هم رد شده حساب می‌شوند
+                    self.db.save_conversation_summary(user_id, text, rows[-1]['id'])
+            except Exception as e:
+                print(f"Conversation summary error: {e}")
+            finally:
+                with self._lock:
+                    self._summarizing.discard(user_id)
+
+        # خلاصه‌سازی پاسخ فعلی را معطل نمی‌کند
+        threading.Thread(target=run, name=f'summary-{user_id}', daemon=True).start()
@@ -1,18 +1,318 @@
+import json
+import queue
+import re
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from markup import MARK_END, MARK_START, render_message
+from migrations import migrate
+from text_normalize import normalize_text
+
+_SEARCH_TOKEN = re.compile(r'\w+')
+
+
+def build_search_query(text):
+    """Turn free text into an FTS5 MATCH expression of quoted prefix terms.
+
+    Returns None when the text has no searchable words. Quoting keeps user
+    input from being parsed as FTS5 syntax (AND, NEAR, column filters, ...).
+    """
+    tokens = _SEARCH_TOKEN.findall(normalize_text(text))
+    if not tokens:
+        return None
+    return ' '.join('"%s"*' % token.replace('"', '""') for token in tokens)
+
+class _SessionCache:
+    """Bounded LRU of session_id -> (user_id, ip_address) with a TTL"""
+    
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (value, time.monotonic() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+    
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+
+class _ActivityBuffer:
+    """Coalesces last_active updates; flushed on a timer or when it grows too big"""
+    
+    def __init__(self, flush, interval=10, threshold=500):
+        self._flush = flush
+        self.interval = interval
+        self.threshold = threshold
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+    
+    def touch(self, user_id, ip_address=None):
+        with self._lock:
+            previous = self._pending.get(user_id)
+            if ip_address is None and previous:
+                ip_address = previous[1]
+            # Same format and zone as CURRENT_TIMESTAMP, so it compares with timestamp columns
+            self._pending[user_id] = (datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'), ip_address)
+            size = len(self._pending)
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(
+                    target=self._run, name='activity-flusher', daemon=True
+                )
+                self._thread.start()
+        if size >= self.threshold:
+            self._wakeup.set()
+    
+    def drain(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+    
+    def pending(self, user_ids):
+        with self._lock:
+            return {user_id for user_id in user_ids if user_id in self._pending}
+    
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped:
+                return
+            try:
+                self._flush()
+            except Exception as e:
+                print(f"Activity flush error: {e}")
+
+
+class _MessageWriter:
+    """Single writer thread that owns a connection and group-commits inserts
+    
+    Rows are taken from the queue until batch_size is reached or batch_ms has
+    passed since the first one (0: whatever queued up during the previous
+    commit), then written in one transaction (one WAL sync). Each future resolves with the new id only after the commit, so a
+    caller is never told a message was saved before it is on disk. Rows still
+    queued when the process dies were never acknowledged; stop() drains the
+    queue before returning.
+    """
+    
+    def __init__(self, connect, write, batch_size=100, batch_ms=0, max_queue=10000):
+        self._connect = connect
+        self._write = write
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        # Bounded so a stalled disk pushes back on request threads
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._thread = None
+        self._stopped = False
+    
+    def submit(self, row):
+        future = Future()
+        with self._lock:
+            if self._stopped:
+                raise sqlite3.ProgrammingError('Database has been closed')
+            # Started lazily so a preloading parent process does not own it
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+                self._thread.start()
+        self._queue.put((row, future))
+        return future
+    
+    def stop(self, timeout=10):
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+    
+    def _run(self):
+        try:
+            while True:
+                batch, stopping = self._next_batch()
+                if batch:
+                    self._commit(batch)
+                if stopping:
+                    return
+        finally:
+            if self._conn is not None:
+                self._conn.close()
+    
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.batch_ms / 1000
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+    
+    def _commit(self, batch):
+        try:
+            if self._conn is None:
+                self._conn = self._connect()
+            cursor = self._conn.cursor()
+            ids = [self._write(cursor, row) for row, _ in batch]
+            self._conn.commit()
+        except Exception as e:
+            if self._conn is not None and self._conn.in_transaction:
+                self._conn.rollback()
+            if len(batch) > 1:
+                # One bad row must not fail the others; retry them one by one
+                for item in batch:
+                    self._commit([item])
+                return
+            batch[0][1].set_exception(e)
+            return
+        for (_, future), message_id in zip(batch, ids):
+            future.set_result(message_id)
+
 
 class Database:
-    def __init__(self, db_path):
+    def __init__(self, db_path, pool_size=8, busy_timeout=5000, synchronous='NORMAL',
+                 cache_size_kb=16384, mmap_size=128 * 1024 * 1024,
+                 user_cache_size=10000, user_cache_ttl=300,
+                 activity_flush_interval=10, activity_flush_threshold=500,
+                 write_behind=False, write_batch_size=100, write_batch_ms=0,
+                 write_queue_size=10000, write_synchronous=None, trace_callback=None):
         self.db_path = db_path
+        self.busy_timeout = busy_timeout
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        # Called with the text of every statement (slow-request log)
+        self.trace_callback = trace_callback
+        
+        # Idle connections are kept for reuse instead of connect/close per call
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._closed = False
+        
+        # Session lookups are cached and last_active writes are batched
+        self._user_cache = _SessionCache(user_cache_size, user_cache_ttl)
+        self._activity = _ActivityBuffer(
+            self.flush_activity, activity_flush_interval, activity_flush_threshold
+        )
+        
+        # Message inserts can be group-committed by one writer thread; its
+        # connection may use a stricter synchronous level than the readers
+        self._writer = None
+        if write_behind:
+            self._writer = _MessageWriter(
+                lambda: self.get_connection(write_synchronous or synchronous),
+                self._insert_message,
+                write_batch_size, write_batch_ms, write_queue_size
+            )
         self.init_db()
     
-    def get_connection(self):
-        return sqlite3.connect(self.db_path)
+    def get_connection(self, synchronous=None):
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout / 1000,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout)}')
+        conn.execute(f'PRAGMA synchronous = {synchronous or self.synchronous}')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        if self.trace_callback is not None:
+            conn.set_trace_callback(self.trace_callback)
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection; uncommitted work is rolled back on return"""
+        if self._closed:
+            raise sqlite3.ProgrammingError('Database has been closed')
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self.get_connection()
+        
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._release(conn)
+    
+    def _release(self, conn):
+        if self._closed:
+            conn.close()
+            return
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+    
+    def close(self):
+        # Queued messages are committed before the connections go away
+        if self._writer is not None:
+            self._writer.stop()
+        self._activity.stop()
+        try:
+            self.flush_activity()
+        except sqlite3.Error as e:
+            print(f"Activity flush error: {e}")
+        
+        self._closed = True
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
     
     def init_db(self):
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # Only takes effect on a new file; older databases need one full VACUUM
+        # (flask retention --full-vacuum) so deleted rows can be given back
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        
+        # WAL lets the pollers read while send_message is writing
+        cursor.execute('PRAGMA journal_mode = WAL')
+        
         # Users table with unique session ID and IP
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -39,121 +339,644 @@ class Database:
             )
         ''')
         
-        # Check if ip_address column exists, if not add it
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'ip_address' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN ip_address TEXT")
-        
         conn.commit()
+        
+        # Indexes, new columns and other schema changes live in migrations.py
+        migrate(conn)
         conn.close()
     
     # ✅ این تابع باید دقیقاً این شکلی باشه
     def get_or_create_user(self, session_id, client_ip=None):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        # Polls hit the cache and only queue a last_active update in memory
+        cached = self._user_cache.get(session_id)
+        if cached:
+            user_id, known_ip = cached
+            ip_changed = client_ip and client_ip != known_ip
+            if ip_changed:
+                self._user_cache.put(session_id, (user_id, client_ip))
+            self._activity.touch(user_id, client_ip if ip_changed else None)
+            return user_id
         
-        cursor.execute('SELECT id, ip_address FROM users WHERE session_id = ?', (session_id,))
-        user = cursor.fetchone()
-        
-        if not user:
-            cursor.execute(
-                '''INSERT INTO users (session_id, username, ip_address) 
-                   VALUES (?, ?, ?)''',
-                (session_id, f'کاربر-{session_id[:8]}', client_ip)
-            )
-            user_id = cursor.lastrowid
-        else:
-            user_id = user[0]
-            if client_ip and (len(user) < 2 or user[1] != client_ip):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT id, ip_address FROM users WHERE session_id = ?', (session_id,))
+            user = cursor.fetchone()
+            
+            if not user:
                 cursor.execute(
-                    '''UPDATE users SET last_active = ?, ip_address = ? 
-                       WHERE id = ?''',
-                    (datetime.now().isoformat(), client_ip, user_id)
+                    '''INSERT INTO users (session_id, username, ip_address) 
+                       VALUES (?, ?, ?)''',
+                    (session_id, f'کاربر-{session_id[:8]}', client_ip)
                 )
+                user_id = cursor.lastrowid
+                conn.commit()
+                known_ip = client_ip
             else:
-                cursor.execute(
-                    'UPDATE users SET last_active = ? WHERE id = ?',
-                    (datetime.now().isoformat(), user_id)
-                )
+                user_id, known_ip = user
+                ip_changed = client_ip and client_ip != known_ip
+                self._activity.touch(user_id, client_ip if ip_changed else None)
+                known_ip = client_ip if ip_changed else known_ip
         
-        conn.commit()
-        conn.close()
+        self._user_cache.put(session_id, (user_id, known_ip))
         return user_id
     
+    def flush_activity(self):
+        """Write the buffered last_active/ip_address updates in one transaction"""
+        pending = self._activity.drain()
+        if not pending:
+            return 0
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.executemany(
+                'UPDATE users SET last_active = ? WHERE id = ?',
+                [(last_active, user_id) for user_id, (last_active, ip) in pending.items() if not ip]
+            )
+            cursor.executemany(
+                'UPDATE users SET last_active = ?, ip_address = ? WHERE id = ?',
+                [(last_active, ip, user_id) for user_id, (last_active, ip) in pending.items() if ip]
+            )
+            conn.commit()
+        return len(pending)
+    
+    def pending_activity(self, user_ids):
+        """Users among user_ids with a visit that is buffered but not written yet"""
+        return self._activity.pending(user_ids)
+    
+    def forget_sessions(self, session_ids):
+        """Drop cached session lookups (after their users were deleted)"""
+        for session_id in session_ids:
+            self._user_cache.discard(session_id)
+    
     def save_message(self, user_id, sender, message_type, content, file_path=None):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+        """Insert a message and return its id once it is committed"""
+        return self.save_message_async(user_id, sender, message_type, content, file_path).result()
+    
+    def save_message_async(self, user_id, sender, message_type, content, file_path=None):
+        """Insert a message; the returned Future resolves with its id after commit"""
+        # Render once at write time instead of on every read
+        row = (user_id, sender, message_type, content, file_path,
+               render_message(message_type, content))
+        if self._writer is not None:
+            return self._writer.submit(row)
         
+        future = Future()
+        try:
+            with self.connection() as conn:
+                message_id = self._insert_message(conn.cursor(), row)
+                conn.commit()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            future.set_result(message_id)
+        return future
+    
+    @staticmethod
+    def _insert_message(cursor, row):
         cursor.execute('''
-            INSERT INTO messages (user_id, sender, message_type, content, file_path)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, sender, message_type, content, file_path))
+            INSERT INTO messages (user_id, sender, message_type, content, file_path, content_html)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', row)
+        message_id = cursor.lastrowid
         
-        conn.commit()
-        conn.close()
-        return cursor.lastrowid
+        # Same transaction, so the index never misses a committed message
+        content = row[3]
+        if content:
+            cursor.execute(
+                'INSERT INTO messages_fts (rowid, body) VALUES (?, ?)',
+                (message_id, normalize_text(content))
+            )
+        return message_id
     
-    def get_messages(self, user_id=None, limit=50):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
+    def get_messages(self, user_id=None, limit=50, since_id=None, before_id=None):
+        return self.get_message_page(user_id, limit, before_id=before_id, after_id=since_id)['messages']
+    
+    def get_message_page(self, user_id=None, limit=50, before_id=None, after_id=None):
+        # Keyset pagination: every page is a range scan on (user_id, id) or the rowid,
+        # so its cost does not depend on how deep into the history it is
+        conditions = []
+        params = []
         if user_id:
-            cursor.execute('''
-                SELECT m.*, u.username, u.ip_address 
+            conditions.append('m.user_id = ?')
+            params.append(user_id)
+        if after_id is not None:
+            conditions.append('m.id > ?')
+            params.append(after_id)
+        if before_id is not None:
+            conditions.append('m.id < ?')
+            params.append(before_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        
+        # Forward from after_id; otherwise the newest page before before_id (or overall)
+        forward = after_id is not None and before_id is None
+        order = 'ASC' if forward else 'DESC'
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # One extra row tells whether another page exists
+            cursor.execute(f'''
+                SELECT m.id, m.user_id, m.sender, m.message_type, m.content,
+                       m.file_path, m.timestamp, u.username, u.ip_address, m.content_html,
+                       md.thumbnail_path, md.width, md.height, md.duration, md.size
                 FROM messages m 
                 JOIN users u ON m.user_id = u.id 
-                WHERE m.user_id = ? 
-                ORDER BY m.timestamp ASC 
+                LEFT JOIN media md ON md.file_path = m.file_path
+                {where}
+                ORDER BY m.id {order}
                 LIMIT ?
-            ''', (user_id, limit))
-        else:
+            ''', params + [limit + 1])
+            
+            messages = cursor.fetchall()
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            if not forward:
+                messages.reverse()
+            
+            result = []
+            backfill = []
+            for msg in messages:
+                content_html = msg[9]
+                if content_html is None:
+                    content_html = render_message(msg[3], msg[4])
+                    if content_html is not None:
+                        backfill.append((content_html, msg[0]))
+                result.append({
+                    'id': msg[0],
+                    'user_id': msg[1],
+                    'sender': msg[2],
+                    'message_type': msg[3],
+                    'content': msg[4],
+                    'file_path': msg[5],
+                    'timestamp': msg[6],
+                    'username': msg[7],
+                    'ip_address': msg[8],
+                    'content_html': content_html,
+                    'thumbnail_path': msg[10],
+                    # Filled in by the media pipeline; None until it has run
+                    'media': {
+                        'width': msg[11],
+                        'height': msg[12],
+                        'duration': msg[13],
+                        'size': msg[14]
+                    } if msg[14] is not None else None
+                })
+            
+            # Lazy backfill for rows written before content_html existed
+            if backfill:
+                try:
+                    cursor.executemany(
+                        'UPDATE messages SET content_html = ? WHERE id = ? AND content_html IS NULL',
+                        backfill
+                    )
+                    conn.commit()
+                except sqlite3.OperationalError as e:
+                    # Busy writer: serve the rendered rows now, store them next time
+                    conn.rollback()
+                    print(f"content_html backfill skipped: {e}")
+        
+        return {'messages': result, 'has_more': has_more}
+    
+    def get_latest_message_id(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT MAX(id) FROM messages')
+            latest = cursor.fetchone()[0]
+        return latest or 0
+    
+    def get_message_ids_since(self, since_id, limit=1000):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT id, user_id FROM messages WHERE id > ? ORDER BY id LIMIT ?',
+                (since_id, limit)
+            )
+            rows = cursor.fetchall()
+        return rows
+    
+    def get_recent_messages(self, user_id, limit=20, before_id=None):
+        # Tail of one conversation, walked backwards on idx_messages_user_id_id
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
             cursor.execute('''
-                SELECT m.*, u.username, u.ip_address 
-                FROM messages m 
-                JOIN users u ON m.user_id = u.id 
-                ORDER BY m.timestamp DESC 
+                SELECT id, sender, message_type, content
+                FROM messages
+                WHERE user_id = ? AND id < ?
+                ORDER BY id DESC
                 LIMIT ?
-            ''', (limit,))
+            ''', (user_id, before_id if before_id is not None else 2 ** 63 - 1, limit))
+            rows = cursor.fetchall()
         
-        messages = cursor.fetchall()
-        conn.close()
+        return [
+            {'id': row[0], 'sender': row[1], 'message_type': row[2], 'content': row[3]}
+            for row in reversed(rows)
+        ]
+    
+    def get_conversation_range(self, user_id, after_id, before_id=None, limit=50):
+        # Oldest-first slice of one conversation (turns not yet in the rolling summary)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT id, sender, message_type, content
+                FROM messages
+                WHERE user_id = ? AND id > ? AND id < ?
+                ORDER BY id
+                LIMIT ?
+            ''', (user_id, after_id, before_id if before_id is not None else 2 ** 63 - 1, limit))
+            rows = cursor.fetchall()
         
-        result = []
-        for msg in messages:
-            result.append({
-                'id': msg[0],
-                'user_id': msg[1],
-                'sender': msg[2],
-                'message_type': msg[3],
-                'content': msg[4],
-                'file_path': msg[5],
-                'timestamp': msg[6],
-                'username': msg[7],
-                'ip_address': msg[8] if len(msg) > 8 else None
-            })
+        return [
+            {'id': row[0], 'sender': row[1], 'message_type': row[2], 'content': row[3]}
+            for row in rows
+        ]
+    
+    def get_conversation_summary(self, user_id):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT summary, through_message_id FROM conversation_summaries WHERE user_id = ?',
+                (user_id,)
+            )
+            row = cursor.fetchone()
         
-        return result
+        if row:
+            return {'summary': row[0], 'through_message_id': row[1]}
+        return None
+    
+    def save_conversation_summary(self, user_id, summary, through_message_id):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Never let a slower, older summary overwrite a newer one
+            cursor.execute('''
+                INSERT INTO conversation_summaries (user_id, summary, through_message_id, updated_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    summary = excluded.summary,
+                    through_message_id = excluded.through_message_id,
+                    updated_at = excluded.updated_at
+                WHERE excluded.through_message_id > conversation_summaries.through_message_id
+            ''', (user_id, summary, through_message_id))
+            conn.commit()
+    
+    def count_file_references(self, file_path):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'SELECT COUNT(*) FROM messages WHERE file_path = ?',
+                (file_path,)
+            )
+            count = cursor.fetchone()[0]
+        return count
+    
+    def get_referenced_files(self, prefix=''):
+        # Range scan on idx_messages_file_path instead of LIKE (case-insensitive, no index)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1) if prefix else None
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            if upper:
+                cursor.execute(
+                    'SELECT DISTINCT file_path FROM messages WHERE file_path >= ? AND file_path < ?',
+                    (prefix, upper)
+                )
+            else:
+                cursor.execute('SELECT DISTINCT file_path FROM messages WHERE file_path IS NOT NULL')
+            rows = cursor.fetchall()
+        return {row[0] for row in rows}
+    
+    def enqueue_media(self, file_path):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Content-addressed blobs are processed once, however often re-uploaded
+            cursor.execute('INSERT OR IGNORE INTO media (file_path) VALUES (?)', (file_path,))
+            conn.commit()
+    
+    def claim_media_jobs(self, limit=1):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Select and mark under one write lock so workers never share a job
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(
+                "SELECT file_path FROM media WHERE status = 'pending' ORDER BY created_at LIMIT ?",
+                (limit,)
+            )
+            paths = [row[0] for row in cursor.fetchall()]
+            cursor.executemany('''
+                UPDATE media SET status = 'running', attempts = attempts + 1,
+                                 updated_at = CURRENT_TIMESTAMP
+                WHERE file_path = ?
+            ''', [(path,) for path in paths])
+            conn.commit()
+        return paths
+    
+    def finish_media(self, file_path, info):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE media SET status = 'done', thumbnail_path = ?, width = ?, height = ?,
+                                 duration = ?, size = ?, error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE file_path = ?
+            ''', (info['thumbnail_path'], info['width'], info['height'],
+                  info['duration'], info['size'], file_path))
+            conn.commit()
+    
+    def fail_media(self, file_path, error, max_attempts=3):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE media SET
+                    status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                    error = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE file_path = ?
+            ''', (max_attempts, error[:500], file_path))
+            conn.commit()
+    
+    def requeue_stale_media(self, older_than=600):
+        # Jobs left 'running' by a process that died mid-way
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE media SET status = 'pending'
+                WHERE status = 'running' AND updated_at < datetime('now', ?)
+            ''', (f'-{int(older_than)} seconds',))
+            conn.commit()
+        return cursor.rowcount
+    
+    def delete_media(self, file_paths):
+        # Returns the thumbnails that belonged to the removed rows
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            thumbnails = []
+            for file_path in file_paths:
+                cursor.execute('SELECT thumbnail_path FROM media WHERE file_path = ?', (file_path,))
+                row = cursor.fetchone()
+                if row and row[0]:
+                    thumbnails.append(row[0])
+            cursor.executemany('DELETE FROM media WHERE file_path = ?', [(path,) for path in file_paths])
+            conn.commit()
+        return thumbnails
+    
+    def search_messages(self, query, user_id=None, limit=20, offset=0):
+        match = build_search_query(query)
+        if match is None:
+            return {'results': [], 'has_more': False}
+        
+        conditions = ['messages_fts MATCH ?']
+        params = [match]
+        if user_id is not None:
+            conditions.append('m.user_id = ?')
+            params.append(user_id)
+        
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            # Snippets come from the normalized body; markers are turned into
+            # <mark> after HTML escaping (markup.highlight_snippet)
+            cursor.execute(f'''
+                SELECT m.id, m.user_id, m.sender, m.message_type, m.timestamp, u.username,
+                       snippet(messages_fts, 0, ?, ?, '…', 12)
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                LEFT JOIN users u ON m.user_id = u.id
+                WHERE {' AND '.join(conditions)}
+                ORDER BY messages_fts.rank, m.id DESC
+                LIMIT ? OFFSET ?
+            ''', [MARK_START, MARK_END, *params, limit + 1, offset])
+            rows = cursor.fetchall()
+        
+        results = [{
+            'message_id': row[0],
+            'user_id': row[1],
+            'sender': row[2],
+            'message_type': row[3],
+            'timestamp': row[4],
+            'username': row[5] or 'کاربر',
+            'snippet': row[6]
+        } for row in rows[:limit]]
+        return {'results': results, 'has_more': len(rows) > limit}
+    
+    def rebuild_search_index(self, batch_size=5000):
+        """Re-index every message, e.g. after changing text_normalize."""
+        indexed = 0
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('DELETE FROM messages_fts')
+            last_id = 0
+            while True:
+                cursor.execute(
+                    "SELECT id, content FROM messages WHERE id > ? AND content != '' ORDER BY id LIMIT ?",
+                    (last_id, batch_size)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                cursor.executemany(
+                    'INSERT INTO messages_fts (rowid, body) VALUES (?, ?)',
+                    [(message_id, normalize_text(content)) for message_id, content in rows]
+                )
+                indexed += len(rows)
+                last_id = rows[-1][0]
+            cursor.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+            conn.commit()
+        return indexed
+    
+    @staticmethod
+    def _broadcast_filter(target, after_id=0):
+        """WHERE clause for a broadcast target; always in id order after after_id"""
+        kind = target.get('type')
+        if kind == 'all':
+            return 'id > ?', [after_id]
+        if kind == 'active':
+            # Older last_active values were written by Python isoformat ('T' separator)
+            return (
+                "id > ? AND (last_activity >= ? OR replace(last_active, 'T', ' ') >= ?)",
+                [after_id, target['since'], target['since']]
+            )
+        if kind == 'ids':
+            return 'id > ? AND id IN (SELECT value FROM json_each(?))', [after_id, json.dumps(target['ids'])]
+        raise ValueError(f'Unknown broadcast target: {kind}')
+    
+    def create_broadcast(self, target, message_type, content, file_path=None):
+        where, params = self._broadcast_filter(target)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(f'SELECT COUNT(*) FROM users WHERE {where}', params)
+            total = cursor.fetchone()[0]
+            cursor.execute('''
+                INSERT INTO broadcast_jobs (target, message_type, content, file_path, total)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (json.dumps(target), message_type, content, file_path, total))
+            job_id = cursor.lastrowid
+            conn.commit()
+        return {'id': job_id, 'total': total}
+    
+    def send_broadcast_chunk(self, job_id, limit=500):
+        """Insert the next chunk of a broadcast in one transaction.
+        
+        Returns the inserted (message_id, user_id) pairs; an empty list means
+        the job is finished or was cancelled. Progress is committed with the
+        rows, so a job resumed after a crash never sends a message twice.
+        """
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT target, message_type, content, file_path, last_user_id
+                FROM broadcast_jobs WHERE id = ? AND status IN ('pending', 'running')
+            ''', (job_id,))
+            job = cursor.fetchone()
+            if job is None:
+                conn.rollback()
+                return []
+            target, message_type, content, file_path, last_user_id = job
+            
+            where, params = self._broadcast_filter(json.loads(target), last_user_id)
+            cursor.execute(f'SELECT id FROM users WHERE {where} ORDER BY id LIMIT ?', (*params, limit))
+            user_ids = [row[0] for row in cursor.fetchall()]
+            if not user_ids:
+                cursor.execute('''
+                    UPDATE broadcast_jobs SET status = 'done', updated_at = CURRENT_TIMESTAMP,
+                                              finished_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (job_id,))
+                conn.commit()
+                return []
+            
+            # We hold the write lock, so every id above this one is from this chunk
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM messages')
+            previous_id = cursor.fetchone()[0]
+            content_html = render_message(message_type, content)
+            cursor.executemany('''
+                INSERT INTO messages (user_id, sender, message_type, content, file_path, content_html)
+                VALUES (?, 'admin', ?, ?, ?, ?)
+            ''', [(user_id, message_type, content, file_path, content_html) for user_id in user_ids])
+            if content:
+                cursor.execute(
+                    'INSERT INTO messages_fts (rowid, body) SELECT id, ? FROM messages WHERE id > ?',
+                    (normalize_text(content), previous_id)
+                )
+            cursor.execute('SELECT id, user_id FROM messages WHERE id > ? ORDER BY id', (previous_id,))
+            sent = cursor.fetchall()
+            
+            cursor.execute('''
+                UPDATE broadcast_jobs SET status = 'running', sent = sent + ?, last_user_id = ?,
+                                          updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (len(user_ids), user_ids[-1], job_id))
+            conn.commit()
+        return sent
+    
+    def fail_broadcast(self, job_id, error):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE broadcast_jobs SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP,
+                                          finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status IN ('pending', 'running')
+            ''', (error[:500], job_id))
+            conn.commit()
+    
+    def cancel_broadcast(self, job_id):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE broadcast_jobs SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP,
+                                          finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status IN ('pending', 'running')
+            ''', (job_id,))
+            conn.commit()
+        return cursor.rowcount > 0
+    
+    def claim_stale_broadcasts(self, older_than=60):
+        """Unfinished jobs whose worker stopped updating them (e.g. it was restarted)"""
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('''
+                SELECT id FROM broadcast_jobs
+                WHERE status IN ('pending', 'running') AND updated_at < datetime('now', ?)
+            ''', (f'-{int(older_than)} seconds',))
+            job_ids = [row[0] for row in cursor.fetchall()]
+            cursor.executemany(
+                'UPDATE broadcast_jobs SET updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                [(job_id,) for job_id in job_ids]
+            )
+            conn.commit()
+        return job_ids
+    
+    def get_broadcasts(self, limit=20, job_id=None):
+        condition = 'WHERE id = ?' if job_id is not None else ''
+        params = (job_id, limit) if job_id is not None else (limit,)
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(f'''
+                SELECT id, status, target, message_type, content, file_path, total, sent, error,
+                       created_at, updated_at, finished_at
+                FROM broadcast_jobs {condition}
+                ORDER BY id DESC LIMIT ?
+            ''', params)
+            rows = cursor.fetchall()
+        
+        return [{
+            'id': row[0],
+            'status': row[1],
+            'target': json.loads(row[2]),
+            'message_type': row[3],
+            'content': row[4],
+            'file_path': row[5],
+            'total': row[6],
+            'sent': row[7],
+            'error': row[8],
+            'created_at': row[9],
+            'updated_at': row[10],
+            'finished_at': row[11]
+        } for row in rows]
     
     def get_user_messages(self, user_id, limit=50):
         return self.get_messages(user_id=user_id, limit=limit)
     
-    def get_all_users(self):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def get_all_users(self, limit=None, offset=0, sort='activity'):
+        # Reads only the maintained summary columns on users (see migrations.py)
+        order_by = {
+            'activity': 'last_activity DESC, id DESC',
+            'created': 'id DESC',
+        }.get(sort, 'last_activity DESC, id DESC')
         
-        cursor.execute('''
-            SELECT u.id, u.session_id, u.username, u.ip_address,
-                   MAX(m.timestamp) as last_activity,
-                   COUNT(m.id) as message_count
-            FROM users u
-            LEFT JOIN messages m ON u.id = m.user_id
-            GROUP BY u.id, u.session_id, u.username, u.ip_address
-            ORDER BY last_activity DESC
-        ''')
-        
-        users = cursor.fetchall()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(f'''
+                SELECT id, session_id, username, ip_address,
+                       last_activity, message_count,
+                       last_message_preview, unread_admin_count
+                FROM users
+                ORDER BY {order_by}
+                LIMIT ? OFFSET ?
+            ''', (-1 if limit is None else limit, offset))
+            
+            users = cursor.fetchall()
         
         result = []
         for user in users:
@@ -163,18 +986,36 @@ class Database:
                 'username': user[2] or 'کاربر',
                 'ip_address': user[3],
                 'last_activity': user[4] or 'بدون فعالیت',
-                'message_count': user[5] or 0
+                'message_count': user[5] or 0,
+                'last_message_preview': user[6],
+                'unread_count': user[7] or 0
             })
         
         return result
     
+    def count_users(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT COUNT(*) FROM users')
+            return cursor.fetchone()[0]
+    
+    def mark_read_by_admin(self, user_id):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute(
+                'UPDATE users SET unread_admin_count = 0 WHERE id = ? AND unread_admin_count > 0',
+                (user_id,)
+            )
+            conn.commit()
+    
     def get_user_by_ip(self, ip_address):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT id, session_id, username FROM users WHERE ip_address = ?', (ip_address,))
-        user = cursor.fetchone()
-        conn.close()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT id, session_id, username FROM users WHERE ip_address = ?', (ip_address,))
+            user = cursor.fetchone()
         
         if user:
             return {
@@ -0,0 +1,171 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+
+class KeywordAutomaton:
+    """ماشین Aho-Corasick: همه کلمه‌های کلیدی در یک گذر روی متن پیدا می‌شوند
+
+    هزینه جستجو به طول متن و تعداد تطبیق‌ها بستگی دارد، نه به تعداد کلمه‌ها.
+    """
+
+    def __init__(self, keywords):
+        # keywords: لیست (کلمه، شماره قانون)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        for word, rule_id in keywords:
+            if not word:
+                continue
+            state = 0
+            for char in word:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][char] = next_state
+                state = next_state
+            self._out[state].append(rule_id)
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def first_rule(self, text):
+        """کوچک‌ترین شماره قانونی که یکی از کلمه‌هایش در متن هست (یا None)"""
+        best = None
+        state = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found = min(out[state])
+                if best is None or found < best:
+                    best = found
+                    if best == 0:
+                        break
+        return best
+
+
+class RuleSet:
+    """قوانین پاسخ محلی، تمیزکاری و پاسخ جایگزین که از فایل JSON خوانده می‌شوند
+
+    اولویت: قانونی که زودتر در فایل آمده (یا priority کوچک‌تر دارد) برنده است،
+    صرف نظر از جای کلمه در متن - همان رفتار حلقه‌های قبلی.
+    """
+
+    def __init__(self, data):
+        self.local_responses = self._ordered(data.get('local_responses', []))
+        self.decorations = self._ordered(data.get('response_decorations', []))
+        self.fallback_rules = self._ordered(data.get('fallback_rules', []))
+        self.fallback_responses = data.get('fallback_responses') or ['...']
+        self.unwanted_prefixes = list(data.get('unwanted_prefixes', []))
+
+        self._local = self._compile(self.local_responses)
+        self._decorations = self._compile(self.decorations)
+        self._fallback = self._compile(self.fallback_rules)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    @staticmethod
+    def _ordered(rules):
+        # مرتب‌سازی پایدار: priority صریح، بعد ترتیب فایل
+        return sorted(rules, key=lambda rule: rule.get('priority', 0))
+
+    @staticmethod
+    def _compile(rules):
+        return KeywordAutomaton(
+            (keyword.lower(), i) for i, rule in enumerate(rules) for keyword in rule['keywords']
+        )
+
+    @staticmethod
+    def _render(template):
+        return template.replace('{time}', datetime.now().strftime('%H:%M'))
+
+    def local_response(self, text):
+        rule_id = self._local.first_rule(text.lower())
+        if rule_id is None:
+            return None
+        return self._render(self.local_responses[rule_id]['response'])
+
+    def fallback_response(self, text=None):
+        if text:
+            rule_id = self._fallback.first_rule(text.lower())
+            if rule_id is not None:
+                return self._render(self.fallback_rules[rule_id]['response'])
+        return random.choice(self.fallback_responses)
+
+    def strip_prefixes(self, text):
+        # یک گذر به ترتیب فایل، مثل قبل: هر پیشوند حداکثر یک بار و فقط بعد از قبلی‌ها
+        # (فقط بررسی ابتدای متن است و به ماشین نیازی ندارد)
+        text = text.strip()
+        for prefix in self.unwanted_prefixes:
+            if text.startswith(prefix):
+                text = text[len(prefix):].strip()
+        return text
+
+    def decorate(self, text):
+        rule_id = self._decorations.first_rule(text.lower())
+        if rule_id is None:
+            return text
+        rule = self.decorations[rule_id]
+        if rule.get('unless') and rule['unless'] in text:
+            return text
+        if 'replace' in rule:
+            for keyword in rule['keywords']:
+                text = text.replace(keyword, rule['replace'])
+            return text
+        return text + rule.get('append', '')
+
+
+class ReloadableRuleSet:
+    """RuleSet که با تغییر فایل (در همه worker ها) خودکار دوباره بارگذاری می‌شود"""
+
+    def __init__(self, path, check_interval=5):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = 0
+        self._rules = None
+        self.reload()
+
+    def reload(self):
+        mtime = os.path.getmtime(self.path)
+        rules = RuleSet.load(self.path)
+        with self._lock:
+            self._rules, self._mtime = rules, mtime
+            self._checked_at = time.monotonic()
+        return rules
+
+    def get(self):
+        now = time.monotonic()
+        if now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            try:
+                if os.path.getmtime(self.path) != self._mtime:
+                    self.reload()
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                # فایل خراب یا در حال نوشتن است؛ قوانین قبلی می‌مانند
+                print(f"Rule reload error: {e}")
+        return self._rules
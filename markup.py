@@ -0,0 +1,43 @@
+import html
+import re
+
+# نشانگرهای snippet در FTS5 - کاراکترهای Private Use که در متن کاربر نمی‌آیند
+MARK_START = '\ue000'
+MARK_END = '\ue001'
+
+# الگوها یک بار کامپایل می‌شوند نه در هر فراخوانی
+_LATEX_BLOCK = re.compile(r'\$\$(.+?)\$\$', re.DOTALL)
+_LATEX_INLINE = re.compile(r'\$(.+?)\$')
+
+
+def _replace_latex_inline(match):
+    latex_code = match.group(1)
+    return f'<span class="latex">{latex_code}</span>'
+
+
+def _replace_latex_block(match):
+    latex_code = match.group(1)
+    return f'<div class="latex-block">{latex_code}</div>'
+
+
+def process_latex(text):
+    """تبدیل $...$ و $$...$$ به HTML قابل نمایش با MathJax/KaTeX"""
+    if not text:
+        return text
+    
+    text = _LATEX_BLOCK.sub(_replace_latex_block, text)
+    text = _LATEX_INLINE.sub(_replace_latex_inline, text)
+    
+    return text
+
+
+def render_message(message_type, content):
+    """HTML ذخیره شده کنار content؛ فقط پیام‌های متنی پردازش می‌شوند"""
+    if message_type == 'text' and content:
+        return process_latex(content)
+    return None
+
+
+def highlight_snippet(snippet):
+    """escape کردن snippet جستجو و تبدیل نشانگرها به <mark>"""
+    return html.escape(snippet or '').replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
@@ -0,0 +1,212 @@
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import threading
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # بدون Pillow فقط اندازه فایل ثبت می‌شود
+    Image = None
+
+IMAGE_TYPES = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+VIDEO_TYPES = {'mp4', 'avi', 'mov'}
+AUDIO_TYPES = {'mp3', 'wav'}
+MEDIA_TYPES = IMAGE_TYPES | VIDEO_TYPES | AUDIO_TYPES
+
+
+def is_media(file_path):
+    return bool(file_path) and file_path.rsplit('.', 1)[-1].lower() in MEDIA_TYPES
+
+
+def thumbnail_path(file_path, size, extension):
+    """thumbs/ab/cd/<sha256>_<size>.<ext> کنار blob اصلی"""
+    stem = file_path.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+    return f'thumbs/{stem[:2]}/{stem[2:4]}/{stem}_{size}.{extension}'
+
+
+def extract_media(root, file_path, size=320):
+    """ابعاد، مدت و اندازه فایل و در صورت امکان تصویر کوچک
+
+    در پروسه جدا اجرا می‌شود؛ پس فقط به ماژول‌های همین فایل وابسته است.
+    """
+    full = os.path.join(root, *file_path.split('/'))
+    extension = file_path.rsplit('.', 1)[-1].lower()
+    info = {
+        'size': os.path.getsize(full),
+        'width': None,
+        'height': None,
+        'duration': None,
+        'thumbnail_path': None
+    }
+
+    if extension in IMAGE_TYPES:
+        if Image is not None:
+            _image_info(root, full, file_path, size, info)
+    else:
+        _probe_info(full, info)
+        if extension in VIDEO_TYPES and info['width']:
+            _video_thumbnail(root, full, file_path, size, info)
+        if extension == 'wav' and info['duration'] is None:
+            with wave.open(full) as audio:
+                info['duration'] = audio.getnframes() / float(audio.getframerate())
+    return info
+
+
+def _write_atomic(root, relpath, save):
+    target = os.path.join(root, *relpath.split('/'))
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = f'{target}.{os.getpid()}.part'
+    save(partial)
+    os.replace(partial, target)
+
+
+def _image_info(root, full, file_path, size, info):
+    with Image.open(full) as image:
+        info['width'], info['height'] = image.size
+        if max(image.size) <= size:
+            # تصویر کوچک است؛ خود فایل همان پیش‌نمایش است
+            return
+        # اولین فریم GIF، با چرخش EXIF
+        image.seek(0)
+        thumb = ImageOps.exif_transpose(image.convert('RGBA' if 'A' in image.getbands() else 'RGB'))
+        thumb.thumbnail((size, size))
+        relpath = thumbnail_path(file_path, size, 'webp')
+        _write_atomic(root, relpath, lambda path: thumb.save(path, 'WEBP', quality=80))
+        info['thumbnail_path'] = relpath
+
+
+def _probe_info(full, info):
+    if not shutil.which('ffprobe'):
+        return
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', full],
+        capture_output=True, timeout=30, check=True
+    )
+    probe = json.loads(result.stdout or b'{}')
+    duration = (probe.get('format') or {}).get('duration')
+    if duration:
+        info['duration'] = float(duration)
+    for stream in probe.get('streams') or []:
+        if stream.get('codec_type') == 'video' and stream.get('width'):
+            info['width'], info['height'] = stream['width'], stream['height']
+            break
+
+
+def _video_thumbnail(root, full, file_path, size, info):
+    if not shutil.which('ffmpeg'):
+        return
+    # فریم اول اغلب سیاه است
+    offset = min(1.0, (info['duration'] or 0) / 2)
+    relpath = thumbnail_path(file_path, size, 'jpg')
+    _write_atomic(root, relpath, lambda path: subprocess.run(
+        ['ffmpeg', '-v', 'error', '-y', '-ss', f'{offset:.2f}', '-i', full, '-frames:v', '1',
+         '-vf', f"scale='min({size},iw)':-2", '-f', 'image2', path],
+        capture_output=True, timeout=60, check=True
+    ))
+    info['thumbnail_path'] = relpath
+
+
+class MediaProcessor:
+    """صف پایدار کارهای پیش‌نمایش در SQLite و اجرای آن‌ها در استخر پروسه
+
+    آپلود فقط یک ردیف pending در جدول media می‌سازد. نخ dispatcher کارها را
+    به صورت اتمیک برمی‌دارد (پس چند worker gunicorn با هم تداخل ندارند) و
+    نتیجه را در همان ردیف ذخیره می‌کند.
+    """
+
+    def __init__(self, db, root, workers=2, thumb_size=320, poll_interval=2.0,
+                 max_attempts=3, stale_after=600, requeue_interval=60):
+        self.db = db
+        self.root = root
+        self.workers = workers
+        self.thumb_size = thumb_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self.requeue_interval = requeue_interval
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._slots = threading.Semaphore(workers)
+        self._pool = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, file_path):
+        """ثبت کار برای فایل جدید (فایل تکراری دوباره پردازش نمی‌شود)"""
+        if not is_media(file_path):
+            return
+        self.db.enqueue_media(file_path)
+        self.start()
+        self._wakeup.set()
+
+    def start(self):
+        # با spawn، ماژول اصلی (مثلاً app.py) در پروسه‌های استخر دوباره import می‌شود
+        if self._thread or multiprocessing.parent_process() is not None:
+            return
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._dispatch, name='media-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _dispatch(self):
+        next_requeue = 0
+        while not self._stopped.is_set():
+            # کارهایی که پروسه‌ای (این worker یا worker دیگر) وسط انجامشان از کار افتاد
+            if time.monotonic() >= next_requeue:
+                try:
+                    self.db.requeue_stale_media(self.stale_after)
+                except Exception as e:
+                    print(f"Media queue error: {e}")
+                next_requeue = time.monotonic() + self.requeue_interval
+            self._slots.acquire()
+            if self._stopped.is_set():
+                return
+            try:
+                jobs = self.db.claim_media_jobs(1)
+            except Exception as e:
+                print(f"Media queue error: {e}")
+                jobs = []
+            if not jobs:
+                self._slots.release()
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            file_path = jobs[0]
+            if self._pool is None:
+                # spawn: fork کردن پروسه‌ای که نخ دارد امن نیست
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            try:
+                future = self._pool.submit(extract_media, self.root, file_path, self.thumb_size)
+            except RuntimeError:
+                # استخر در حال بسته شدن است
+                self._slots.release()
+                return
+            future.add_done_callback(lambda f, path=file_path: self._finish(path, f))
+
+    def _finish(self, file_path, future):
+        try:
+            self.db.finish_media(file_path, future.result())
+        except Exception as e:
+            print(f"Media job error ({file_path}): {e}")
+            try:
+                self.db.fail_media(file_path, str(e), self.max_attempts)
+            except Exception as db_error:
+                print(f"Media queue error: {db_error}")
+        finally:
+            self._slots.release()
+            self._wakeup.set()
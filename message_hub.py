@@ -0,0 +1,129 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+class MessageHub:
+    """هاب انتشار/اشتراک پیام‌های جدید برای اتصال‌های SSE
+
+    انتشار در همین پروسه فوراً منتظرها را بیدار می‌کند. برای کار با چند
+    worker در gunicorn، یک نخ پس‌زمینه جدول messages را به عنوان لاگ
+    اعلان‌ها دنبال می‌کند تا پیام‌هایی که worker دیگری ذخیره کرده هم
+    دیده شوند.
+
+    آخرین پیام فقط برای max_users کاربر اخیر نگه داشته می‌شود (LRU)؛ کاربری
+    که منتظر است بیرون نمی‌رود و کاربر بیرون رفته یک بار بیدار می‌شود تا از
+    دیتابیس بخواند.
+    """
+
+    def __init__(self, db, poll_interval=0.5, max_users=10000, batch_size=1000):
+        self.db = db
+        self.poll_interval = poll_interval
+        self.max_users = max_users
+        self.batch_size = batch_size
+        self._cond = threading.Condition()
+        self._latest_by_user = OrderedDict()
+        self._waiting = Counter()
+        # بزرگ‌ترین شناسه‌ای که با بیرون رفتن کاربری از حافظه فراموش شده
+        self._evicted_id = 0
+        self._latest = 0
+        # مکان خواندن watcher؛ جدا از _latest که publish همین worker هم جلو می‌برد
+        self._watched_id = 0
+        self._watcher = None
+        self._stopped = threading.Event()
+
+    def publish(self, user_id, message_id):
+        """اعلام یک پیام جدید (بعد از Database.save_message)"""
+        with self._cond:
+            self._record(user_id, message_id)
+            self._cond.notify_all()
+
+    def publish_many(self, messages):
+        """اعلام چند پیام (message_id, user_id) با یک بار بیدار کردن منتظرها"""
+        with self._cond:
+            for message_id, user_id in messages:
+                self._record(user_id, message_id)
+            self._cond.notify_all()
+
+    def wait(self, user_id, since_id, timeout):
+        """تا رسیدن پیامی جدیدتر از since_id یا پایان timeout صبر کن
+
+        اگر user_id خالی باشد، هر پیام جدیدی منتظر را بیدار می‌کند.
+        """
+        self._ensure_watcher()
+        with self._cond:
+            if user_id is not None:
+                if user_id not in self._latest_by_user:
+                    self._latest_by_user[user_id] = since_id
+                    if self._evicted_id > since_id:
+                        # شاید پیامش همراه کاربر از حافظه بیرون رفته باشد
+                        return True
+                self._latest_by_user.move_to_end(user_id)
+                self._waiting[user_id] += 1
+            try:
+                return self._cond.wait_for(
+                    lambda: self._latest_for(user_id) > since_id or self._stopped.is_set(),
+                    timeout
+                )
+            finally:
+                if user_id is not None:
+                    self._waiting[user_id] -= 1
+                    if not self._waiting[user_id]:
+                        del self._waiting[user_id]
+
+    def stop(self):
+        self._stopped.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _latest_for(self, user_id):
+        if user_id is None:
+            return self._latest
+        return self._latest_by_user.get(user_id, 0)
+
+    def _record(self, user_id, message_id):
+        if message_id > self._latest_by_user.get(user_id, 0):
+            self._latest_by_user[user_id] = message_id
+        self._latest_by_user.move_to_end(user_id)
+        if message_id > self._latest:
+            self._latest = message_id
+        self._evict()
+
+    def _evict(self):
+        # کاربران منتظر به انتهای صف برمی‌گردند؛ حداقل یک کاربر غیرمنتظر لازم است
+        while (len(self._latest_by_user) > self.max_users
+               and len(self._waiting) < len(self._latest_by_user)):
+            user_id, latest = self._latest_by_user.popitem(last=False)
+            if user_id in self._waiting:
+                self._latest_by_user[user_id] = latest
+            elif latest > self._evicted_id:
+                self._evicted_id = latest
+
+    def _ensure_watcher(self):
+        if self._watcher is not None:
+            return
+        with self._cond:
+            if self._watcher is None:
+                self._watched_id = self.db.get_latest_message_id()
+                self._latest = max(self._latest, self._watched_id)
+                self._watcher = threading.Thread(
+                    target=self._watch, name='message-hub-watcher', daemon=True
+                )
+                self._watcher.start()
+
+    def _watch(self):
+        """دنبال کردن پیام‌هایی که worker های دیگر نوشته‌اند"""
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                latest = self.db.get_latest_message_id()
+                while latest > self._watched_id:
+                    # پیام همگانی ممکن است هزاران ردیف باشد؛ دسته به دسته
+                    new_rows = self.db.get_message_ids_since(self._watched_id, self.batch_size)
+                    self._watched_id = new_rows[-1][0] if new_rows else latest
+                    with self._cond:
+                        for message_id, user_id in new_rows:
+                            self._record(user_id, message_id)
+                        self._cond.notify_all()
+            except Exception as e:
+                print(f"MessageHub watcher error: {e}")
+                time.sleep(self.poll_interval)
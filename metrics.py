@@ -0,0 +1,256 @@
+import functools
+import math
+import re
+import threading
+import time
+
+# مرزهای پیش‌فرض هیستوگرام (ثانیه)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+# رشته‌های داخل SQL (متن پیام‌ها) در لاگ نوشته نمی‌شوند
+_SQL_LITERAL = re.compile(r"'(?:[^']|'')*'")
+
+# سقف رویدادهای ثبت شده برای یک درخواست در لاگ درخواست‌های کند
+MAX_TRACE_EVENTS = 200
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = self.header()
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            item = self._values.get(key)
+            if item is None:
+                # [شمارنده هر bucket (غیر تجمعی)، مجموع]
+                item = self._values[key] = [[0] * len(self.buckets), 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    item[0][i] += 1
+                    break
+            item[1] += value
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = self.header()
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Callback(_Metric):
+    """مقدار هنگام scrape خوانده می‌شود - برای آماری که جای دیگری نگه داشته می‌شود
+
+    function یک عدد یا dict از (مقادیر label) به عدد برمی‌گرداند.
+    """
+
+    def __init__(self, name, documentation, function, kind='gauge', labelnames=(), registry=None):
+        self.kind = kind
+        self.function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def render(self):
+        try:
+            values = self.function()
+        except Exception as e:
+            print(f"Metrics callback error ({self.name}): {e}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines = self.header()
+        for key, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self):
+        """خروجی در قالب متنی Prometheus (text/plain; version=0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# هر پروسه (worker) آمار خودش را دارد
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds', 'HTTP request latency by route', ('method', 'route', 'status')
+)
+HTTP_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests currently being handled')
+DB_METHOD_SECONDS = Histogram(
+    'db_method_duration_seconds', 'Database method latency', ('method',), buckets=DB_BUCKETS
+)
+DB_METHOD_ERRORS = Counter('db_method_errors_total', 'Database methods that raised', ('method',))
+AI_CALL_SECONDS = Histogram(
+    'ai_api_call_duration_seconds', 'Latency of each HTTP attempt to the AI API (headers for streams)',
+    ('kind', 'status')
+)
+AI_CALLS_REJECTED = Counter(
+    'ai_api_calls_rejected_total', 'AI calls not sent (circuit open or local rate limit)', ('reason',)
+)
+AI_RESPONSES = Counter('ai_responses_total', 'AI replies by where they came from', ('mode', 'source'))
+ADMISSION_REJECTED = Counter(
+    'admission_rejected_total', 'Requests shed by admission control', ('kind', 'reason')
+)
+
+
+# ---------- لاگ درخواست‌های کند ----------
+
+_trace = threading.local()
+
+
+def start_trace():
+    _trace.events = []
+
+
+def end_trace():
+    events = getattr(_trace, 'events', None)
+    _trace.events = None
+    return events
+
+
+def trace_event(kind, name, seconds=None):
+    """ثبت یک رویداد (query، متد دیتابیس، تماس AI) در درخواست جاری اگر ردیابی فعال است"""
+    events = getattr(_trace, 'events', None)
+    if events is not None and len(events) < MAX_TRACE_EVENTS:
+        events.append((kind, name, None if seconds is None else round(seconds * 1000, 3)))
+
+
+def trace_sql(statement):
+    """برای Connection.set_trace_callback - متن هر دستور SQL اجرا شده"""
+    events = getattr(_trace, 'events', None)
+    if events is None:
+        return
+    # دستورهای داخلی trigger ها و جدول FTS با -- شروع می‌شوند
+    if statement.startswith('--'):
+        return
+    statement = _SQL_LITERAL.sub('?', ' '.join(statement.split()))[:500]
+    if events and events[-1][:2] == ('sql', statement):
+        return
+    trace_event('sql', statement)
+
+
+def instrument_methods(obj, histogram, errors=None, exclude=()):
+    """زمان‌گیری همه متدهای عمومی یک شیء (روی خود نمونه، نه کلاس)"""
+    for name in dir(type(obj)):
+        if name.startswith('_') or name in exclude:
+            continue
+        method = getattr(obj, name)
+        if not callable(method):
+            continue
+        setattr(obj, name, _timed(method, name, histogram, errors))
+    return obj
+
+
+def _timed(method, name, histogram, errors):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            if errors is not None:
+                errors.inc(method=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            histogram.observe(elapsed, method=name)
+            trace_event('db', name, elapsed)
+    return wrapper
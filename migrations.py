@@ -0,0 +1,253 @@
+"""Versioned schema migrations for the chat database.
+
+Each migration runs once, in order, inside its own write transaction and
+bumps ``PRAGMA user_version`` to its number. New schema changes are added
+by appending to ``MIGRATIONS``; existing entries must never be edited.
+"""
+from text_normalize import normalize_text
+
+
+def _column_names(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+    return {column[1] for column in cursor.fetchall()}
+
+
+def _add_users_ip_address(cursor):
+    # Databases created before ip_address was part of CREATE TABLE
+    if 'ip_address' not in _column_names(cursor, 'users'):
+        cursor.execute('ALTER TABLE users ADD COLUMN ip_address TEXT')
+
+
+def _add_user_activity_summary(cursor):
+    # Denormalized per-user summary so the admin list never aggregates messages
+    columns = _column_names(cursor, 'users')
+    for name, ddl in (
+        ('last_activity', 'TIMESTAMP'),
+        ('message_count', 'INTEGER NOT NULL DEFAULT 0'),
+        ('last_message_preview', 'TEXT'),
+        ('unread_admin_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ):
+        if name not in columns:
+            cursor.execute(f'ALTER TABLE users ADD COLUMN {name} {ddl}')
+
+    # One-time backfill from existing messages
+    cursor.execute('''
+        UPDATE users SET
+            last_activity = (SELECT MAX(m.timestamp) FROM messages m WHERE m.user_id = users.id),
+            message_count = (SELECT COUNT(*) FROM messages m WHERE m.user_id = users.id),
+            last_message_preview = (
+                SELECT substr(COALESCE(NULLIF(m.content, ''), m.message_type), 1, 100)
+                FROM messages m WHERE m.user_id = users.id
+                ORDER BY m.id DESC LIMIT 1
+            ),
+            unread_admin_count = (
+                SELECT COUNT(*) FROM messages m
+                WHERE m.user_id = users.id AND m.sender = 'user'
+                  AND m.id > COALESCE((
+                      SELECT MAX(a.id) FROM messages a
+                      WHERE a.user_id = users.id AND a.sender = 'admin'
+                  ), 0)
+            )
+    ''')
+
+    # Kept up to date in the same transaction as every insert/delete
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_summary_insert
+        AFTER INSERT ON messages
+        BEGIN
+            UPDATE users SET
+                last_activity = NEW.timestamp,
+                message_count = message_count + 1,
+                last_message_preview = substr(COALESCE(NULLIF(NEW.content, ''), NEW.message_type), 1, 100),
+                unread_admin_count = CASE
+                    WHEN NEW.sender = 'user' THEN unread_admin_count + 1
+                    WHEN NEW.sender = 'admin' THEN 0
+                    ELSE unread_admin_count
+                END
+            WHERE id = NEW.user_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_summary_delete
+        AFTER DELETE ON messages
+        BEGIN
+            UPDATE users SET message_count = MAX(message_count - 1, 0)
+            WHERE id = OLD.user_id;
+        END
+    ''')
+    cursor.execute(
+        'CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users (last_activity DESC, id DESC)'
+    )
+
+
+def _add_message_search(cursor):
+    # Full-text index over normalized content; rowid is messages.id.
+    # unicode61 splits on Arabic diacritics and ZWNJ, so rows are stored
+    # through normalize_text and queries must be normalized the same way.
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+        USING fts5(body, tokenize = 'unicode61 remove_diacritics 2')
+    ''')
+    # Inserts are indexed by Database.save_message (needs Python normalization);
+    # deletes only need the rowid so a trigger covers every code path
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete
+        AFTER DELETE ON messages
+        BEGIN
+            DELETE FROM messages_fts WHERE rowid = OLD.id;
+        END
+    ''')
+
+    last_id = 0
+    while True:
+        rows = cursor.execute(
+            "SELECT id, content FROM messages WHERE id > ? AND content != '' ORDER BY id LIMIT 5000",
+            (last_id,)
+        ).fetchall()
+        if not rows:
+            break
+        cursor.executemany(
+            'INSERT INTO messages_fts (rowid, body) VALUES (?, ?)',
+            [(message_id, normalize_text(content)) for message_id, content in rows]
+        )
+        last_id = rows[-1][0]
+
+
+def _recompute_summary_on_delete(cursor):
+    # The version 3 delete trigger only decremented message_count, so deleting
+    # a user's newest message left its preview and last_activity behind
+    cursor.execute('DROP TRIGGER IF EXISTS trg_messages_summary_delete')
+    cursor.execute('''
+        CREATE TRIGGER trg_messages_summary_delete
+        AFTER DELETE ON messages
+        BEGIN
+            UPDATE users SET message_count = MAX(message_count - 1, 0)
+            WHERE id = OLD.user_id;
+            -- Only when the newest message went; retention deletes the oldest ones
+            UPDATE users SET
+                last_activity = (SELECT MAX(m.timestamp) FROM messages m WHERE m.user_id = users.id),
+                last_message_preview = (
+                    SELECT substr(COALESCE(NULLIF(m.content, ''), m.message_type), 1, 100)
+                    FROM messages m WHERE m.user_id = users.id
+                    ORDER BY m.id DESC LIMIT 1
+                )
+            WHERE id = OLD.user_id
+              AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.user_id = OLD.user_id AND m.id > OLD.id);
+        END
+    ''')
+
+    # Repair summaries left stale by the old trigger
+    cursor.execute('''
+        UPDATE users SET
+            last_activity = (SELECT MAX(m.timestamp) FROM messages m WHERE m.user_id = users.id),
+            message_count = (SELECT COUNT(*) FROM messages m WHERE m.user_id = users.id),
+            last_message_preview = (
+                SELECT substr(COALESCE(NULLIF(m.content, ''), m.message_type), 1, 100)
+                FROM messages m WHERE m.user_id = users.id
+                ORDER BY m.id DESC LIMIT 1
+            )
+    ''')
+
+
+MIGRATIONS = [
+    (1, _add_users_ip_address),
+    (2, [
+        'CREATE INDEX IF NOT EXISTS idx_messages_user_id_id ON messages (user_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_user_id_timestamp ON messages (user_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_users_ip_address ON users (ip_address)',
+    ]),
+    (3, _add_user_activity_summary),
+    (4, [
+        # Rolling summary of the turns that no longer fit in the AI context window
+        '''CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            through_message_id INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )''',
+    ]),
+    # Rendered HTML stored next to content; old rows are filled lazily on read
+    (5, ['ALTER TABLE messages ADD COLUMN content_html TEXT']),
+    # Reference counts for content-addressed upload blobs
+    (6, [
+        'CREATE INDEX IF NOT EXISTS idx_messages_file_path ON messages (file_path) '
+        'WHERE file_path IS NOT NULL',
+    ]),
+    # Thumbnail/metadata job queue and results, one row per upload blob
+    (7, [
+        '''CREATE TABLE IF NOT EXISTS media (
+            file_path TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            thumbnail_path TEXT,
+            width INTEGER,
+            height INTEGER,
+            duration REAL,
+            size INTEGER,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_media_status ON media (status, created_at)',
+    ]),
+    (8, _add_message_search),
+    # Admin broadcasts; last_user_id is the resume cursor (users are sent in id order)
+    (9, [
+        '''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            target TEXT NOT NULL,
+            message_type TEXT NOT NULL,
+            content TEXT,
+            file_path TEXT,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )''',
+        'CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status, updated_at)',
+    ]),
+    (10, _recompute_summary_on_delete),
+]
+
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply every pending migration; safe to call from several workers at once"""
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, step in MIGRATIONS:
+            if get_version(conn) >= version:
+                continue
+
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                # Another worker may have applied it while we waited for the lock
+                if get_version(conn) >= version:
+                    cursor.execute('ROLLBACK')
+                    continue
+
+                if callable(step):
+                    step(cursor)
+                else:
+                    for statement in step:
+                        cursor.execute(statement)
+
+                cursor.execute(f'PRAGMA user_version = {int(version)}')
+                cursor.execute('COMMIT')
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+
+    return get_version(conn)
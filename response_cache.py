@@ -0,0 +1,277 @@
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from text_normalize import normalize_text
+
+_TRAILING_PUNCTUATION = re.compile(r'[\s?!.,;:؟،؛!]+$')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt):
+    """متن سوال را طوری یکسان کن که سوال‌های تقریباً یکسان یک کلید بگیرند"""
+    text = _WHITESPACE.sub(' ', normalize_text(prompt)).strip()
+    return _TRAILING_PUNCTUATION.sub('', text)
+
+
+# هر چند بار ذخیره، ردیف‌های منقضی و اضافه لایه SQLite پاک می‌شوند
+PRUNE_EVERY = 100
+# فاصله بررسی شماره purge مشترک (ثانیه)
+GENERATION_CHECK_INTERVAL = 1.0
+
+
+class ResponseCache:
+    """کش پاسخ‌های هوش مصنوعی: LRU در حافظه با TTL و لایه اختیاری SQLite
+
+    لایه SQLite بین worker های gunicorn مشترک است و بعد از ری‌استارت هم می‌ماند.
+    اندازه آن با disk_max_entries و disk_max_bytes محدود است (قدیمی‌ترها حذف
+    می‌شوند). هر purge شماره نسل مشترکی را در همان فایل بالا می‌برد و worker های
+    دیگر با دیدن آن لایه حافظه خودشان را خالی می‌کنند.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=8 * 1024 * 1024, ttl=86400, db_path=None,
+                 disk_max_entries=20000, disk_max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.db_path = db_path
+        self.disk_max_entries = disk_max_entries
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()  # لایه حافظه و آمار
+        self._disk_lock = threading.Lock()  # اتصال SQLite؛ هیچ وقت همراه _lock گرفته نمی‌شود
+        self._stats = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0}
+        self._conn = None
+        self._generation = 0
+        self._generation_checked = 0
+        self._stores_since_prune = 0
+        if db_path:
+            self._conn = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode = WAL')
+            self._conn.execute('PRAGMA synchronous = NORMAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS ai_cache (
+                    key TEXT PRIMARY KEY,
+                    prompt TEXT,
+                    response TEXT,
+                    created_at REAL,
+                    expires_at REAL
+                )
+            ''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_ai_cache_expires_at ON ai_cache (expires_at)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS ai_cache_meta (name TEXT PRIMARY KEY, value INTEGER)'
+            )
+            self._conn.commit()
+            self._generation = self._read_generation()
+
+    @staticmethod
+    def make_key(prompt, model, system_prompt, context=None):
+        parts = [normalize_prompt(prompt), model or '', system_prompt or '', context or '']
+        return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        self._check_generation(now)
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                if item[1] > now:
+                    self._memory.move_to_end(key)
+                    self._stats['hits'] += 1
+                    self._stats['memory_hits'] += 1
+                    return item[0]
+                self._evict(key)
+            generation = self._generation
+
+        row = None
+        if self._conn is not None:
+            try:
+                with self._disk_lock:
+                    row = self._conn.execute(
+                        'SELECT prompt, response, expires_at FROM ai_cache WHERE key = ? AND expires_at > ?',
+                        (key, now)
+                    ).fetchone()
+            except sqlite3.Error as e:
+                print(f"Response cache read error: {e}")
+
+        with self._lock:
+            if row:
+                # ردیفی که پیش از یک purge همزمان خوانده شده به حافظه برنمی‌گردد
+                if self._generation == generation:
+                    self._store_memory(key, row[1], row[2], row[0])
+                self._stats['hits'] += 1
+                self._stats['disk_hits'] += 1
+                return row[1]
+            self._stats['misses'] += 1
+            return None
+
+    def set(self, key, prompt, response):
+        now = time.time()
+        expires_at = now + self.ttl
+        with self._lock:
+            self._store_memory(key, response, expires_at, prompt)
+            self._stats['stores'] += 1
+        if self._conn is None:
+            return
+        try:
+            with self._disk_lock:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO ai_cache (key, prompt, response, created_at, expires_at) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, prompt, response, now, expires_at)
+                )
+                self._conn.commit()
+                self._stores_since_prune += 1
+                if self._stores_since_prune >= PRUNE_EVERY:
+                    self._prune_disk(now)
+        except sqlite3.Error as e:
+            print(f"Response cache write error: {e}")
+
+    def purge(self, key=None):
+        """حذف یک کلید یا کل کش از هر دو لایه
+
+        لایه حافظه worker های دیگر حداکثر GENERATION_CHECK_INTERVAL ثانیه بعد
+        (با اولین get) کامل خالی می‌شود.
+        """
+        removed = 0
+        generation = None
+        if self._conn is not None:
+            try:
+                with self._disk_lock:
+                    if key is None:
+                        cursor = self._conn.execute('DELETE FROM ai_cache')
+                    else:
+                        cursor = self._conn.execute('DELETE FROM ai_cache WHERE key = ?', (key,))
+                    removed = cursor.rowcount
+                    self._conn.execute(
+                        "INSERT INTO ai_cache_meta (name, value) VALUES ('generation', 1) "
+                        "ON CONFLICT(name) DO UPDATE SET value = value + 1"
+                    )
+                    self._conn.commit()
+                    generation = self._read_generation()
+            except sqlite3.Error as e:
+                print(f"Response cache write error: {e}")
+
+        # حافظه بعد از دیسک پاک می‌شود تا get همزمان ردیف حذف شده را برنگرداند
+        with self._lock:
+            if key is None:
+                removed = max(removed, len(self._memory))
+                self._memory.clear()
+                self._bytes = 0
+            else:
+                removed = max(removed, 1 if key in self._memory else 0)
+                self._evict(key)
+            if generation is not None:
+                # حافظه همین worker همین الان پاک شد
+                self._generation = generation
+        return removed
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            for key in [k for k, item in self._memory.items() if item[1] <= now]:
+                self._evict(key)
+        if self._conn is not None:
+            try:
+                with self._disk_lock:
+                    self._prune_disk(now)
+            except sqlite3.Error as e:
+                print(f"Response cache write error: {e}")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._bytes
+        if self._conn is not None:
+            try:
+                with self._disk_lock:
+                    stats['disk_entries'] = self._conn.execute('SELECT COUNT(*) FROM ai_cache').fetchone()[0]
+            except sqlite3.Error as e:
+                print(f"Response cache read error: {e}")
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def entries(self, limit=50):
+        """آخرین موارد کش برای نمایش در پنل ادمین"""
+        if self._conn is not None:
+            with self._disk_lock:
+                rows = self._conn.execute(
+                    'SELECT key, prompt, response, expires_at FROM ai_cache '
+                    'ORDER BY created_at DESC LIMIT ?', (limit,)
+                ).fetchall()
+        else:
+            with self._lock:
+                rows = [(key, item[2], item[0], item[1])
+                        for key, item in reversed(self._memory.items())][:limit]
+        return [
+            {'key': key, 'prompt': prompt, 'response': response, 'expires_at': expires_at}
+            for key, prompt, response, expires_at in rows
+        ]
+
+    def close(self):
+        with self._disk_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _read_generation(self):
+        row = self._conn.execute("SELECT value FROM ai_cache_meta WHERE name = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def _check_generation(self, now):
+        """اگر worker دیگری purge کرده، لایه حافظه این worker هم خالی شود"""
+        if self._conn is None:
+            return
+        with self._lock:
+            if now - self._generation_checked < GENERATION_CHECK_INTERVAL:
+                return
+            self._generation_checked = now
+            known = self._generation
+        try:
+            with self._disk_lock:
+                generation = self._read_generation()
+        except sqlite3.Error as e:
+            print(f"Response cache read error: {e}")
+            return
+        with self._lock:
+            # اگر purge همین worker در این فاصله شماره را عوض کرده، آن جدیدتر است
+            if generation != known and self._generation == known:
+                self._memory.clear()
+                self._bytes = 0
+                self._generation = generation
+
+    def _prune_disk(self, now):
+        """حذف ردیف‌های منقضی و قدیمی‌ترین‌ها تا سقف تعداد و حجم لایه SQLite (زیر _disk_lock)"""
+        self._stores_since_prune = 0
+        self._conn.execute('''
+            DELETE FROM ai_cache WHERE expires_at <= ? OR key IN (
+                SELECT key FROM (
+                    SELECT key,
+                           ROW_NUMBER() OVER newest AS position,
+                           SUM(length(CAST(response AS BLOB)) + length(CAST(prompt AS BLOB))) OVER newest AS size
+                    FROM ai_cache
+                    WINDOW newest AS (ORDER BY created_at DESC)
+                )
+                WHERE position > ? OR size > ?
+            )
+        ''', (now, self.disk_max_entries, self.disk_max_bytes))
+        self._conn.commit()
+
+    def _store_memory(self, key, response, expires_at, prompt):
+        self._evict(key)
+        self._memory[key] = (response, expires_at, prompt)
+        self._bytes += len(response.encode('utf-8'))
+        while self._memory and (len(self._memory) > self.max_entries or self._bytes > self.max_bytes):
+            self._evict(next(iter(self._memory)))
+
+    def _evict(self, key):
+        item = self._memory.pop(key, None)
+        if item is not None:
+            self._bytes -= len(item[0].encode('utf-8'))
@@ -0,0 +1,313 @@
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+try:
+    import fcntl
+except ImportError:  # ویندوز؛ قفل بین پروسه‌ها نداریم
+    fcntl = None
+
+try:
+    import zstandard
+except ImportError:  # بدون zstandard فقط gzip
+    zstandard = None
+
+MESSAGE_COLUMNS = ('id', 'user_id', 'sender', 'message_type', 'content', 'file_path', 'timestamp')
+USER_COLUMNS = ('id', 'session_id', 'username', 'ip_address', 'created_at', 'last_active',
+                'last_activity', 'message_count')
+
+
+# last_active قدیمی با isoformat پایتون (جداکننده 'T') نوشته شده؛ مثل بقیه ستون‌ها مقایسه شود
+LAST_ACTIVE = "replace(last_active, 'T', ' ')"
+
+
+def _cutoff(**delta):
+    # هم‌قالب CURRENT_TIMESTAMP (UTC) که timestamp پیام‌ها و last_active با آن نوشته می‌شوند
+    return (datetime.now(timezone.utc) - timedelta(**delta)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class Retention:
+    """انتقال داده‌های قدیمی از دیتابیس اصلی به آرشیو فشرده و فشرده‌سازی فایل
+
+    - پیام‌های قدیمی‌تر از message_days در فایل‌های JSONL ماهانه
+      (messages-YYYY-MM.jsonl.gz) آرشیو و حذف می‌شوند.
+    - کاربرانی که inactive_user_days هیچ فعالیتی نداشته‌اند با همه پیام‌هایشان
+      آرشیو و حذف می‌شوند (users-YYYY-MM.jsonl.gz).
+    - session هایی که هیچ پیامی نفرستاده‌اند بعد از empty_session_hours حذف
+      می‌شوند (آرشیو نمی‌شوند).
+
+    هر دسته یک تراکنش کوتاه است و بین دسته‌ها مکث می‌شود تا قفل نوشتن آزاد
+    شود. آرشیو قبل از حذف fsync می‌شود؛ اگر پروسه بین این دو از کار بیفتد،
+    همان ردیف‌ها در اجرای بعد دوباره آرشیو می‌شوند (id در هر رکورد هست).
+    ایندکس جستجو و شمارنده‌های کاربر با trigger ها به‌روز می‌شوند و blob های
+    بدون ارجاع با gc-uploads پاک می‌شوند.
+    """
+
+    def __init__(self, db, archive_dir, message_days=365, inactive_user_days=180,
+                 empty_session_hours=24, compression='gzip', batch_size=500,
+                 batch_pause=0.05, vacuum_pages=1000, lock_path=None):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.message_days = message_days
+        self.inactive_user_days = inactive_user_days
+        self.empty_session_hours = empty_session_hours
+        if compression == 'zstd' and zstandard is None:
+            print("Retention: zstandard is not installed, archiving with gzip")
+            compression = 'gzip'
+        self.compression = compression
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.vacuum_pages = vacuum_pages
+        self.lock_path = lock_path or os.path.join(archive_dir, 'retention.lock')
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # ---------- اجرا ----------
+
+    def run(self):
+        """یک دور کامل؛ اگر پروسه دیگری در حال اجراست None برمی‌گرداند"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return None
+
+            stats = {'messages_archived': 0, 'users_archived': 0, 'sessions_deleted': 0,
+                     'pages_freed': 0}
+            if self.inactive_user_days:
+                self._archive_inactive_users(_cutoff(days=self.inactive_user_days), stats)
+            if self.message_days:
+                stats['messages_archived'] += self._archive_old_messages(_cutoff(days=self.message_days))
+            if self.empty_session_hours:
+                stats['sessions_deleted'] = self._delete_empty_sessions(
+                    _cutoff(hours=self.empty_session_hours)
+                )
+            stats['pages_freed'] = self.compact()
+            return stats
+
+    def preview(self):
+        """تعداد ردیف‌هایی که اجرای بعدی برمی‌دارد، بدون تغییر (برای --dry-run)"""
+        counts = {'messages': 0, 'inactive_users': 0, 'empty_sessions': 0}
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            if self.message_days:
+                cursor.execute('SELECT COUNT(*) FROM messages WHERE timestamp < ?',
+                               (_cutoff(days=self.message_days),))
+                counts['messages'] = cursor.fetchone()[0]
+            if self.inactive_user_days:
+                cutoff = _cutoff(days=self.inactive_user_days)
+                cursor.execute(f'SELECT COUNT(*) FROM users WHERE last_activity < ? AND {LAST_ACTIVE} < ?',
+                               (cutoff, cutoff))
+                counts['inactive_users'] = cursor.fetchone()[0]
+            if self.empty_session_hours:
+                cursor.execute(f'SELECT COUNT(*) FROM users WHERE last_activity IS NULL AND {LAST_ACTIVE} < ?',
+                               (_cutoff(hours=self.empty_session_hours),))
+                counts['empty_sessions'] = cursor.fetchone()[0]
+        return counts
+
+    def start(self, interval):
+        """اجرای دوره‌ای در نخ پس‌زمینه؛ با قفل فایل فقط یک worker کار می‌کند"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, args=(interval,), name='retention', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _loop(self, interval):
+        while not self._stopped.wait(interval):
+            try:
+                stats = self.run()
+                if stats:
+                    print(f"Retention: {stats}")
+            except Exception as e:
+                print(f"Retention error: {e}")
+
+    # ---------- سیاست‌ها ----------
+
+    def _archive_old_messages(self, cutoff, user_ids=None, through_id=None):
+        """پیام‌ها به ترتیب id خوانده می‌شوند؛ id و timestamp هم‌جهت‌اند پس ایندکس زمانی لازم نیست
+
+        با user_ids فقط پیام‌های تا through_id (لحظه انتخاب کاربران) آرشیو
+        می‌شوند و فقط تا وقتی کاربر هنوز غیرفعال است.
+        """
+        archived = 0
+        while not self._stopped.is_set():
+            if user_ids is not None:
+                # بازدیدهایی که هنوز در بافر حافظه‌اند
+                self.db.flush_activity()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+                if user_ids is None:
+                    cursor.execute(
+                        f'SELECT {", ".join(MESSAGE_COLUMNS)} FROM messages ORDER BY id LIMIT ?',
+                        (self.batch_size,)
+                    )
+                    rows = [row for row in cursor.fetchall() if (row[6] or '') < cutoff]
+                else:
+                    cursor.execute(
+                        f'SELECT {", ".join(MESSAGE_COLUMNS)} FROM messages '
+                        f'WHERE id <= ? AND user_id IN ('
+                        f'SELECT id FROM users WHERE id IN ({", ".join("?" * len(user_ids))}) '
+                        f'AND last_activity < ? AND {LAST_ACTIVE} < ?) ORDER BY id LIMIT ?',
+                        (through_id, *user_ids, cutoff, cutoff, self.batch_size)
+                    )
+                    rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                # اول آرشیو روی دیسک، بعد حذف
+                self._write_archive('messages', MESSAGE_COLUMNS, rows, lambda row: row[6])
+                cursor.executemany('DELETE FROM messages WHERE id = ?', [(row[0],) for row in rows])
+                conn.commit()
+
+            archived += len(rows)
+            if user_ids is None and len(rows) < self.batch_size:
+                break
+            time.sleep(self.batch_pause)
+        return archived
+
+    def _archive_inactive_users(self, cutoff, stats):
+        while not self._stopped.is_set():
+            self.db.flush_activity()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+                # پیام‌هایی که بعد از این لحظه برسند مال کاربری است که برگشته
+                cursor.execute('SELECT COALESCE(MAX(id), 0) FROM messages')
+                through_id = cursor.fetchone()[0]
+                # last_activity: آخرین پیام، last_active: آخرین بازدید
+                cursor.execute(
+                    f'SELECT {", ".join(USER_COLUMNS)} FROM users '
+                    f'WHERE last_activity < ? AND {LAST_ACTIVE} < ? LIMIT ?',
+                    (cutoff, cutoff, max(self.batch_size // 10, 1))
+                )
+                users = cursor.fetchall()
+            if not users:
+                return
+
+            user_ids = [user[0] for user in users]
+            stats['messages_archived'] += self._archive_old_messages(cutoff, user_ids, through_id)
+            if self._stopped.is_set():
+                return
+
+            users = self._delete_users(users, cutoff, archive=True)
+            stats['users_archived'] += len(users)
+            if not users:
+                # همه برگشته‌اند؛ دور بعد دوباره امتحان می‌شود
+                return
+            time.sleep(self.batch_pause)
+
+    def _delete_empty_sessions(self, cutoff):
+        """session هایی که فقط صفحه را باز کرده‌اند - چیزی برای آرشیو ندارند"""
+        deleted = 0
+        after_id = 0
+        while not self._stopped.is_set():
+            self.db.flush_activity()
+            with self.db.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    f'SELECT {", ".join(USER_COLUMNS)} FROM users '
+                    f'WHERE id > ? AND last_activity IS NULL AND message_count = 0 AND {LAST_ACTIVE} < ? '
+                    'ORDER BY id LIMIT ?',
+                    (after_id, cutoff, self.batch_size)
+                )
+                users = cursor.fetchall()
+            if not users:
+                break
+            after_id = users[-1][0]
+            deleted += len(self._delete_users(users, cutoff, archive=False))
+            if len(users) < self.batch_size:
+                break
+            time.sleep(self.batch_pause)
+        return deleted
+
+    def _delete_users(self, users, cutoff, archive):
+        """حذف کاربرانی که هنوز غیرفعال و بدون پیام‌اند؛ خروجی: کاربران حذف شده
+
+        بررسی دوباره و حذف در یک تراکنش BEGIN IMMEDIATE است تا پیام یا بازدیدی
+        بین این دو از قلم نیفتد.
+        """
+        user_ids = [user[0] for user in users]
+        with self.db.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            # last_activity با هر پیام (trigger) جلو می‌رود
+            cursor.execute(
+                f'SELECT id FROM users WHERE id IN ({", ".join("?" * len(user_ids))}) '
+                f'AND message_count = 0 AND {LAST_ACTIVE} < ? '
+                'AND (last_activity IS NULL OR last_activity < ?) '
+                'AND NOT EXISTS (SELECT 1 FROM messages WHERE messages.user_id = users.id)',
+                (*user_ids, cutoff, cutoff)
+            )
+            gone = {row[0] for row in cursor.fetchall()} - self.db.pending_activity(user_ids)
+            users = [user for user in users if user[0] in gone]
+            if users:
+                if archive:
+                    self._write_archive('users', USER_COLUMNS, users, lambda user: user[6] or user[4])
+                params = [(user[0],) for user in users]
+                cursor.executemany('DELETE FROM conversation_summaries WHERE user_id = ?', params)
+                cursor.executemany('DELETE FROM users WHERE id = ?', params)
+            conn.commit()
+        # session کش شده نباید به کاربر حذف شده برسد
+        self.db.forget_sessions([user[1] for user in users])
+        return users
+
+    # ---------- فشرده‌سازی فایل دیتابیس ----------
+
+    def compact(self):
+        """آزاد کردن صفحه‌های خالی در تکه‌های کوچک (نیاز به auto_vacuum = INCREMENTAL)"""
+        freed = 0
+        with self.db.connection() as conn:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                return 0
+            while not self._stopped.is_set():
+                free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if not free:
+                    break
+                # هر ردیف خروجی یک صفحه است؛ تا آخر خوانده شود وگرنه فقط یک صفحه آزاد می‌شود
+                conn.execute(f'PRAGMA incremental_vacuum({min(free, int(self.vacuum_pages))})').fetchall()
+                conn.commit()
+                freed += min(free, int(self.vacuum_pages))
+                time.sleep(self.batch_pause)
+            # WAL بزرگ شده هم کوچک شود
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return freed
+
+    def full_vacuum(self):
+        """یک بار برای دیتابیس‌های قدیمی: فعال کردن auto_vacuum و بازسازی کل فایل
+
+        تمام مدت قفل نوشتن را نگه می‌دارد؛ فقط در زمان تعمیر و نگهداری.
+        """
+        with self.db.connection() as conn:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    # ---------- آرشیو ----------
+
+    def _write_archive(self, kind, columns, rows, month_of):
+        by_month = {}
+        for row in rows:
+            by_month.setdefault((month_of(row) or '')[:7] or 'unknown', []).append(row)
+
+        extension = 'zst' if self.compression == 'zstd' else 'gz'
+        for month, items in by_month.items():
+            data = ''.join(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in items
+            ).encode('utf-8')
+            path = os.path.join(self.archive_dir, f'{kind}-{month}.jsonl.{extension}')
+            # هر دسته یک frame/member جدا به انتهای فایل اضافه می‌کند؛ هر دو فرمت
+            # چند frame پشت سر هم را یک جریان می‌خوانند (zcat / zstdcat)
+            with open(path, 'ab') as f:
+                if extension == 'zst':
+                    f.write(zstandard.ZstdCompressor().compress(data))
+                else:
+                    f.write(gzip.compress(data))
+                f.flush()
+                os.fsync(f.fileno())
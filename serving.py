@@ -0,0 +1,106 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+
+from flask import abort, current_app, request, send_file
+from werkzeug.security import safe_join
+
+# فایل‌های محتوا-محور هیچ‌وقت تغییر نمی‌کنند
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# blobs/ab/cd/<sha256>.<ext> و thumbs/ab/cd/<sha256>_<size>.<ext> - هش از خود نام خوانده می‌شود
+_BLOB_NAME = re.compile(r'^(?:blobs|thumbs)/[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64}(?:_\d+)?)\.[A-Za-z0-9]+$')
+
+
+class FileHasher:
+    """SHA-256 فایل‌ها با کش در حافظه؛ با تغییر mtime یا اندازه دوباره حساب می‌شود"""
+
+    def __init__(self, max_entries=4096, chunk_size=64 * 1024):
+        self.max_entries = max_entries
+        self.chunk_size = chunk_size
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+
+    def digest(self, path):
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            item = self._digests.get(path)
+            if item is not None and item[0] == stamp:
+                self._digests.move_to_end(path)
+                return item[1]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+
+        with self._lock:
+            self._digests[path] = (stamp, digest)
+            self._digests.move_to_end(path)
+            while len(self._digests) > self.max_entries:
+                self._digests.popitem(last=False)
+        return digest
+
+
+class FileServer:
+    """ارسال فایل با ETag قوی، پاسخ 304، درخواست Range و واگذاری اختیاری به nginx
+
+    offload: None، 'x-accel' (هدر X-Accel-Redirect برای nginx) یا 'x-sendfile'
+    (هدر X-Sendfile از طریق USE_X_SENDFILE در Flask).
+    """
+
+    def __init__(self, root, hasher=None, max_age=3600, offload=None, accel_prefix='/protected-uploads/'):
+        self.root = root
+        self.hasher = hasher or FileHasher()
+        self.max_age = max_age
+        self.offload = offload
+        self.accel_prefix = accel_prefix
+
+    def resolve(self, filename):
+        path = safe_join(self.root, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        return path
+
+    def version(self, filename):
+        """نسخه کوتاه محتوا برای URL های نسخه‌دار (None اگر فایل نباشد)"""
+        path = safe_join(self.root, filename)
+        if path is None or not os.path.isfile(path):
+            return None
+        return self.hasher.digest(path)[:12]
+
+    def send(self, filename, immutable=None):
+        path = self.resolve(filename)
+
+        match = _BLOB_NAME.match(filename)
+        if match:
+            # نام فایل همان هش محتواست؛ نیازی به خواندن فایل نیست
+            etag = match.group(1)
+            immutable = True if immutable is None else immutable
+        else:
+            etag = self.hasher.digest(path)
+        max_age = IMMUTABLE_MAX_AGE if immutable else self.max_age
+
+        if self.offload == 'x-accel':
+            response = current_app.response_class(
+                mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            )
+            # nginx خودش Range و ارسال بدنه را انجام می‌دهد
+            response.headers['X-Accel-Redirect'] = self.accel_prefix + quote(filename)
+            response.set_etag(etag)
+            response.make_conditional(request)
+        else:
+            # send_file خودش If-None-Match و Range را پاسخ می‌دهد
+            response = send_file(path, etag=etag, max_age=max_age, conditional=True)
+
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        if immutable:
+            response.cache_control.immutable = True
+        return response
@@ -603,6 +603,53 @@ function createSystemMessage(content, type = 'info') {
     messagesDiv.scrollTop = messagesDiv.scrollHeight;
 }
 
+/**
+ * ارسال پیام و دریافت تدریجی پاسخ هوش مصنوعی
+ * هر خط پاسخ سرور یک JSON است: {delta} برای هر تکه و {done} در پایان
+ */
+async function streamAIResponse(formData, onDelta) {
+    const response = await fetch('/api/send_message_stream', {
+        method: 'POST',
+        body: formData
+    });
+    
+    if (response.status === 429 || response.status === 503) {
+        const result = await response.json();
+        const error = new Error(result.message || 'سرور شلوغ است، کمی بعد دوباره تلاش کنید');
+        error.busy = true;
+        throw error;
+    }
+    
+    if (!response.ok || !response.body) {
+        throw new Error(`Stream failed: ${response.status}`);
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result = null;
+    
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        
+        lines.filter(line => line.trim()).forEach(line => {
+            const event = JSON.parse(line);
+            if (event.delta) {
+                onDelta(event.delta);
+            } else if (event.done) {
+                result = event;
+            }
+        });
+    }
+    
+    return result;
+}
+
 /**
  * بررسی اتصال اینترنت
  */
@@ -3,6 +3,12 @@ let currentChatType = 'ai';
 let currentUserId = null;
 let messageInterval = null;
 let adminMessageInterval = null;
+let lastMessageId = 0;
+let messageStream = null;
+// اسکرول به بالا: قدیمی‌ترین پیام نمایش داده شده و وجود صفحه قبلی
+let oldestMessageId = null;
+let hasOlderMessages = false;
+let loadingOlderMessages = false;
 
 // تغییر نوع چت
 function switchChat(type) {
@@ -25,13 +31,44 @@ function switchChat(type) {
     
     // پاک کردن پیام‌ها
     document.getElementById('messages').innerHTML = '';
+    lastMessageId = 0;
+    oldestMessageId = null;
+    hasOlderMessages = false;
     
-    // بارگیری پیام‌های جدید
+    // بارگیری پیام‌های جدید و اتصال به جریان پیام‌ها
+    startMessageUpdates();
+}
+
+// دریافت خودکار پیام‌ها: SSE در صورت پشتیبانی، در غیر این صورت polling
+async function startMessageUpdates() {
     clearInterval(messageInterval);
-    loadMessages();
+    if (messageStream) {
+        messageStream.close();
+        messageStream = null;
+    }
+    
+    await loadMessages();
+    
+    if (!window.EventSource) {
+        messageInterval = setInterval(loadMessages, 2000);
+        return;
+    }
     
-    // تنظیم بازخوانی خودکار
-    messageInterval = setInterval(loadMessages, 2000);
+    const chatType = currentChatType;
+    messageStream = new EventSource(`/api/stream_messages?chat_type=${chatType}&since_id=${lastMessageId}`);
+    messageStream.addEventListener('messages', function(e) {
+        if (chatType === currentChatType) {
+            appendMessages(JSON.parse(e.data));
+        }
+    });
+    messageStream.onerror = function() {
+        // اگر اتصال کاملاً بسته شد به polling برگرد
+        if (messageStream && messageStream.readyState === EventSource.CLOSED) {
+            messageStream = null;
+            clearInterval(messageInterval);
+            messageInterval = setInterval(loadMessages, 2000);
+        }
+    };
 }
 
 // ارسال پیام
@@ -44,8 +81,8 @@ async function sendMessage() {
         return;
     }
     
-    // نمایش پیام کاربر
-    addMessageToChat('user', message);
+    // نمایش پیام کاربر (موقت تا رسیدن نسخه سرور)
+    addMessageToChat('user', message, null, null, true);
     input.value = '';
     
     // نمایش وضعیت در حال ارسال
@@ -58,6 +95,27 @@ async function sendMessage() {
     
     // فایل آپلود شده
     const fileInput = document.getElementById('file-upload');
+    
+    // پیام متنی به هوش مصنوعی - پاسخ به صورت تدریجی نمایش داده می‌شود
+    if (currentChatType === 'ai' && fileInput.files.length === 0 && window.ReadableStream && window.TextDecoder) {
+        try {
+            await sendStreamingMessage(formData);
+            return;
+        } catch (error) {
+            console.error('Streaming error:', error);
+            removeTypingIndicator();
+            if (error.busy) {
+                // پیام ذخیره نشده - متن برای تلاش دوباره برمی‌گردد
+                showNotification(error.message, 'warning');
+                document.querySelectorAll('#messages .message.pending').forEach(el => el.remove());
+                input.value = message;
+            } else {
+                showNotification('خطا در ارسال پیام', 'error');
+            }
+            return;
+        }
+    }
+    
     if (fileInput.files.length > 0) {
         const fileType = document.getElementById('file-type').value;
         formData.append('message_type', fileType);
@@ -78,17 +136,21 @@ async function sendMessage() {
         
         const result = await response.json();
         
-        // حذف نشانگر تایپ
-        removeTypingIndicator();
+        // سرور شلوغ است یا درخواست‌ها زیاد بوده - پیام ذخیره نشده
+        if (response.status === 503 || response.status === 429) {
+            removeTypingIndicator();
+            showNotification(result.message || 'سرور شلوغ است، کمی بعد دوباره تلاش کنید', 'warning');
+            document.querySelectorAll('#messages .message.pending').forEach(el => el.remove());
+            input.value = message;
+            return;
+        }
         
-        if (result.status === 'success' && result.ai_response) {
-            // نمایش پاسخ هوش مصنوعی
-            setTimeout(() => {
-                addMessageToChat('ai', result.ai_response);
-            }, 800);
+        // در حالت صف، نشانگر تایپ تا رسیدن پاسخ هوش مصنوعی می‌ماند
+        if (result.status !== 'queued') {
+            removeTypingIndicator();
         }
         
-        // بارگیری مجدد پیام‌ها
+        // بارگیری پیام‌های جدید (پیام کاربر و پاسخ هوش مصنوعی)
         loadMessages();
         
     } catch (error) {
@@ -98,11 +160,55 @@ async function sendMessage() {
     }
 }
 
+// ارسال پیام با پاسخ تدریجی هوش مصنوعی
+async function sendStreamingMessage(formData) {
+    let replyDiv = null;
+    let replyText = '';
+    
+    const result = await streamAIResponse(formData, delta => {
+        if (!replyDiv) {
+            removeTypingIndicator();
+            replyDiv = addMessageToChat('ai', ' ', null, null, true);
+        }
+        replyText += delta;
+        replyDiv.querySelector('.message-content').textContent = replyText;
+        const messagesDiv = document.getElementById('messages');
+        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+    });
+    
+    removeTypingIndicator();
+    
+    // متن نهایی تمیز شده با LaTeX پردازش شده جایگزین می‌شود
+    if (result && replyDiv) {
+        replyDiv.querySelector('.message-content').innerHTML = result.content;
+        if (window.MathJax) {
+            MathJax.typesetPromise([replyDiv]);
+        }
+    }
+    
+    loadMessages();
+}
+
+// مدت فایل صوتی - چون preload="none" مرورگر خودش آن را نمی‌داند
+function formatDuration(seconds) {
+    if (!seconds) {
+        return '';
+    }
+    const total = Math.round(seconds);
+    const minutes = Math.floor(total / 60);
+    const rest = String(total % 60).padStart(2, '0');
+    return `<span class="media-duration">${minutes}:${rest}</span>`;
+}
+
 // افزودن پیام به چت
-function addMessageToChat(sender, content, filePath = null, timestamp = null) {
+// preview: {thumbnail_url, media} از سرور - اول پیش‌نمایش کوچک بارگیری می‌شود
+function addMessageToChat(sender, content, filePath = null, timestamp = null, pending = false, preview = null) {
     const messagesDiv = document.getElementById('messages');
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${sender}-message`;
+    if (pending) {
+        messageDiv.classList.add('pending');
+    }
     
     let messageContent = '';
     let fileContent = '';
@@ -110,13 +216,18 @@ function addMessageToChat(sender, content, filePath = null, timestamp = null) {
     if (filePath) {
         const fileType = filePath.split('.').pop().toLowerCase();
         const fileUrl = `/uploads/${filePath}`;
+        const thumbUrl = preview && preview.thumbnail_url;
+        const media = (preview && preview.media) || {};
+        // ابعاد از قبل معلوم است تا با بارگیری تصویر صفحه جابه‌جا نشود
+        const sizeAttrs = media.width && media.height ? `width="${media.width}" height="${media.height}"` : '';
         
         if (['jpg', 'jpeg', 'png', 'gif', 'webp'].includes(fileType)) {
-            fileContent = `<div class="message-file"><img src="${fileUrl}" class="file-preview" onclick="openFile('${fileUrl}')"></div>`;
+            fileContent = `<div class="message-file"><img src="${thumbUrl || fileUrl}" ${sizeAttrs} loading="lazy" class="file-preview" onclick="openFile('${fileUrl}')"></div>`;
         } else if (['mp4', 'avi', 'mov', 'webm'].includes(fileType)) {
-            fileContent = `<div class="message-file"><video controls class="file-preview"><source src="${fileUrl}" type="video/mp4"></video></div>`;
+            const poster = thumbUrl ? `poster="${thumbUrl}"` : '';
+            fileContent = `<div class="message-file"><video controls preload="none" ${poster} class="file-preview"><source src="${fileUrl}" type="video/mp4"></video></div>`;
         } else if (['mp3', 'wav', 'ogg'].includes(fileType)) {
-            fileContent = `<div class="message-file"><audio controls><source src="${fileUrl}"></audio></div>`;
+            fileContent = `<div class="message-file"><audio controls preload="none"><source src="${fileUrl}"></audio>${formatDuration(media.duration)}</div>`;
         } else {
             fileContent = `<div class="message-file"><a href="${fileUrl}" download class="file-download"><i class="fas fa-download"></i> دانلود فایل</a></div>`;
         }
@@ -141,22 +252,95 @@ function addMessageToChat(sender, content, filePath = null, timestamp = null) {
     if (window.MathJax) {
         MathJax.typesetPromise([messageDiv]);
     }
+    
+    return messageDiv;
 }
 
-// بارگیری پیام‌ها
+// بارگیری پیام‌ها - فقط پیام‌های جدیدتر از lastMessageId اضافه می‌شوند
 async function loadMessages() {
     try {
-        const response = await fetch(`/api/get_messages?chat_type=${currentChatType}`);
+        const chatType = currentChatType;
+        const sinceParam = lastMessageId ? `&since_id=${lastMessageId}` : '';
+        const response = await fetch(`/api/get_messages?chat_type=${chatType}${sinceParam}`);
+        
+        // 304 یعنی پیام جدیدی نیامده؛ 429/503 یعنی این دور رد شد
+        if (response.status === 304 || response.status === 429 || response.status === 503 || chatType !== currentChatType) {
+            return;
+        }
+        
+        appendMessages(await response.json());
+    } catch (error) {
+        console.error('Error loading messages:', error);
+    }
+}
+
+// افزودن پیام‌های جدیدتر از lastMessageId به چت
+function appendMessages(data) {
+    if (!data.messages || data.messages.length === 0 || data.last_id <= lastMessageId) {
+        return;
+    }
+    
+    // حذف پیام‌های موقت - نسخه سرور جایگزین آنها می‌شود
+    document.querySelectorAll('#messages .message.pending').forEach(el => el.remove());
+    
+    const newMessages = data.messages
+        .filter(msg => msg.id > lastMessageId)
+        .sort((a, b) => a.id - b.id);
+    newMessages.forEach(msg => {
+        addMessageToChat(msg.sender, msg.content, msg.file_path, msg.timestamp, false, msg);
+    });
+    // اولین بارگیری آخرین صفحه را می‌آورد؛ قبلی‌ها با اسکرول به بالا
+    if (oldestMessageId === null && newMessages.length) {
+        oldestMessageId = newMessages[0].id;
+        hasOlderMessages = Boolean(data.has_more);
+    }
+    lastMessageId = data.last_id;
+    
+    // نشانگر تایپ (پاسخ در صف) پایین بماند تا پاسخ هوش مصنوعی برسد
+    const typingDiv = document.getElementById('typing-indicator');
+    if (typingDiv) {
+        if (newMessages.some(msg => msg.sender === 'ai')) {
+            typingDiv.remove();
+        } else {
+            typingDiv.parentElement.appendChild(typingDiv);
+        }
+    }
+}
+
+// بارگیری صفحه قبلی تاریخچه وقتی کاربر به بالای چت می‌رسد
+async function loadOlderMessages() {
+    if (!hasOlderMessages || loadingOlderMessages || oldestMessageId === null) {
+        return;
+    }
+    loadingOlderMessages = true;
+    const chatType = currentChatType;
+    try {
+        const response = await fetch(`/api/get_messages?chat_type=${chatType}&before_id=${oldestMessageId}`);
         const data = await response.json();
+        if (chatType !== currentChatType || !data.messages) {
+            return;
+        }
         
         const messagesDiv = document.getElementById('messages');
-        messagesDiv.innerHTML = '';
+        const anchor = messagesDiv.firstChild;
+        const previousHeight = messagesDiv.scrollHeight;
+        const previousTop = messagesDiv.scrollTop;
         
         data.messages.forEach(msg => {
-            addMessageToChat(msg.sender, msg.content, msg.file_path, msg.timestamp);
+            const messageDiv = addMessageToChat(msg.sender, msg.content, msg.file_path, msg.timestamp, false, msg);
+            messagesDiv.insertBefore(messageDiv, anchor);
         });
+        // همان پیامی که کاربر می‌دید سر جایش بماند
+        messagesDiv.scrollTop = messagesDiv.scrollHeight - previousHeight + previousTop;
+        
+        if (data.messages.length) {
+            oldestMessageId = data.first_id;
+        }
+        hasOlderMessages = Boolean(data.has_more);
     } catch (error) {
-        console.error('Error loading messages:', error);
+        console.error('Error loading older messages:', error);
+    } finally {
+        loadingOlderMessages = false;
     }
 }
 
@@ -236,9 +420,14 @@ document.addEventListener('DOMContentLoaded', function() {
     }
     
     // بارگیری اولیه
-    if (document.getElementById('messages')) {
-        loadMessages();
-        messageInterval = setInterval(loadMessages, 2000);
+    const messagesDiv = document.getElementById('messages');
+    if (messagesDiv) {
+        startMessageUpdates();
+        messagesDiv.addEventListener('scroll', function() {
+            if (messagesDiv.scrollTop < 100) {
+                loadOlderMessages();
+            }
+        });
     }
     
     // نمایش انیمیشن ربات
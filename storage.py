@@ -0,0 +1,152 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from flask import Request
+
+BLOB_PREFIX = 'blobs/'
+
+
+class HashingFile:
+    """فایل موقت که هم‌زمان با نوشتن، SHA-256 محتوا را حساب می‌کند
+
+    Werkzeug بخش‌های multipart را به ترتیب در آن می‌نویسد، پس بعد از پایان
+    آپلود هش آماده است و فایل دوباره خوانده نمی‌شود.
+    """
+
+    def __init__(self, directory):
+        self._file = tempfile.NamedTemporaryFile(dir=directory, prefix='upload-', suffix='.part')
+        self._hash = hashlib.sha256()
+        self.name = self._file.name
+        self.size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class BlobStore:
+    """انبار فایل محتوا-محور: هر محتوا یک بار در blobs/ab/cd/<sha256>.<ext>
+
+    فایل‌های تکراری دوباره ذخیره نمی‌شوند. شمارش ارجاع از ستون
+    messages.file_path است و blob بدون ارجاع با collect_garbage حذف می‌شود.
+    """
+
+    def __init__(self, root, chunk_size=64 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def request_class(self):
+        """کلاس Request که فایل‌های آپلودی را مستقیم در پوشه موقت انبار می‌نویسد"""
+        store = self
+
+        class UploadRequest(Request):
+            def _get_file_stream(self, total_content_length, content_type,
+                                 filename=None, content_length=None):
+                return HashingFile(store.tmp_dir)
+
+        return UploadRequest
+
+    @staticmethod
+    def blob_path(digest, extension):
+        return f'{BLOB_PREFIX}{digest[:2]}/{digest[2:4]}/{digest}.{extension}'
+
+    def full_path(self, relpath):
+        return os.path.join(self.root, *relpath.split('/'))
+
+    def save(self, file, extension):
+        """ذخیره FileStorage و برگرداندن مسیر نسبی blob (برای messages.file_path)"""
+        stream = file.stream
+        own_temp = None
+        if isinstance(stream, HashingFile):
+            stream.flush()
+        else:
+            # آپلود از مسیر دیگری آمده؛ تکه‌تکه کپی و هش کن
+            own_temp = stream = self._copy_to_temp(stream)
+
+        try:
+            relpath = self.blob_path(stream.hexdigest(), extension)
+            target = self.full_path(relpath)
+            if os.path.exists(target):
+                # تکراری؛ mtime تازه می‌شود تا GC آن را قبل از ثبت پیام حذف نکند
+                os.utime(target)
+                return relpath
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                # لینک سخت اتمیک است و اگر هم‌زمان ساخته شده باشد خطا می‌دهد
+                os.link(stream.name, target)
+            except FileExistsError:
+                os.utime(target)
+                return relpath
+            except OSError:
+                partial = target + '.part'
+                shutil.copyfile(stream.name, partial)
+                os.replace(partial, target)
+            os.chmod(target, 0o644)
+            return relpath
+        finally:
+            if own_temp is not None:
+                own_temp.close()
+
+    def _copy_to_temp(self, source):
+        temp = HashingFile(self.tmp_dir)
+        while True:
+            chunk = source.read(self.chunk_size)
+            if not chunk:
+                break
+            temp.write(chunk)
+        temp.flush()
+        return temp
+
+    def iter_blobs(self):
+        blobs_dir = os.path.join(self.root, BLOB_PREFIX.rstrip('/'))
+        for dirpath, _, filenames in os.walk(blobs_dir):
+            for filename in filenames:
+                full = os.path.join(dirpath, filename)
+                yield os.path.relpath(full, self.root).replace(os.sep, '/'), full
+
+    def collect_garbage(self, is_referenced, grace=3600, dry_run=False):
+        """حذف blob های بدون ارجاع که قدیمی‌تر از grace ثانیه هستند
+
+        grace جلوی حذف فایلی را می‌گیرد که ذخیره شده ولی پیامش هنوز ثبت نشده.
+        خروجی: (لیست مسیرهای حذف شده، تعداد بایت آزاد شده)
+        """
+        cutoff = time.time() - grace
+        removed = []
+        freed = 0
+        for relpath, full in self.iter_blobs():
+            try:
+                stat = os.stat(full)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime > cutoff or is_referenced(relpath):
+                continue
+            if not dry_run:
+                os.remove(full)
+            removed.append(relpath)
+            freed += stat.st_size
+
+        # فایل‌های موقت جامانده از پروسه‌هایی که وسط آپلود از کار افتادند
+        for filename in os.listdir(self.tmp_dir):
+            full = os.path.join(self.tmp_dir, filename)
+            try:
+                if os.stat(full).st_mtime <= cutoff and not dry_run:
+                    os.remove(full)
+            except FileNotFoundError:
+                pass
+        return removed, freed
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from database import Database  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    # The flusher thread is kept out of the way; tests flush explicitly
+    database = Database(str(tmp_path / 'chat.db'), activity_flush_interval=3600)
+    yield database
+    database.close()
+
+
+@pytest.fixture(scope='session')
+def flask_app(tmp_path_factory):
+    """app.py imported once, with its relative paths inside a scratch directory"""
+    workdir = tmp_path_factory.mktemp('app')
+    previous = os.getcwd()
+    os.chdir(workdir)
+    from config import Config
+
+    Config.AI_RULES_PATH = os.path.join(ROOT, 'rules', 'ai_rules.json')
+    Config.OPENAI_API_KEY = None
+    import app
+
+    yield app
+    os.chdir(previous)
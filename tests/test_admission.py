@@ -0,0 +1,95 @@
+import pytest
+
+from admission import Admission
+
+
+@pytest.fixture
+def admission(tmp_path):
+    gate = Admission(str(tmp_path / 'admission.db'), limits={'poll': (1, 3), 'ai': (1, 5)},
+                     ip_factor=2, ai_max_in_flight=1)
+    yield gate
+    gate.close()
+
+
+@pytest.fixture
+def gated_app(flask_app, admission, monkeypatch):
+    monkeypatch.setattr(flask_app, 'admission', admission)
+    return flask_app
+
+
+def visitor(app_module):
+    """test client with a chat session, as after opening the page"""
+    client = app_module.app.test_client()
+    client.get('/')
+    return client
+
+
+def test_bucket_empties_then_asks_to_retry(admission):
+    assert [admission.take('poll', 's1') for _ in range(3)] == [0, 0, 0]
+    assert admission.take('poll', 's1') >= 1
+    # another session has its own bucket, unknown kinds are not limited
+    assert admission.take('poll', 's2') == 0
+    assert admission.take('page', 's1') == 0
+
+
+def test_ip_bucket_is_shared_across_sessions(admission):
+    results = [admission.take('poll', f's{i}', '10.0.0.1') for i in range(7)]
+    assert results[:6] == [0] * 6
+    assert results[6] >= 1
+
+
+def test_buckets_are_shared_between_workers(tmp_path):
+    path = str(tmp_path / 'shared.db')
+    first = Admission(path, limits={'poll': (1, 2)})
+    second = Admission(path, limits={'poll': (1, 2)})
+    try:
+        assert first.take('poll', 's1') == 0
+        assert second.take('poll', 's1') == 0
+        assert first.take('poll', 's1') >= 1
+    finally:
+        first.close()
+        second.close()
+
+
+def test_ai_slots_are_capped_and_released(admission):
+    token = admission.acquire_ai()
+    assert token
+    assert admission.acquire_ai() is None
+    assert admission.ai_in_flight() == 1
+    admission.release_ai(token)
+    assert admission.acquire_ai()
+
+
+def test_poll_over_limit_gets_429_with_retry_after(gated_app):
+    client = visitor(gated_app)
+    statuses = [client.get('/api/get_messages?chat_type=ai').status_code for _ in range(4)]
+    assert statuses[:3] == [200, 200, 200]
+    assert statuses[3] == 429
+
+    response = client.get('/api/get_messages?chat_type=ai')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+
+
+def test_password_parameter_does_not_bypass_limits(gated_app):
+    client = visitor(gated_app)
+    for _ in range(3):
+        client.get('/api/get_messages?chat_type=ai&password=admin123')
+    response = client.get('/api/get_messages?chat_type=ai&password=admin123')
+    assert response.status_code == 429
+
+
+def test_admin_routes_are_not_limited(gated_app):
+    client = visitor(gated_app)
+    for _ in range(5):
+        assert client.get('/api/get_messages?chat_type=admin&password=admin123').status_code == 200
+        assert client.get('/api/get_users?password=admin123').status_code == 200
+
+
+def test_ai_saturated_gets_503(gated_app, admission):
+    token = admission.acquire_ai()
+    client = visitor(gated_app)
+    response = client.post('/api/send_message', data={'message': 'سلام', 'chat_type': 'ai'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(gated_app.app.config['ADMISSION_AI_RETRY_AFTER'])
+    admission.release_ai(token)
@@ -0,0 +1,112 @@
+from types import SimpleNamespace
+
+import pytest
+
+import ai_service
+from ai_service import AIService, CircuitBreaker, TokenBucket
+from benchmarks.stub_openai import REPLY, start_stub
+from response_cache import ResponseCache
+
+QUESTION = 'درباره فیزیک کوانتوم توضیح بده'
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**options):
+        options.setdefault('chunk_delay', 0)
+        server, url = start_stub(**options)
+        servers.append(server)
+        return server.RequestHandlerClass.state, url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def service(url, **options):
+    options.setdefault('backoff_base', 0.01)
+    return AIService(api_key='stub', api_url=url, **options)
+
+
+def test_stream_yields_deltas_then_the_final_reply(stub):
+    state, url = stub()
+    ai = service(url, cache=ResponseCache())
+
+    events = list(ai.stream_response(QUESTION))
+    deltas = [text for kind, text in events if kind == 'delta']
+    assert len(deltas) == len(REPLY.split(' '))
+    assert ''.join(deltas).strip() == REPLY
+    assert events[-1] == ('done', REPLY)
+
+    # a complete stream is cached; the repeat is one delta and no request
+    assert list(ai.stream_response(QUESTION)) == [('delta', REPLY), ('done', REPLY)]
+    assert state.requests == 1
+
+
+def test_stream_falls_back_when_the_api_fails(stub):
+    state, url = stub(error_rate=1)
+    ai = service(url, max_retries=1)
+    events = list(ai.stream_response(QUESTION))
+    assert [kind for kind, _ in events] == ['delta', 'done']
+    assert events[0][1] == events[1][1]
+    assert state.requests == 2
+
+
+def test_token_bucket_allows_a_burst_then_waits():
+    bucket = TokenBucket(rate=100, capacity=2)
+    assert bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=1)  # refilled after ~10ms
+
+
+def test_circuit_breaker_opens_then_lets_one_probe_through(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ai_service.time, 'monotonic', lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+    now[0] += 30
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+    assert not breaker.allow()  # only one probe at a time
+    breaker.release_probe()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_retry_after_header_is_honoured():
+    ai = AIService()
+    assert ai._retry_delay(0, SimpleNamespace(headers={'Retry-After': '2'})) == 2
+    assert ai._retry_delay(0, SimpleNamespace(headers={'Retry-After': 'soon'})) <= ai.backoff_base
+    assert ai.backoff_max / 2 <= ai._retry_delay(10) <= ai.backoff_max
+
+
+def test_failing_api_is_retried_then_cut_off(stub):
+    state, url = stub(error_rate=1)
+    ai = service(url, max_retries=2, breaker_threshold=2)
+    fallbacks = ai.rules.get().fallback_responses
+
+    assert ai.get_response(QUESTION) in fallbacks
+    assert state.requests == 3  # first try and two retries
+    ai.get_response(QUESTION)
+    assert ai.breaker.state == 'open'
+    ai.get_response(QUESTION)
+    assert state.requests == 6  # no request while the circuit is open
+
+
+def test_local_rate_limit_does_not_open_the_circuit(stub):
+    state, url = stub()
+    ai = service(url, rate_limit=0.01, rate_burst=1, breaker_threshold=1)
+    assert ai.get_response(QUESTION, timeout=0.2) == REPLY
+    ai.get_response(QUESTION + '؟ دوباره', timeout=0.2)
+    assert state.requests == 1
+    assert ai.breaker.state == 'closed'
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from ai_worker import AIQueueFull, AIReplyQueue
+from message_hub import MessageHub
+
+
+class FakeAI:
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def get_response(self, user_input, use_real_ai=True, timeout=30, history=None):
+        self.release.wait(5)
+        self.calls.append((user_input, use_real_ai))
+        return f'پاسخ: {user_input}'
+
+
+@pytest.fixture
+def hub(db):
+    hub = MessageHub(db, poll_interval=60)
+    yield hub
+    hub.stop()
+
+
+def test_reply_is_saved_and_published(db, hub):
+    ai = FakeAI()
+    replies = AIReplyQueue(ai, db, hub, workers=1)
+    user_id = db.get_or_create_user('s1')
+    message_id = db.save_message(user_id, 'user', 'text', 'سلام')
+    try:
+        replies.submit(user_id, 'سلام', message_id)
+        assert hub.wait(user_id, message_id, timeout=5)
+        messages = db.get_messages(user_id, since_id=message_id)
+        assert [(m['sender'], m['content']) for m in messages] == [('ai', 'پاسخ: سلام')]
+        assert ai.calls == [('سلام', True)]
+    finally:
+        replies.stop()
+
+
+def test_full_queue_is_refused(db, hub):
+    ai = FakeAI()
+    ai.release.clear()  # the only worker is stuck on the first job
+    replies = AIReplyQueue(ai, db, hub, workers=1, max_queue=2)
+    user_id = db.get_or_create_user('s1')
+    try:
+        replies.submit(user_id, 'a')
+        while replies.depth():
+            pass
+        replies.submit(user_id, 'b')
+        replies.submit(user_id, 'c')
+        assert replies.is_full()
+        assert replies.retry_after() == 3
+        with pytest.raises(AIQueueFull):
+            replies.submit(user_id, 'd')
+    finally:
+        ai.release.set()
+        replies.stop()
+
+
+def test_job_past_its_deadline_gets_a_local_reply(db, hub):
+    ai = FakeAI()
+    replies = AIReplyQueue(ai, db, hub, workers=1, deadline=0)
+    user_id = db.get_or_create_user('s1')
+    try:
+        replies.submit(user_id, 'دیر')
+        assert hub.wait(user_id, 0, timeout=5)
+        assert ai.calls == [('دیر', False)]
+    finally:
+        replies.stop()
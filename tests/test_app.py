@@ -0,0 +1,86 @@
+import json
+
+
+ADMIN = 'chat_type=admin&password=admin123'
+
+
+def unread(db, user_id):
+    with db.connection() as conn:
+        return conn.execute('SELECT unread_admin_count FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+
+
+def test_admin_stream_marks_pushed_messages_read(flask_app):
+    db = flask_app.db
+    user_id = db.get_or_create_user('stream-read')
+    since_id = db.get_latest_message_id()
+    db.save_message(user_id, 'user', 'text', 'سلام')
+    assert unread(db, user_id) == 1
+
+    client = flask_app.app.test_client()
+    response = client.get(f'/api/stream_messages?{ADMIN}&user_id={user_id}&since_id={since_id}',
+                          buffered=False)
+    try:
+        for chunk in response.response:
+            if b'event: messages' in chunk:
+                break
+    finally:
+        response.close()
+    assert unread(db, user_id) == 0
+
+
+def chat_user(flask_app):
+    """test client after opening the chat page, and its user id"""
+    client = flask_app.app.test_client()
+    client.get('/')
+    with client.session_transaction() as session:
+        session_id = session['session_id']
+    return client, flask_app.db.get_or_create_user(session_id)
+
+
+def test_poll_returns_only_messages_after_since_id(flask_app):
+    db = flask_app.db
+    client, user_id = chat_user(flask_app)
+    _, other_id = chat_user(flask_app)
+    first = db.save_message(user_id, 'user', 'text', 'اول')
+    second = db.save_message(user_id, 'ai', 'text', 'دوم')
+    db.save_message(other_id, 'user', 'text', 'مال دیگری')
+
+    data = client.get('/api/get_messages').get_json()
+    assert [msg['id'] for msg in data['messages']] == [first, second]
+    assert data['last_id'] == second
+
+    data = client.get(f'/api/get_messages?since_id={first}').get_json()
+    assert [msg['id'] for msg in data['messages']] == [second]
+
+    # nothing new: empty 304 instead of the whole history
+    response = client.get(f'/api/get_messages?since_id={second}')
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_streamed_reply_is_sent_as_ndjson_and_saved(flask_app):
+    client, user_id = chat_user(flask_app)
+    response = client.post('/api/send_message_stream', data={'content': 'سلام'})
+    assert response.mimetype == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert all('delta' in line for line in lines[:-1])
+    final = lines[-1]
+    assert final['done']
+    assert ''.join(line['delta'] for line in lines[:-1]) == final['content']
+
+    messages = flask_app.db.get_messages(user_id)
+    assert [(m['sender'], m['id']) for m in messages][-1] == ('ai', final['message_id'])
+
+
+def test_scrolling_back_pages_through_the_history(flask_app):
+    client, user_id = chat_user(flask_app)
+    ids = [flask_app.db.save_message(user_id, 'user', 'text', f'm{i}') for i in range(5)]
+
+    page = client.get('/api/get_messages?limit=2').get_json()
+    assert [m['id'] for m in page['messages']] == ids[3:]
+    assert page['has_more']
+    page = client.get(f"/api/get_messages?limit=2&before_id={page['first_id']}").get_json()
+    assert [m['id'] for m in page['messages']] == ids[1:3]
+    page = client.get(f"/api/get_messages?limit=2&before_id={page['first_id']}").get_json()
+    assert [m['id'] for m in page['messages']] == ids[:1]
+    assert not page['has_more']
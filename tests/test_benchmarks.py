@@ -0,0 +1,46 @@
+import requests
+
+from benchmarks.loadtest import metrics_delta, percentile, summarize
+from benchmarks.stub_openai import REPLY, start_stub
+
+
+def post(url, **body):
+    return requests.post(url, json={'model': 'stub', 'messages': [], **body}, timeout=5)
+
+
+def test_stub_answers_plain_and_streamed_requests():
+    server, url = start_stub(chunk_delay=0)
+    try:
+        assert post(url).json()['choices'][0]['message']['content'] == REPLY
+        lines = [line for line in post(url, stream=True).content.decode('utf-8').split('\n') if line]
+        assert len(lines) == len(REPLY.split(' ')) + 1
+        assert lines[-1] == 'data: [DONE]'
+        assert server.RequestHandlerClass.state.requests == 2
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_stub_rate_limits_with_retry_after():
+    server, url = start_stub(rate_limit_rate=1, retry_after=7)
+    try:
+        response = post(url)
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '7'
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_load_test_summary():
+    samples = [i / 1000 for i in range(1, 101)]
+    assert percentile(sorted(samples), 0.95) == 0.095
+    assert percentile([], 0.5) is None
+    summary = summarize(samples, errors=2, elapsed=10)
+    assert summary['requests'] == 100
+    assert summary['rps'] == 10
+    assert (summary['p50_ms'], summary['p99_ms'], summary['max_ms']) == (50, 99, 100)
+    assert summarize([], 0, 1)['p50_ms'] is None
+
+    before = {'a': 1.0, 'b': 2.0}
+    assert metrics_delta(before, {'a': 1.0, 'b': 5.0, 'c': 1.0}) == {'b': 3.0, 'c': 1.0}
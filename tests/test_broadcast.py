@@ -0,0 +1,87 @@
+import time
+
+from broadcast import Broadcaster
+
+
+class RecordingHub:
+    def __init__(self):
+        self.published = []
+
+    def publish_many(self, messages):
+        self.published.append(list(messages))
+
+
+def users(db, count):
+    return [db.get_or_create_user(f's{i}') for i in range(count)]
+
+
+def admin_messages(db, user_id):
+    return [m['content'] for m in db.get_messages(user_id) if m['sender'] == 'admin']
+
+
+def wait_until_idle(broadcaster, timeout=5):
+    deadline = time.monotonic() + timeout
+    while broadcaster._running and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not broadcaster._running
+
+
+def test_broadcast_is_sent_in_chunks_with_progress(db):
+    user_ids = users(db, 5)
+    job = db.create_broadcast({'type': 'all'}, 'text', 'اطلاعیه')
+    assert job['total'] == 5
+
+    first = db.send_broadcast_chunk(job['id'], limit=2)
+    assert [user_id for _, user_id in first] == user_ids[:2]
+    assert db.get_broadcasts(job_id=job['id'])[0]['sent'] == 2
+
+    # a resumed job carries on after the last user it reached
+    rest = db.send_broadcast_chunk(job['id'], limit=10)
+    assert [user_id for _, user_id in rest] == user_ids[2:]
+    assert db.send_broadcast_chunk(job['id']) == []
+    assert db.get_broadcasts(job_id=job['id'])[0]['status'] == 'done'
+    assert all(admin_messages(db, user_id) == ['اطلاعیه'] for user_id in user_ids)
+    # the chunk's rows are in the search index too
+    assert len(db.search_messages('اطلاعیه')['results']) == 5
+
+
+def test_ids_target_only_reaches_the_listed_users(db):
+    user_ids = users(db, 4)
+    job = db.create_broadcast({'type': 'ids', 'ids': [user_ids[1], user_ids[3], 999]}, 'text', 'سلام')
+    assert job['total'] == 2
+    sent = db.send_broadcast_chunk(job['id'])
+    assert [user_id for _, user_id in sent] == [user_ids[1], user_ids[3]]
+    assert admin_messages(db, user_ids[0]) == []
+
+
+def test_broadcaster_sends_every_chunk_and_notifies_the_hub(db):
+    user_ids = users(db, 5)
+    hub = RecordingHub()
+    broadcaster = Broadcaster(db, hub, chunk_size=2, pause=0)
+    job = broadcaster.start({'type': 'all'}, 'text', 'به‌روزرسانی')
+    wait_until_idle(broadcaster)
+
+    assert [len(chunk) for chunk in hub.published] == [2, 2, 1]
+    assert [user_id for chunk in hub.published for _, user_id in chunk] == user_ids
+    assert db.get_broadcasts(job_id=job['id'])[0]['status'] == 'done'
+
+
+def test_cancelled_broadcast_stops_sending(db):
+    user_ids = users(db, 5)
+    job = db.create_broadcast({'type': 'all'}, 'text', 'لغو')
+    db.send_broadcast_chunk(job['id'], limit=2)
+    assert db.cancel_broadcast(job['id'])
+    assert db.send_broadcast_chunk(job['id']) == []
+    assert admin_messages(db, user_ids[4]) == []
+    assert not db.cancel_broadcast(job['id'])
+
+
+def test_stale_jobs_are_claimed_once(db):
+    users(db, 2)
+    job = db.create_broadcast({'type': 'all'}, 'text', 'ادامه')
+    with db.connection() as conn:
+        conn.execute("UPDATE broadcast_jobs SET updated_at = datetime('now', '-1 hour')")
+        conn.commit()
+    assert db.claim_stale_broadcasts(60) == [job['id']]
+    # claiming refreshes updated_at, so a second worker does not take it too
+    assert db.claim_stale_broadcasts(60) == []
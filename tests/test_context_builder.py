@@ -0,0 +1,58 @@
+import threading
+
+from context_builder import MESSAGE_OVERHEAD, SUMMARY_PREFIX, ContextBuilder, estimate_tokens
+
+
+def conversation(db, count, sender_cycle=('user', 'ai')):
+    user_id = db.get_or_create_user('s1')
+    ids = [db.save_message(user_id, sender_cycle[i % len(sender_cycle)], 'text', f'پیام شماره {i}')
+           for i in range(count)]
+    return user_id, ids
+
+
+def test_token_estimate_counts_persian_heavier_than_latin():
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('a' * 40) == 11
+    assert estimate_tokens('س' * 40) == 21
+
+
+def test_history_is_the_newest_turns_within_max_turns(db):
+    user_id, ids = conversation(db, 10)
+    db.save_message(user_id, 'admin', 'text', 'پیام ادمین')
+    question = db.save_message(user_id, 'user', 'text', 'سوال تازه')
+
+    history = ContextBuilder(db, max_turns=5).build(user_id, before_id=question)
+    # the admin message fills one of the five slots but is not sent
+    assert [turn['content'] for turn in history] == [f'پیام شماره {i}' for i in range(6, 10)]
+    assert [turn['role'] for turn in history] == ['user', 'assistant', 'user', 'assistant']
+
+
+def test_history_stops_at_the_token_budget(db):
+    user_id, ids = conversation(db, 10)
+    per_turn = estimate_tokens('پیام شماره 0') + MESSAGE_OVERHEAD
+    history = ContextBuilder(db, max_tokens=per_turn * 3 + 1, max_turns=20).build(user_id)
+    assert [turn['content'] for turn in history] == [f'پیام شماره {i}' for i in range(7, 10)]
+    assert ContextBuilder(db, max_turns=0).build(user_id) == []
+
+
+def test_turns_pushed_out_are_summarized_in_the_background(db):
+    user_id, ids = conversation(db, 12)
+    done = threading.Event()
+    calls = []
+
+    def summarize(previous, turns):
+        calls.append((previous, [turn['content'] for turn in turns]))
+        done.set()
+        return 'کاربر درباره پیام‌ها پرسید'
+
+    builder = ContextBuilder(db, max_turns=4, summarize=summarize, summary_min_turns=6)
+    builder.build(user_id)
+    assert done.wait(5)
+    assert calls == [(None, [f'پیام شماره {i}' for i in range(8)])]
+
+    # wait for the summary to be saved, then it replaces the turns it covers
+    while builder._summarizing:
+        pass
+    history = builder.build(user_id)
+    assert history[0] == {'role': 'system', 'content': SUMMARY_PREFIX + 'کاربر درباره پیام‌ها پرسید'}
+    assert [turn['content'] for turn in history[1:]] == [f'پیام شماره {i}' for i in range(8, 12)]
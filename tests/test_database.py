@@ -0,0 +1,172 @@
+import sqlite3
+
+import pytest
+
+from database import Database
+
+
+def test_connections_are_pooled_in_wal_mode(db):
+    with db.connection() as conn:
+        first = conn
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+    with db.connection() as conn:
+        assert conn is first
+
+
+def test_uncommitted_work_is_rolled_back_on_return(db):
+    with db.connection() as conn:
+        conn.execute("INSERT INTO users (session_id) VALUES ('left-open')")
+    with db.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM users WHERE session_id = 'left-open'").fetchone()[0] == 0
+
+
+def test_readers_are_not_blocked_by_a_writer(db):
+    user_id = db.get_or_create_user('s1')
+    db.save_message(user_id, 'user', 'text', 'سلام')
+    with db.connection() as writer, db.connection() as reader:
+        writer.execute('BEGIN IMMEDIATE')
+        writer.execute("INSERT INTO users (session_id) VALUES ('pending')")
+        assert reader.execute('SELECT COUNT(*) FROM messages').fetchone()[0] == 1
+        writer.rollback()
+
+
+def test_closed_database_refuses_connections(tmp_path):
+    database = Database(str(tmp_path / 'chat.db'), pool_size=2)
+    database.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        with database.connection():
+            pass
+
+
+def test_user_list_reads_the_maintained_summary(db):
+    first = db.get_or_create_user('s1')
+    second = db.get_or_create_user('s2')
+    with db.connection() as conn:
+        conn.executemany(
+            'INSERT INTO messages (user_id, sender, message_type, content, timestamp) VALUES (?, ?, ?, ?, ?)',
+            [(first, 'user', 'text', 'سلام', '2024-01-01 10:00:00'),
+             (first, 'user', 'image', '', '2024-01-01 10:01:00'),
+             (second, 'user', 'text', 'سوال', '2024-01-01 09:00:00'),
+             (second, 'admin', 'text', 'جواب ' * 40, '2024-01-01 09:05:00')]
+        )
+        conn.commit()
+
+    users = db.get_all_users()
+    assert [user['id'] for user in users] == [first, second]
+    assert users[0]['message_count'] == 2
+    assert users[0]['last_message_preview'] == 'image'  # no text: the message type
+    assert users[0]['unread_count'] == 2
+    assert users[1]['unread_count'] == 0  # an admin reply resets it
+    assert len(users[1]['last_message_preview']) == 100
+
+    db.mark_read_by_admin(first)
+    assert db.get_all_users(limit=1)[0]['unread_count'] == 0
+    assert [user['id'] for user in db.get_all_users(sort='created')] == [second, first]
+
+
+def user_row(db, user_id):
+    with db.connection() as conn:
+        return conn.execute('SELECT last_active, ip_address FROM users WHERE id = ?', (user_id,)).fetchone()
+
+
+def test_repeat_lookups_do_not_touch_the_database(tmp_path):
+    statements = []
+    database = Database(str(tmp_path / 'chat.db'), activity_flush_interval=3600,
+                        trace_callback=statements.append)
+    try:
+        user_id = database.get_or_create_user('s1', '10.0.0.1')
+        statements.clear()
+        assert database.get_or_create_user('s1', '10.0.0.1') == user_id
+        assert database.get_or_create_user('s1') == user_id
+        assert statements == []
+    finally:
+        database.close()
+
+
+def test_visits_are_written_in_one_batch(db):
+    first = db.get_or_create_user('s1', '10.0.0.1')
+    second = db.get_or_create_user('s2')
+    with db.connection() as conn:
+        conn.execute("UPDATE users SET last_active = '2020-01-01 00:00:00'")
+        conn.commit()
+
+    db.get_or_create_user('s1', '10.0.0.2')  # new IP, from the cache
+    db.get_or_create_user('s2')
+    assert user_row(db, first) == ('2020-01-01 00:00:00', '10.0.0.1')
+    assert db.pending_activity([first, second, 999]) == {first, second}
+
+    assert db.flush_activity() == 2
+    last_active, ip_address = user_row(db, first)
+    assert last_active > '2020-01-01 00:00:00'
+    assert ip_address == '10.0.0.2'
+    assert db.flush_activity() == 0
+
+
+def test_history_pages_walk_back_by_id(db):
+    user_id = db.get_or_create_user('s1')
+    other_id = db.get_or_create_user('s2')
+    ids = []
+    for i in range(7):
+        ids.append(db.save_message(user_id, 'user', 'text', f'm{i}'))
+        db.save_message(other_id, 'user', 'text', f'other {i}')
+
+    newest = db.get_message_page(user_id, limit=3)
+    assert [m['id'] for m in newest['messages']] == ids[4:]
+    assert newest['has_more']
+    older = db.get_message_page(user_id, limit=3, before_id=ids[4])
+    assert [m['id'] for m in older['messages']] == ids[1:4]
+    oldest = db.get_message_page(user_id, limit=3, before_id=ids[1])
+    assert [m['id'] for m in oldest['messages']] == ids[:1]
+    assert not oldest['has_more']
+
+    # forward from a cursor, oldest first
+    forward = db.get_message_page(user_id, limit=2, after_id=ids[2])
+    assert [m['id'] for m in forward['messages']] == ids[3:5]
+    assert forward['has_more']
+
+
+def test_pages_are_index_range_scans(db):
+    with db.connection() as conn:
+        plan = ' '.join(row[3] for row in conn.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM messages m WHERE m.user_id = 1 AND m.id < 100 '
+            'ORDER BY m.id DESC LIMIT 51'
+        ))
+    assert 'idx_messages_user_id_id' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+def test_write_behind_group_commits_and_isolates_a_bad_row(tmp_path):
+    statements = []
+    db = Database(str(tmp_path / 'chat.db'), write_behind=True, write_batch_ms=200,
+                  trace_callback=statements.append)
+    user_id = db.get_or_create_user('s1')
+    statements.clear()
+
+    futures = [db.save_message_async(user_id, 'user', 'text', f'm{i}') for i in range(3)]
+    bad = db.save_message_async(user_id, 'user', 'image', object())
+    futures.append(db.save_message_async(user_id, 'user', 'text', 'm3'))
+
+    ids = [future.result(5) for future in futures]
+    with pytest.raises(sqlite3.Error):
+        bad.result(5)
+    assert [m['content'] for m in db.get_messages(user_id)] == ['m0', 'm1', 'm2', 'm3']
+    assert [m['id'] for m in db.get_messages(user_id)] == ids
+    # the batch failed as a whole once, then each row was committed on its own
+    assert statements.count('COMMIT') == 4
+    db.close()
+
+
+def test_close_commits_queued_messages(tmp_path):
+    path = str(tmp_path / 'chat.db')
+    db = Database(path, write_behind=True, write_batch_ms=50)
+    user_id = db.get_or_create_user('s1')
+    futures = [db.save_message_async(user_id, 'user', 'text', f'm{i}') for i in range(20)]
+    db.close()
+    assert all(future.done() for future in futures)
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.save_message(user_id, 'user', 'text', 'late')
+
+    reopened = Database(path)
+    assert len(reopened.get_messages(user_id)) == 20
+    reopened.close()
@@ -0,0 +1,89 @@
+import json
+import os
+
+import pytest
+
+from keyword_rules import KeywordAutomaton, ReloadableRuleSet, RuleSet
+
+
+def test_automaton_finds_overlapping_keywords():
+    automaton = KeywordAutomaton([('hers', 0), ('he', 1), ('she', 2), ('his', 3)])
+    # 'she' and 'he' end inside 'ushers' only through failure links
+    assert automaton.first_rule('ushers') == 0
+    assert automaton.first_rule('ushe') == 1
+    assert automaton.first_rule('this') == 3
+    assert automaton.first_rule('nothing') is None
+
+
+def test_lowest_rule_wins_regardless_of_position():
+    automaton = KeywordAutomaton([('خداحافظ', 0), ('سلام', 1)])
+    assert automaton.first_rule('سلام و خداحافظ') == 0
+
+
+RULES = {
+    'local_responses': [
+        {'keywords': ['سلام'], 'response': 'درود'},
+        {'keywords': ['ساعت'], 'response': 'ساعت {time}', 'priority': -1},
+    ],
+    'response_decorations': [
+        {'keywords': ['سلام'], 'append': ' 😊', 'unless': '😊'},
+    ],
+    'fallback_rules': [{'keywords': ['چطور'], 'response': 'توضیح بیشتر'}],
+    'fallback_responses': ['...'],
+    'unwanted_prefixes': ['خب، ', 'به عنوان ChatGPT'],
+}
+
+
+def test_rule_set_priorities_and_decorations():
+    rules = RuleSet(RULES)
+    assert rules.local_response('سلام، ساعت چنده؟').startswith('ساعت ')
+    assert rules.local_response('SALAM') is None
+    assert rules.fallback_response('چطور کار می‌کند') == 'توضیح بیشتر'
+    assert rules.decorate('سلام') == 'سلام 😊'
+    assert rules.decorate('سلام 😊') == 'سلام 😊'
+
+
+def test_prefixes_are_stripped_in_one_pass_in_file_order():
+    rules = RuleSet(RULES)
+    assert rules.strip_prefixes('  خب، به عنوان ChatGPT پاسخ') == 'پاسخ'
+    # a prefix that comes earlier in the file is not checked again
+    assert rules.strip_prefixes('به عنوان ChatGPT خب، پاسخ') == 'خب، پاسخ'
+    assert rules.strip_prefixes('خب، خب، پاسخ') == 'خب، پاسخ'
+
+
+def write_rules(path, data, mtime):
+    path.write_text(data if isinstance(data, str) else json.dumps(data), encoding='utf-8')
+    os.utime(path, (mtime, mtime))
+
+
+@pytest.mark.parametrize('broken', [
+    '{"local_responses": [',  # half-written file
+    {'local_responses': [{'keywords': 5, 'response': ''}]},  # TypeError
+    {'local_responses': ['سلام']},  # AttributeError
+    [],  # AttributeError
+    {'local_responses': [{'response': ''}]},  # KeyError
+])
+def test_broken_file_keeps_previous_rules(tmp_path, broken):
+    path = tmp_path / 'rules.json'
+    write_rules(path, RULES, 1_000_000)
+    reloadable = ReloadableRuleSet(str(path), check_interval=0)
+    previous = reloadable.get()
+
+    write_rules(path, broken, 2_000_000)
+    assert reloadable.get() is previous
+
+    changed = dict(RULES, unwanted_prefixes=['باشه، '])
+    write_rules(path, changed, 3_000_000)
+    assert reloadable.get().strip_prefixes('باشه، پاسخ') == 'پاسخ'
+
+
+def test_admin_reload_rejects_broken_file(flask_app, tmp_path, monkeypatch):
+    path = tmp_path / 'rules.json'
+    write_rules(path, {'local_responses': [{'keywords': 5, 'response': ''}]}, 1_000_000)
+    monkeypatch.setattr(flask_app.ai_service.rules, 'path', str(path))
+    previous = flask_app.ai_service.rules.get()
+
+    client = flask_app.app.test_client()
+    response = client.post('/api/admin/rules/reload', data={'password': 'admin123'})
+    assert response.status_code == 400
+    assert flask_app.ai_service.rules.get() is previous
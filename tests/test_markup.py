@@ -0,0 +1,32 @@
+from markup import process_latex, render_message
+
+
+def test_latex_is_turned_into_markup():
+    assert process_latex('x $a^2$ y') == 'x <span class="latex">a^2</span> y'
+    assert process_latex('$$\\frac{1}{2}$$') == '<div class="latex-block">\\frac{1}{2}</div>'
+    assert process_latex('') == ''
+    assert render_message('image', '$a$') is None
+    assert render_message('text', 'بدون فرمول') == 'بدون فرمول'
+
+
+def stored_html(db, message_id):
+    with db.connection() as conn:
+        return conn.execute('SELECT content_html FROM messages WHERE id = ?', (message_id,)).fetchone()[0]
+
+
+def test_html_is_rendered_once_at_write_time(db):
+    user_id = db.get_or_create_user('s1')
+    message_id = db.save_message(user_id, 'ai', 'text', 'جواب $x=1$')
+    assert stored_html(db, message_id) == 'جواب <span class="latex">x=1</span>'
+    assert db.get_messages(user_id)[0]['content_html'] == stored_html(db, message_id)
+
+
+def test_older_rows_are_rendered_on_read_and_written_back(db):
+    user_id = db.get_or_create_user('s1')
+    message_id = db.save_message(user_id, 'ai', 'text', '$$y$$')
+    with db.connection() as conn:
+        conn.execute('UPDATE messages SET content_html = NULL')
+        conn.commit()
+
+    assert db.get_messages(user_id)[0]['content_html'] == '<div class="latex-block">y</div>'
+    assert stored_html(db, message_id) == '<div class="latex-block">y</div>'
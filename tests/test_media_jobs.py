@@ -0,0 +1,37 @@
+import os
+import shutil
+import subprocess
+import sys
+
+from conftest import ROOT
+from database import Database
+from media_jobs import is_media
+
+
+def test_is_media():
+    assert is_media('blobs/ab/cd.png')
+    assert is_media('blobs/ab/cd.mp3')
+    assert not is_media('blobs/ab/cd.pdf')
+
+
+def test_cli_command_does_not_process_media(tmp_path):
+    os.makedirs(tmp_path / 'data')
+    shutil.copytree(os.path.join(ROOT, 'rules'), tmp_path / 'rules')
+    db = Database(str(tmp_path / 'data' / 'chat_data.db'))
+    db.enqueue_media('blobs/ab/cd.png')
+    db.close()
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'reindex-search'],
+                   cwd=tmp_path, env=env, check=True, capture_output=True, timeout=60)
+
+    db = Database(str(tmp_path / 'data' / 'chat_data.db'))
+    with db.connection() as conn:
+        row = conn.execute('SELECT status, attempts FROM media').fetchone()
+    db.close()
+    assert row == ('pending', 0)
+
+
+def test_media_dispatcher_starts_with_first_request(flask_app):
+    flask_app.app.test_client().get('/api/get_messages')
+    assert flask_app.media_processor._thread is not None
@@ -0,0 +1,71 @@
+import threading
+
+from message_hub import MessageHub
+
+
+def waiter(hub, user_id, since_id, timeout=2):
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(woke=hub.wait(user_id, since_id, timeout)))
+    thread.start()
+    return thread, result
+
+
+def test_publish_wakes_only_that_user(db):
+    hub = MessageHub(db, poll_interval=60)
+    try:
+        thread, result = waiter(hub, 1, 0)
+        hub.publish(2, 5)
+        assert not hub.wait(1, 0, timeout=0.05)
+        hub.publish(1, 6)
+        thread.join()
+        assert result['woke']
+    finally:
+        hub.stop()
+
+
+def test_latest_by_user_is_bounded(db):
+    hub = MessageHub(db, poll_interval=60, max_users=2)
+    try:
+        hub.publish_many([(10, 1), (11, 2), (12, 3)])
+        assert list(hub._latest_by_user) == [2, 3]
+        # user 1 fell out; one wake so the caller reads the database, then a normal wait
+        assert hub.wait(1, 0, timeout=0.05)
+        assert not hub.wait(1, 10, timeout=0.05)
+    finally:
+        hub.stop()
+
+
+def test_waiting_user_is_not_evicted(db):
+    hub = MessageHub(db, poll_interval=60, max_users=2)
+    try:
+        hub.publish(1, 10)
+        thread, result = waiter(hub, 1, 10)
+        while not hub._waiting:
+            pass
+        hub.publish_many([(11, 2), (12, 3), (13, 4)])
+        assert 1 in hub._latest_by_user
+        hub.publish(1, 14)
+        thread.join()
+        assert result['woke']
+    finally:
+        hub.stop()
+
+
+def test_watcher_reads_other_workers_in_batches(db):
+    user_id = db.get_or_create_user('s1')
+    hub = MessageHub(db, poll_interval=0.01, batch_size=2)
+    try:
+        hub.wait(None, 0, timeout=0)  # starts the watcher at the current tail
+        # saved without publish, as another worker would
+        ids = [db.save_message(user_id, 'user', 'text', f'm{i}') for i in range(5)]
+        assert hub.wait(user_id, ids[-2], timeout=2)
+        assert hub._watched_id == ids[-1]
+    finally:
+        hub.stop()
+
+
+def test_message_ids_since_is_limited(db):
+    user_id = db.get_or_create_user('s1')
+    ids = [db.save_message(user_id, 'user', 'text', f'm{i}') for i in range(3)]
+    assert db.get_message_ids_since(0, 2) == [(ids[0], user_id), (ids[1], user_id)]
+    assert db.get_message_ids_since(ids[1]) == [(ids[2], user_id)]
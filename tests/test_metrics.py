@@ -0,0 +1,82 @@
+import json
+import logging
+
+from metrics import (
+    Callback, Counter, Histogram, Registry, end_trace, instrument_methods, start_trace, trace_sql
+)
+
+
+def test_prometheus_text_format():
+    registry = Registry()
+    requests = Counter('requests_total', 'Requests', ('route',), registry=registry)
+    latency = Histogram('latency_seconds', 'Latency', buckets=(0.1, 1), registry=registry)
+    Callback('ratio', 'Ratio', lambda: 0.5, registry=registry)
+    requests.inc(route='/a "x"')
+    requests.inc(2, route='/a "x"')
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    lines = registry.render().splitlines()
+    assert 'requests_total{route="/a \\"x\\""} 3' in lines
+    assert '# TYPE latency_seconds histogram' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'latency_seconds_count 3' in lines
+    assert 'ratio 0.5' in lines
+
+
+def test_trace_masks_sql_literals_and_collapses_repeats():
+    start_trace()
+    trace_sql("SELECT id FROM messages WHERE content = 'it''s secret'")
+    trace_sql("SELECT id FROM messages WHERE content = 'other'")
+    trace_sql('-- messages_fts internal')
+    events = end_trace()
+    assert events == [('sql', 'SELECT id FROM messages WHERE content = ?', None)]
+    # nothing is recorded outside a traced request
+    trace_sql('SELECT 1')
+    assert end_trace() is None
+
+
+def test_instrumented_methods_are_timed_and_counted():
+    registry = Registry()
+    seconds = Histogram('method_seconds', 'Method latency', ('method',), registry=registry)
+    errors = Counter('method_errors_total', 'Errors', ('method',), registry=registry)
+
+    class Store:
+        def ok(self):
+            return 1
+
+        def fail(self):
+            raise ValueError
+
+    store = instrument_methods(Store(), seconds, errors)
+    assert store.ok() == 1
+    try:
+        store.fail()
+    except ValueError:
+        pass
+    text = registry.render()
+    assert 'method_seconds_count{method="ok"} 1' in text
+    assert 'method_errors_total{method="fail"} 1' in text
+
+
+def test_metrics_endpoint_requires_auth(flask_app):
+    client = flask_app.app.test_client()
+    assert client.get('/metrics').status_code == 403
+    response = client.get('/metrics?password=admin123')
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds' in response.get_data(as_text=True)
+
+
+def test_slow_requests_go_to_the_app_logger(flask_app, monkeypatch, caplog):
+    monkeypatch.setitem(flask_app.app.config, 'METRICS_SLOW_REQUEST_MS', 0)
+    with caplog.at_level(logging.WARNING, logger=flask_app.app.logger.name):
+        flask_app.app.test_client().get('/api/get_messages?chat_type=admin&password=admin123')
+    records = [r for r in caplog.records if r.getMessage().startswith('Slow request: ')]
+    assert len(records) == 1
+    entry = json.loads(records[0].getMessage()[len('Slow request: '):])
+    assert entry['route'] == '/api/get_messages'
+    assert entry['status'] == 200
+    assert any(kind == 'db' for kind, _, _ in entry['events'])
@@ -0,0 +1,128 @@
+import sqlite3
+
+from database import Database
+from migrations import MIGRATIONS, get_version, migrate
+
+
+def summary(db, user_id):
+    with db.connection() as conn:
+        return conn.execute(
+            'SELECT message_count, last_message_preview, last_activity FROM users WHERE id = ?',
+            (user_id,)
+        ).fetchone()
+
+
+def add_message(db, user_id, content, timestamp):
+    with db.connection() as conn:
+        cursor = conn.execute(
+            "INSERT INTO messages (user_id, sender, message_type, content, timestamp) "
+            "VALUES (?, 'user', 'text', ?, ?)",
+            (user_id, content, timestamp)
+        )
+        conn.commit()
+        return cursor.lastrowid
+
+
+def delete_message(db, message_id):
+    with db.connection() as conn:
+        conn.execute('DELETE FROM messages WHERE id = ?', (message_id,))
+        conn.commit()
+
+
+def test_new_database_is_at_the_latest_version(db):
+    with db.connection() as conn:
+        assert get_version(conn) == MIGRATIONS[-1][0]
+
+
+def test_deleting_the_newest_message_recomputes_the_summary(db):
+    user_id = db.get_or_create_user('s1')
+    first = add_message(db, user_id, 'اول', '2024-01-01 10:00:00')
+    second = add_message(db, user_id, 'دوم', '2024-01-02 10:00:00')
+    third = add_message(db, user_id, 'سوم', '2024-01-03 10:00:00')
+
+    delete_message(db, first)  # an old message, as retention deletes them
+    assert summary(db, user_id) == (2, 'سوم', '2024-01-03 10:00:00')
+
+    delete_message(db, third)
+    assert summary(db, user_id) == (1, 'دوم', '2024-01-02 10:00:00')
+
+    delete_message(db, second)
+    assert summary(db, user_id) == (0, None, None)
+
+
+def test_upgrade_repairs_summaries_left_by_the_old_trigger(db):
+    user_id = db.get_or_create_user('s1')
+    add_message(db, user_id, 'اول', '2024-01-01 10:00:00')
+    newest = add_message(db, user_id, 'دوم', '2024-01-02 10:00:00')
+    with db.connection() as conn:
+        # back to version 9 with the trigger it shipped with
+        conn.executescript('''
+            DROP TRIGGER trg_messages_summary_delete;
+            CREATE TRIGGER trg_messages_summary_delete
+            AFTER DELETE ON messages
+            BEGIN
+                UPDATE users SET message_count = MAX(message_count - 1, 0)
+                WHERE id = OLD.user_id;
+            END;
+            PRAGMA user_version = 9;
+        ''')
+    delete_message(db, newest)
+    assert summary(db, user_id) == (1, 'دوم', '2024-01-02 10:00:00')
+
+    with db.connection() as conn:
+        assert migrate(conn) == MIGRATIONS[-1][0]
+    assert summary(db, user_id) == (1, 'اول', '2024-01-01 10:00:00')
+
+
+def test_baseline_database_is_upgraded_in_place(tmp_path):
+    # schema and data as the app created them before migrations existed
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT UNIQUE,
+            username TEXT DEFAULT 'کاربر',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_active TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            sender TEXT,
+            message_type TEXT,
+            content TEXT,
+            file_path TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        INSERT INTO users (session_id) VALUES ('old-session');
+        INSERT INTO messages (user_id, sender, message_type, content, timestamp)
+        VALUES (1, 'user', 'text', 'پیام قدیمی', '2023-05-01 08:00:00'),
+               (1, 'admin', 'text', 'پاسخ', '2023-05-01 09:00:00'),
+               (1, 'user', 'text', 'سوال بعدی', '2023-05-02 08:00:00');
+    ''')
+    conn.close()
+
+    db = Database(path)
+    try:
+        with db.connection() as conn:
+            assert get_version(conn) == MIGRATIONS[-1][0]
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            assert {'idx_messages_user_id_id', 'idx_users_ip_address', 'idx_users_last_activity'} <= indexes
+            plan = ' '.join(row[3] for row in conn.execute(
+                'EXPLAIN QUERY PLAN SELECT id FROM messages WHERE user_id = 1 AND id > 0 ORDER BY id'
+            ))
+            assert 'idx_messages_user_id_id' in plan
+            unread = conn.execute('SELECT unread_admin_count FROM users WHERE id = 1').fetchone()[0]
+        # summary columns backfilled from the existing rows
+        assert summary(db, 1) == (3, 'سوال بعدی', '2023-05-02 08:00:00')
+        assert unread == 1
+        assert len(db.search_messages('قدیمی')['results']) == 1
+        assert db.get_or_create_user('old-session') == 1
+    finally:
+        db.close()
+
+    # running the migrations again is a no-op
+    conn = sqlite3.connect(path)
+    assert migrate(conn) == MIGRATIONS[-1][0]
+    conn.close()
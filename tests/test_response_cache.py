@@ -0,0 +1,110 @@
+import sqlite3
+import threading
+
+import pytest
+
+import response_cache
+from response_cache import ResponseCache, normalize_prompt
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'ai_cache.db')
+
+
+def test_near_identical_prompts_share_a_key():
+    assert normalize_prompt('  سلام   دنيا؟! ') == 'سلام دنیا'
+    key = ResponseCache.make_key('سلام دنیا', 'gpt', 'system')
+    assert ResponseCache.make_key('سلام  دنيا?', 'gpt', 'system') == key
+    assert ResponseCache.make_key('سلام دنیا', 'gpt', 'other') != key
+
+
+def test_memory_layer_lru_and_ttl():
+    cache = ResponseCache(max_entries=2)
+    cache.set('a', 'p', 'A')
+    cache.set('b', 'p', 'B')
+    assert cache.get('a') == 'A'
+    cache.set('c', 'p', 'C')  # 'b' is the least recently used
+    assert cache.get('b') is None
+    assert cache.get('c') == 'C'
+
+    expired = ResponseCache(ttl=0)
+    expired.set('a', 'p', 'A')
+    assert expired.get('a') is None
+    assert expired.stats()['memory_entries'] == 0
+
+
+def test_disk_layer_is_shared_between_workers(cache_path):
+    first = ResponseCache(db_path=cache_path)
+    second = ResponseCache(db_path=cache_path)
+    try:
+        first.set('k', 'prompt', 'answer')
+        assert second.get('k') == 'answer'
+        stats = second.stats()
+        assert (stats['disk_hits'], stats['disk_entries']) == (1, 1)
+    finally:
+        first.close()
+        second.close()
+
+
+def test_purge_clears_other_workers_memory(cache_path, monkeypatch):
+    monkeypatch.setattr(response_cache, 'GENERATION_CHECK_INTERVAL', 0)
+    first = ResponseCache(db_path=cache_path)
+    second = ResponseCache(db_path=cache_path)
+    try:
+        first.set('k', 'prompt', 'answer')
+        assert second.get('k') == 'answer'  # now in second's memory layer
+        assert first.purge() == 1
+        assert second.get('k') is None
+    finally:
+        first.close()
+        second.close()
+
+
+def test_disk_layer_is_capped(cache_path, monkeypatch):
+    monkeypatch.setattr(response_cache, 'PRUNE_EVERY', 1)
+    cache = ResponseCache(max_entries=1, db_path=cache_path, disk_max_entries=3)
+    try:
+        for i in range(6):
+            cache.set(f'k{i}', 'p', f'v{i}')
+        assert cache.stats()['disk_entries'] == 3
+        assert [entry['key'] for entry in cache.entries()] == ['k5', 'k4', 'k3']
+    finally:
+        cache.close()
+
+
+class BrokenConnection:
+    def execute(self, *args):
+        raise sqlite3.OperationalError('database is locked')
+
+    def close(self):
+        pass
+
+
+def test_disk_errors_do_not_escape(cache_path):
+    cache = ResponseCache(db_path=cache_path)
+    cache.set('k', 'p', 'v')
+    cache._conn.close()
+    cache._conn = BrokenConnection()
+
+    assert cache.get('k') == 'v'
+    assert cache.get('missing') is None
+    cache.set('k2', 'p', 'v2')
+    assert cache.purge() == 2
+    cache.purge_expired()
+    assert 'disk_entries' not in cache.stats()
+
+
+def test_memory_hits_do_not_wait_for_the_disk(cache_path, monkeypatch):
+    monkeypatch.setattr(response_cache, 'GENERATION_CHECK_INTERVAL', float('inf'))
+    cache = ResponseCache(db_path=cache_path)
+    cache.set('k', 'p', 'v')
+    result = []
+    try:
+        with cache._disk_lock:  # a slow disk write in another thread
+            thread = threading.Thread(target=lambda: result.append(cache.get('k')))
+            thread.start()
+            thread.join(timeout=2)
+            assert result == ['v']
+    finally:
+        cache.close()
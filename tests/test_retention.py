@@ -0,0 +1,100 @@
+import pytest
+
+from retention import Retention
+
+
+def age_user(db, user_id, hours):
+    with db.connection() as conn:
+        conn.execute(
+            "UPDATE users SET last_active = datetime('now', ?) WHERE id = ?",
+            (f'-{hours} hours', user_id)
+        )
+        conn.execute(
+            "UPDATE users SET last_activity = datetime('now', ?) WHERE id = ? AND last_activity IS NOT NULL",
+            (f'-{hours} hours', user_id)
+        )
+        conn.execute(
+            "UPDATE messages SET timestamp = datetime('now', ?) WHERE user_id = ?",
+            (f'-{hours} hours', user_id)
+        )
+        conn.commit()
+
+
+def user_exists(db, user_id):
+    with db.connection() as conn:
+        return conn.execute('SELECT 1 FROM users WHERE id = ?', (user_id,)).fetchone() is not None
+
+
+@pytest.fixture
+def retention(db, tmp_path):
+    return Retention(db, str(tmp_path / 'archive'), message_days=None, inactive_user_days=30,
+                     empty_session_hours=24, batch_pause=0)
+
+
+def test_empty_session_is_deleted_and_its_cached_session_forgotten(db, retention):
+    user_id = db.get_or_create_user('idle')
+    age_user(db, user_id, 48)
+    db.flush_activity()
+
+    assert retention.run()['sessions_deleted'] == 1
+    assert not user_exists(db, user_id)
+    # The cached lookup must not hand out the deleted id
+    assert db.get_or_create_user('idle') != user_id
+
+
+def test_buffered_visit_keeps_empty_session(db, retention):
+    user_id = db.get_or_create_user('visitor')
+    age_user(db, user_id, 48)
+    # A visit that is still only in the activity buffer
+    db.get_or_create_user('visitor')
+
+    assert retention.run()['sessions_deleted'] == 0
+    assert user_exists(db, user_id)
+
+
+def test_buffered_visit_keeps_inactive_user(db, retention):
+    user_id = db.get_or_create_user('returning')
+    db.save_message(user_id, 'user', 'text', 'old message')
+    age_user(db, user_id, 24 * 60)
+    db.get_or_create_user('returning')
+
+    stats = retention.run()
+    assert stats['users_archived'] == 0
+    assert stats['messages_archived'] == 0
+    assert user_exists(db, user_id)
+
+
+def test_message_sent_while_archiving_is_kept(db, retention, monkeypatch):
+    user_id = db.get_or_create_user('late')
+    old_id = db.save_message(user_id, 'user', 'text', 'old message')
+    age_user(db, user_id, 24 * 60)
+    db.flush_activity()
+
+    archive = retention._archive_old_messages
+    sent = []
+
+    def archive_then_reply(*args, **kwargs):
+        # The user comes back after being selected, before the archive runs
+        sent.append(db.save_message(user_id, 'user', 'text', 'I am back'))
+        return archive(*args, **kwargs)
+
+    monkeypatch.setattr(retention, '_archive_old_messages', archive_then_reply)
+    stats = retention.run()
+
+    assert stats['users_archived'] == 0
+    assert user_exists(db, user_id)
+    # A returning user keeps the whole conversation
+    assert [msg['id'] for msg in db.get_messages(user_id)] == [old_id] + sent
+
+
+def test_inactive_user_is_archived(db, retention, tmp_path):
+    user_id = db.get_or_create_user('gone')
+    db.save_message(user_id, 'user', 'text', 'goodbye')
+    age_user(db, user_id, 24 * 60)
+    db.flush_activity()
+
+    stats = retention.run()
+    assert stats == {'messages_archived': 1, 'users_archived': 1, 'sessions_deleted': 0,
+                     'pages_freed': stats['pages_freed']}
+    assert not user_exists(db, user_id)
+    assert sorted(p.name.split('-')[0] for p in (tmp_path / 'archive').glob('*.gz')) == ['messages', 'users']
@@ -0,0 +1,64 @@
+from benchmarks import bench_queries
+from database import build_search_query
+from markup import highlight_snippet
+
+
+def test_query_is_quoted_prefix_terms():
+    assert build_search_query('  ') is None
+    assert build_search_query('سلام دنیا') == '"سلام"* "دنیا"*'
+    # FTS5 syntax in user input stays a plain term
+    assert build_search_query('a OR b') == '"a"* "or"* "b"*'
+
+
+def test_search_matches_persian_variants(db):
+    user_id = db.get_or_create_user('s1')
+    # Arabic yeh/kaf, harakat and a zero-width non-joiner in the stored text
+    message_id = db.save_message(user_id, 'user', 'text', 'كتاب‌هاي عَلی')
+    db.save_message(user_id, 'user', 'text', 'چیز دیگری')
+
+    for query in ('کتاب', 'کتاب‌های', 'علی', 'عل'):
+        results = db.search_messages(query)['results']
+        assert [r['message_id'] for r in results] == [message_id], query
+
+
+def test_search_filters_by_user_and_pages(db):
+    first = db.get_or_create_user('s1')
+    second = db.get_or_create_user('s2')
+    ids = [db.save_message(first, 'user', 'text', f'سفارش {i}') for i in range(3)]
+    db.save_message(second, 'user', 'text', 'سفارش دیگر')
+
+    page = db.search_messages('سفارش', user_id=first, limit=2)
+    assert page['has_more']
+    rest = db.search_messages('سفارش', user_id=first, limit=2, offset=2)
+    assert not rest['has_more']
+    found = [r['message_id'] for r in page['results'] + rest['results']]
+    assert sorted(found) == ids
+
+
+def test_snippet_is_escaped_before_highlighting(db):
+    user_id = db.get_or_create_user('s1')
+    db.save_message(user_id, 'user', 'text', '<script>alert(1)</script> نکته')
+
+    snippet = highlight_snippet(db.search_messages('نکته')['results'][0]['snippet'])
+    assert '<script>' not in snippet
+    assert '&lt;script&gt;' in snippet
+    assert '<mark>نکته</mark>' in snippet
+
+
+def test_reindex_restores_the_index(db):
+    user_id = db.get_or_create_user('s1')
+    db.save_message(user_id, 'user', 'text', 'پیام قدیمی')
+    with db.connection() as conn:
+        conn.execute('DELETE FROM messages_fts')
+        conn.commit()
+    assert db.search_messages('قدیمی')['results'] == []
+    assert db.rebuild_search_index() == 1
+    assert len(db.search_messages('قدیمی')['results']) == 1
+
+
+def test_benchmark_database_is_searchable(tmp_path):
+    db = bench_queries.generate(str(tmp_path / 'bench.db'), users=3, messages=20)
+    try:
+        assert len(db.search_messages('آزمایشی', limit=50)['results']) == 20
+    finally:
+        db.close()
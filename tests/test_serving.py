@@ -0,0 +1,74 @@
+import hashlib
+
+import pytest
+from flask import Flask
+
+from serving import IMMUTABLE_MAX_AGE, FileHasher, FileServer
+
+DATA = bytes(range(256)) * 40
+DIGEST = hashlib.sha256(DATA).hexdigest()
+BLOB = f'blobs/{DIGEST[:2]}/{DIGEST[2:4]}/{DIGEST}.bin'
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / 'old.txt').write_bytes(DATA)
+    blob = tmp_path.joinpath(*BLOB.split('/'))
+    blob.parent.mkdir(parents=True)
+    blob.write_bytes(DATA)
+    return tmp_path
+
+
+def make_client(root, **options):
+    app = Flask(__name__)
+    server = FileServer(str(root), max_age=60, **options)
+    app.add_url_rule('/files/<path:filename>', 'files', lambda filename: server.send(filename))
+    return app.test_client()
+
+
+def test_blobs_are_immutable_and_revalidate_with_304(files):
+    client = make_client(files)
+    response = client.get(f'/files/{BLOB}')
+    assert response.status_code == 200
+    assert response.headers['ETag'] == f'"{DIGEST}"'
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == IMMUTABLE_MAX_AGE
+
+    response = client.get(f'/files/{BLOB}', headers={'If-None-Match': f'"{DIGEST}"'})
+    assert response.status_code == 304
+    assert response.data == b''
+
+
+def test_other_files_get_a_content_etag_and_max_age(files):
+    response = make_client(files).get('/files/old.txt')
+    assert response.headers['ETag'] == f'"{DIGEST}"'
+    assert response.cache_control.max_age == 60
+    assert not response.cache_control.immutable
+
+
+def test_range_requests_return_partial_content(files):
+    response = make_client(files).get(f'/files/{BLOB}', headers={'Range': 'bytes=100-199'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 100-199/{len(DATA)}'
+    assert response.data == DATA[100:200]
+
+
+def test_missing_files_and_traversal_are_404(files):
+    client = make_client(files)
+    assert client.get('/files/nope.txt').status_code == 404
+    assert client.get('/files/../secret').status_code == 404
+
+
+def test_x_accel_leaves_the_body_to_nginx(files):
+    response = make_client(files, offload='x-accel').get(f'/files/{BLOB}')
+    assert response.headers['X-Accel-Redirect'] == f'/protected-uploads/{BLOB}'
+    assert response.data == b''
+
+
+def test_hasher_recomputes_after_the_file_changes(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'one')
+    hasher = FileHasher()
+    assert hasher.digest(str(path)) == hashlib.sha256(b'one').hexdigest()
+    path.write_bytes(b'three')
+    assert hasher.digest(str(path)) == hashlib.sha256(b'three').hexdigest()
@@ -0,0 +1,65 @@
+import hashlib
+import io
+import os
+
+from flask import Flask, request
+from werkzeug.datastructures import FileStorage
+
+from storage import BlobStore, HashingFile
+
+DATA = b'\x89PNG fake image bytes' * 1000
+DIGEST = hashlib.sha256(DATA).hexdigest()
+
+
+def upload(data=DATA, filename='a.png'):
+    return FileStorage(stream=io.BytesIO(data), filename=filename)
+
+
+def blob_files(store):
+    return sorted(relpath for relpath, _ in store.iter_blobs())
+
+
+def test_identical_uploads_are_stored_once(tmp_path):
+    store = BlobStore(str(tmp_path), chunk_size=1024)
+    first = store.save(upload(), 'png')
+    second = store.save(upload(filename='copy.png'), 'png')
+    assert first == second == f'blobs/{DIGEST[:2]}/{DIGEST[2:4]}/{DIGEST}.png'
+    assert blob_files(store) == [first]
+    with open(store.full_path(first), 'rb') as f:
+        assert f.read() == DATA
+    assert os.listdir(store.tmp_dir) == []
+
+
+def test_upload_is_hashed_while_it_is_received(tmp_path):
+    store = BlobStore(str(tmp_path))
+    app = Flask(__name__)
+    app.request_class = store.request_class()
+    saved = {}
+
+    @app.route('/upload', methods=['POST'])
+    def receive():
+        file = request.files['file']
+        saved['streamed'] = isinstance(file.stream, HashingFile)
+        saved['path'] = store.save(file, 'png')
+        return ''
+
+    app.test_client().post('/upload', data={'file': (io.BytesIO(DATA), 'a.png')})
+    assert saved['streamed']
+    assert saved['path'].endswith(f'{DIGEST}.png')
+
+
+def test_garbage_collection_keeps_referenced_and_recent_blobs(tmp_path):
+    store = BlobStore(str(tmp_path))
+    kept = store.save(upload(b'kept'), 'txt')
+    orphan = store.save(upload(b'orphan'), 'txt')
+    recent = store.save(upload(b'recent'), 'txt')
+    for path in (kept, orphan):
+        os.utime(store.full_path(path), (0, 0))
+
+    removed, freed = store.collect_garbage(lambda path: path == kept, grace=3600, dry_run=True)
+    assert removed == [orphan]
+    assert len(blob_files(store)) == 3
+
+    removed, freed = store.collect_garbage(lambda path: path == kept, grace=3600)
+    assert (removed, freed) == ([orphan], len(b'orphan'))
+    assert blob_files(store) == sorted([kept, recent])
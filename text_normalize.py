@@ -0,0 +1,18 @@
+import re
+
+# یکسان‌سازی حروف عربی/فارسی و حذف اعراب و کشیده
+_CHAR_MAP = str.maketrans({
+    '\u064a': '\u06cc', '\u0649': '\u06cc', '\u0643': '\u06a9', '\u0629': '\u0647',
+    '\u06c0': '\u0647', '\u0623': '\u0627', '\u0625': '\u0627',
+    '\u200c': ' ', '\u0640': None,
+})
+_DIACRITICS = re.compile('[\u064b-\u065f\u0670]')
+
+
+def normalize_text(text):
+    """شکل یکسان متن فارسی برای مقایسه و جستجو
+
+    ی/ک عربی به فارسی، حذف اعراب و کشیده و نیم‌فاصله به جای فاصله؛ برای
+    tokenizer دیتابیس اعراب و نیم‌فاصله جداکننده کلمه هستند.
+    """
+    return _DIACRITICS.sub('', (text or '').lower().translate(_CHAR_MAP))